@@ -9,12 +9,29 @@ import os
 import threading
 import time
 import uuid
-import zipfile
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from datetime import datetime, timedelta
+from flask import Flask, Response, render_template, request, jsonify, send_file, send_from_directory, stream_with_context
 from dotenv import load_dotenv
-from image_generator import ImageGenerator, get_aspect_ratio_prefix
+from werkzeug.utils import secure_filename
+from circuit_breaker import CircuitBreakers
+from client_pool import default_client_pool
+from concurrency import ConcurrencyLimiters
+from engine_loop import inflight_calls
+from image_encoding import (
+    IMAGE_EXTENSIONS, OUTPUT_FORMATS, is_format_supported, make_thumbnail, normalize_output_format, thumbnail_filename
+)
+from history_store import HistoryStore
+from image_generator import ImageGenerator, get_aspect_ratio_prefix, validate_model_aspect_ratio, write_file_atomic
+from job_archive import JobArchives
+from job_store import create_job_store
+from key_validation import KeyValidator, is_image_model, load_or_create_salt
+from model_router import ModelRouter
+from rate_limit import create_rate_limiter
+from reference_store import ReferenceStore, ReferenceTooLargeError
+from result_cache import ResultCache
+from scheduler import GenerationScheduler, QueueFullError
+from shared_cache import SharedCache
+from zip_stream import iter_zip
 
 # Load environment variables
 load_dotenv()
@@ -28,11 +45,83 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')  # Optional - for backward compatibility
 MAX_WORKERS = int(os.getenv('MAX_WORKERS', '3'))
 STATIC_FOLDER = 'static/generated'
+THUMBNAIL_FOLDER = os.path.join(STATIC_FOLDER, 'thumbs')
 DATA_FOLDER = 'data'
-HISTORY_FILE = os.path.join(DATA_FOLDER, 'jobs_history.json')
-MAX_HISTORY_JOBS = 50
+HISTORY_FILE = os.path.join(DATA_FOLDER, 'jobs_history.json')  # รูปแบบเดิม - ย้ายเข้า HISTORY_DB_PATH อัตโนมัติ
+HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', os.path.join(DATA_FOLDER, 'history.db'))
+MAX_HISTORY_JOBS = int(os.getenv('MAX_HISTORY_JOBS', '10000'))
+# /api/history แบ่งหน้า: จำนวน job ต่อหน้า (default / สูงสุด)
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', '500'))
 AUTO_CLEANUP_ENABLED = os.getenv('AUTO_CLEANUP_ENABLED', 'false').lower() == 'true'
 AUTO_CLEANUP_DAYS = int(os.getenv('AUTO_CLEANUP_DAYS', '7'))
+# Job store: 'sqlite' ให้ทุก gunicorn worker เห็น job เดียวกัน, 'memory' สำหรับ process เดียว
+JOB_STORE_BACKEND = os.getenv('JOB_STORE_BACKEND', 'sqlite')
+JOB_STORE_PATH = os.getenv('JOB_STORE_PATH', os.path.join(DATA_FOLDER, 'jobs.db'))
+# Scheduler: จำนวน job ที่รันพร้อมกัน, ขนาดคิวรอ และจำนวน API call พร้อมกันสูงสุด (ต่อ process)
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '50'))
+MAX_INFLIGHT_CALLS = int(os.getenv('MAX_INFLIGHT_CALLS', '6'))
+# Progress stream (SSE): ส่ง keepalive ทุก X วินาที และปิด stream หลัง Y วินาที (browser ต่อใหม่เองพร้อม Last-Event-ID)
+SSE_KEEPALIVE_SECONDS = int(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+SSE_MAX_STREAM_SECONDS = int(os.getenv('SSE_MAX_STREAM_SECONDS', '300'))
+JOB_FINISHED_STATUSES = ('completed', 'cancelled', 'error')
+# Adaptive concurrency (AIMD ต่อ API key + model): เริ่มที่ MAX_WORKERS แล้วปรับขึ้น/ลงตาม 429/503
+ADAPTIVE_CONCURRENCY = os.getenv('ADAPTIVE_CONCURRENCY', 'true').lower() == 'true'
+ADAPTIVE_MIN_CONCURRENCY = int(os.getenv('ADAPTIVE_MIN_CONCURRENCY', '1'))
+ADAPTIVE_MAX_CONCURRENCY = int(os.getenv('ADAPTIVE_MAX_CONCURRENCY', '16'))
+# Rate limit (token bucket ต่อ API key + model) - RPM ต่อ model, 0 = ไม่จำกัด
+# ใช้ backend เดียวกับ job store: sqlite = ทุก gunicorn worker แบ่ง quota ก้อนเดียวกัน
+RATE_LIMIT_PATH = os.getenv('RATE_LIMIT_PATH', os.path.join(DATA_FOLDER, 'rate_limits.db'))
+RATE_LIMIT_RPM = {
+    ImageGenerator.MODEL_NANO_BANANA: float(os.getenv('RATE_LIMIT_NANO_BANANA_RPM', '60')),
+    ImageGenerator.MODEL_NANO_BANANA_PRO: float(os.getenv('RATE_LIMIT_NANO_BANANA_PRO_RPM', '20')),
+    ImageGenerator.MODEL_ANALYZE: float(os.getenv('RATE_LIMIT_ANALYZE_RPM', '60')),
+}
+RATE_LIMIT_BURST = int(os.getenv('RATE_LIMIT_BURST', '3'))
+# Circuit breaker ต่อ API key + model: เปิดเมื่อสัดส่วน call ที่ fail ใน window เกิน threshold
+BREAKER_ENABLED = os.getenv('BREAKER_ENABLED', 'true').lower() == 'true'
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', '0.5'))
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '20'))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', '5'))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', '1'))
+# Model fallback (opt-in ต่อ job ด้วย 'model_fallback'): ส่ง prompt จาก Pro ไป Flash เมื่อ Pro ช้า/error เกิน threshold
+# หรือ circuit ของ Pro เปิดอยู่ - ใช้ได้เฉพาะ aspect ratio ที่ Flash รองรับ (1:1)
+MODEL_FALLBACK_DEFAULT = os.getenv('MODEL_FALLBACK_DEFAULT', 'false').lower() == 'true'
+FALLBACK_LATENCY_SECONDS = float(os.getenv('FALLBACK_LATENCY_SECONDS', '60'))
+FALLBACK_ERROR_RATE = float(os.getenv('FALLBACK_ERROR_RATE', '0.3'))
+FALLBACK_MIN_SAMPLES = int(os.getenv('FALLBACK_MIN_SAMPLES', '3'))
+FALLBACK_PROBE_SECONDS = float(os.getenv('FALLBACK_PROBE_SECONDS', '30'))
+# Output format ของไฟล์รูป (ค่า default - job เลือกเองได้ด้วย 'output_format' / 'quality')
+OUTPUT_FORMAT_DEFAULT = normalize_output_format(os.getenv('OUTPUT_FORMAT', 'png')) or 'png'
+if not is_format_supported(OUTPUT_FORMAT_DEFAULT):
+    print(f"[Config] OUTPUT_FORMAT={OUTPUT_FORMAT_DEFAULT} has no encoder in this Pillow build, using png")
+    OUTPUT_FORMAT_DEFAULT = 'png'
+OUTPUT_QUALITY_DEFAULT = int(os.getenv('OUTPUT_QUALITY', '85'))
+# Thumbnail WebP สำหรับ gallery / history (สร้างเบื้องหลังทันทีที่รูปเสร็จ)
+THUMBNAILS_ENABLED = os.getenv('THUMBNAILS_ENABLED', 'true').lower() == 'true'
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', '384'))
+THUMBNAIL_CACHE_SECONDS = 365 * 24 * 3600
+# Job archive: เติมรูปลง ZIP ของ job ทันทีที่เสร็จ - Download All ส่งไฟล์ที่พร้อมแล้วทันทีเมื่อ job จบ
+JOB_ARCHIVES_ENABLED = os.getenv('JOB_ARCHIVES_ENABLED', 'false').lower() == 'true'
+ARCHIVE_FOLDER = os.getenv('ARCHIVE_FOLDER', os.path.join(DATA_FOLDER, 'archives'))
+# Result cache: request ที่เหมือนกันทุกอย่าง (prompt เต็ม, model, aspect ratio, reference) ใช้รูปเดิมแทนการเรียก API
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', 'false').lower() == 'true'
+RESULT_CACHE_FOLDER = os.getenv('RESULT_CACHE_FOLDER', os.path.join(DATA_FOLDER, 'result_cache'))
+RESULT_CACHE_MAX_MB = int(os.getenv('RESULT_CACHE_MAX_MB', '2048'))
+# Cache ขนาดเล็กที่ทุก worker ใช้ร่วมกัน (เมื่อ JOB_STORE_BACKEND=sqlite) เช่นผลจำแนกประเภท reference image
+SHARED_CACHE_PATH = os.getenv('SHARED_CACHE_PATH', os.path.join(DATA_FOLDER, 'cache.db'))
+REFERENCE_TYPE_CACHE_TTL = int(os.getenv('REFERENCE_TYPE_CACHE_TTL', str(7 * 24 * 3600)))
+# Reference image ที่อัปโหลดครั้งเดียวผ่าน /api/references แล้วอ้างถึงด้วย reference_id
+REFERENCE_FOLDER = os.getenv('REFERENCE_FOLDER', os.path.join(DATA_FOLDER, 'references'))
+REFERENCE_MAX_MB = int(os.getenv('REFERENCE_MAX_MB', '10'))
+# ผลตรวจ API key (+ รายชื่อ model ของ key) - key ที่ใช้ไม่ได้ cache สั้นกว่า
+KEY_VALIDATION_TTL = int(os.getenv('KEY_VALIDATION_TTL', '300'))
+KEY_VALIDATION_NEGATIVE_TTL = int(os.getenv('KEY_VALIDATION_NEGATIVE_TTL', '60'))
+# salt ของ hash ของ API key ใน cache (ว่าง = สุ่มครั้งแรกแล้วเก็บใน KEY_CACHE_SALT_PATH)
+KEY_CACHE_SALT = os.getenv('KEY_CACHE_SALT', '')
+KEY_CACHE_SALT_PATH = os.getenv('KEY_CACHE_SALT_PATH', os.path.join(DATA_FOLDER, 'key_cache.salt'))
 
 # Note: ไม่ต้องเช็ค GOOGLE_API_KEY แล้ว เพราะแต่ละ user จะส่ง API key ของตัวเองมา
 # ImageGenerator จะถูกสร้างใหม่ทุกครั้งที่มี request
@@ -48,9 +137,122 @@ cleanup_state = {
 # สร้าง data folder ถ้ายังไม่มี
 os.makedirs(DATA_FOLDER, exist_ok=True)
 
-# In-memory storage สำหรับ job tracking
-jobs = {}
-jobs_lock = threading.Lock()
+# Job tracking storage (ใช้ร่วมกันทุก worker เมื่อเป็น SQLite backend)
+job_store = create_job_store(JOB_STORE_BACKEND, JOB_STORE_PATH)
+
+# ประวัติ job ที่จบแล้ว (SQLite ใช้ร่วมกันทุก worker)
+history_store = HistoryStore(HISTORY_DB_PATH, max_jobs=MAX_HISTORY_JOBS)
+history_store.import_json(HISTORY_FILE)
+
+# ZIP ต่อ job (ถ้าเปิด)
+job_archives = JobArchives(ARCHIVE_FOLDER) if JOB_ARCHIVES_ENABLED else None
+
+# Cache ผลลัพธ์ (ถ้าเปิด) - ใช้ร่วมกันทุก worker
+result_cache = (
+    ResultCache(RESULT_CACHE_FOLDER, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024) if RESULT_CACHE_ENABLED else None
+)
+
+# ผลจำแนกประเภท reference image ตาม digest ของรูป (อัปโหลดรูปเดิมซ้ำไม่ต้องเรียก API)
+shared_cache_path = SHARED_CACHE_PATH if JOB_STORE_BACKEND.lower() == 'sqlite' else None
+reference_type_cache = (
+    SharedCache(shared_cache_path, 'reference_type', REFERENCE_TYPE_CACHE_TTL) if REFERENCE_TYPE_CACHE_TTL > 0 else None
+)
+
+# Reference image ตาม digest (ทุก worker ใช้ folder เดียวกัน)
+reference_store = ReferenceStore(REFERENCE_FOLDER, max_bytes=REFERENCE_MAX_MB * 1024 * 1024)
+
+# ผลตรวจ API key ตาม hash ของ key (validate ซ้ำไม่ต้องเรียก list models ทุกครั้ง)
+key_validator = KeyValidator(
+    SharedCache(shared_cache_path, 'key_validation', max(KEY_VALIDATION_TTL, 0)),
+    KEY_CACHE_SALT.encode('utf-8') if KEY_CACHE_SALT else load_or_create_salt(KEY_CACHE_SALT_PATH),
+    client_pool=default_client_pool,
+    negative_ttl_seconds=max(KEY_VALIDATION_NEGATIVE_TTL, 0)
+)
+
+# Worker pool กลางสำหรับรัน generation jobs (แทนการเปิด thread ใหม่ทุก request)
+scheduler = GenerationScheduler(
+    num_workers=SCHEDULER_WORKERS,
+    max_queue=JOB_QUEUE_SIZE,
+    max_inflight_calls=MAX_INFLIGHT_CALLS
+)
+
+# Limiter ต่อ (API key, model) ใช้ร่วมกันทุก job ใน process
+# ขอบบนไม่เกิน MAX_INFLIGHT_CALLS - call จริงพร้อมกันไม่มีทางเกินนั้น limit ที่สูงกว่าจะโตจาก success ที่ไม่เคยใช้จริง
+concurrency_limiters = ConcurrencyLimiters(
+    initial=MAX_WORKERS,
+    min_limit=ADAPTIVE_MIN_CONCURRENCY,
+    max_limit=min(ADAPTIVE_MAX_CONCURRENCY, MAX_INFLIGHT_CALLS)
+) if ADAPTIVE_CONCURRENCY else None
+
+# Token bucket ต่อ (API key, model) ใช้ร่วมกันทุก job (และทุก process ถ้าเป็น sqlite)
+rate_limiter = create_rate_limiter(JOB_STORE_BACKEND, RATE_LIMIT_PATH, RATE_LIMIT_RPM, burst=RATE_LIMIT_BURST)
+
+# Circuit breaker ต่อ (API key, model) ใช้ร่วมกันทุก job ใน process
+circuit_breakers = CircuitBreakers(
+    failure_rate=BREAKER_FAILURE_RATE,
+    window_size=BREAKER_WINDOW,
+    min_calls=BREAKER_MIN_CALLS,
+    open_seconds=BREAKER_OPEN_SECONDS,
+    half_open_calls=BREAKER_HALF_OPEN_CALLS
+) if BREAKER_ENABLED else None
+
+# สุขภาพของแต่ละ (API key, model) + การเลือก model สำรอง
+model_router = ModelRouter(
+    fallbacks={ImageGenerator.MODEL_NANO_BANANA_PRO: ImageGenerator.MODEL_NANO_BANANA},
+    validate=validate_model_aspect_ratio,
+    circuit_breakers=circuit_breakers,
+    latency_threshold=FALLBACK_LATENCY_SECONDS,
+    error_rate_threshold=FALLBACK_ERROR_RATE,
+    min_samples=FALLBACK_MIN_SAMPLES,
+    probe_interval=FALLBACK_PROBE_SECONDS
+)
+
+# โหมด parallel: ถ้าเปิด adaptive ให้ limiter เป็นตัวกำหนดจำนวนพร้อมกัน (job เปิดได้ถึงเพดาน)
+PARALLEL_CONCURRENCY = ADAPTIVE_MAX_CONCURRENCY if ADAPTIVE_CONCURRENCY else MAX_WORKERS
+
+
+def build_image_generator(api_key: str, job: dict = None) -> ImageGenerator:
+    """ImageGenerator ของ user นี้ (ใช้ API key ของเขา) ผูกกับ gate / limiter กลางของ process และ option ของ job"""
+    job = job or {}
+    return ImageGenerator(
+        api_key=api_key,
+        output_dir=STATIC_FOLDER,
+        call_gate=scheduler.call_slot,
+        concurrency_limiters=concurrency_limiters,
+        rate_limiter=rate_limiter,
+        circuit_breakers=circuit_breakers,
+        model_router=model_router,
+        allow_model_fallback=job.get('model_fallback', False),
+        output_format=job.get('output_format', 'png'),
+        output_quality=job.get('output_quality', OUTPUT_QUALITY_DEFAULT),
+        thumbnail_dir=THUMBNAIL_FOLDER if THUMBNAILS_ENABLED else None,
+        thumbnail_size=THUMBNAIL_SIZE,
+        result_cache=result_cache,
+        reference_type_cache=reference_type_cache
+    )
+
+
+def thumbnail_url(filename: str) -> str:
+    return f"/api/thumbnails/{thumbnail_filename(filename)}"
+
+
+def parse_output_options(data: dict):
+    """
+    อ่าน output_format / quality จาก request
+    Returns: (output_format, quality, error message หรือ None)
+    """
+    output_format = normalize_output_format(data.get('output_format') or OUTPUT_FORMAT_DEFAULT)
+    if output_format is None:
+        return None, None, f"output_format must be one of: {', '.join(OUTPUT_FORMATS)}"
+    if not is_format_supported(output_format):
+        return None, None, f"output_format {output_format} is not supported by this server (Pillow has no {output_format.upper()} encoder)"
+    try:
+        quality = int(data.get('quality', OUTPUT_QUALITY_DEFAULT))
+    except (TypeError, ValueError):
+        return None, None, 'quality must be an integer (1-100)'
+    if not 1 <= quality <= 100:
+        return None, None, 'quality must be an integer (1-100)'
+    return output_format, quality, None
 
 
 def get_json_payload():
@@ -59,50 +261,97 @@ def get_json_payload():
     return data if isinstance(data, dict) else None
 
 
-def normalize_model_name(model: str) -> str:
-    """Accept model names with or without the models/ prefix."""
-    if model in ["gemini-2.5-flash-image", "gemini-3-pro-image-preview"]:
-        return f"models/{model}"
-    return model
+def parse_reference_payload(data):
+    """
+    อ่าน reference image จาก JSON: reference_id (อัปโหลดไว้แล้วผ่าน /api/references) หรือ reference_image (data URL)
+    Returns: (bytes ของรูป, mime type, error message หรือ None, HTTP status ของ error)
+    """
+    reference_id = (data.get('reference_id') or '').strip()
+    if reference_id:
+        try:
+            image_bytes, mime_type = reference_store.load(reference_id)
+        except ValueError as e:
+            return None, None, str(e), 400
+        except KeyError:
+            return None, None, 'Reference image not found (upload it again via /api/references)', 404
+        return image_bytes, mime_type, None, None
+
+    ref_data = data.get('reference_image', '')
+    if not ref_data or not ref_data.startswith('data:'):
+        return None, None, 'Reference image is required (reference_id or data:image/...;base64,...)', 400
+
+    parts = ref_data.split(',', 1)
+    if len(parts) != 2:
+        return None, None, 'Invalid base64 image data', 400
+
+    mime_part = parts[0]
+    mime_type = 'image/jpeg'
+    if 'png' in mime_part:
+        mime_type = 'image/png'
+    elif 'webp' in mime_part:
+        mime_type = 'image/webp'
+
+    try:
+        image_bytes = base64.b64decode(parts[1])
+    except Exception as e:
+        return None, None, f'Invalid base64: {str(e)}', 400
 
+    if len(image_bytes) > REFERENCE_MAX_MB * 1024 * 1024:
+        return None, None, f'Image too large (max {REFERENCE_MAX_MB}MB)', 400
+    return image_bytes, mime_type, None, None
 
-def validate_model_aspect_ratio(model: str, aspect_ratio: str):
-    """Non-Pro image model only supports the default square aspect ratio."""
-    if model != ImageGenerator.MODEL_NANO_BANANA_PRO and aspect_ratio != "1:1":
-        return "Aspect ratio other than 1:1 requires Nano Banana Pro"
-    return None
 
-# Job History Functions
-def load_history():
-    """โหลด job history จาก file"""
-    if os.path.exists(HISTORY_FILE):
+def parse_history_query(args):
+    """
+    อ่าน query ของ /api/history (cursor, limit, view, status, model, from, to, has_reference)
+    Returns: (page options, filters, error message หรือ None)
+    """
+    try:
+        cursor = int(args['cursor']) if args.get('cursor') else None
+        limit = int(args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        return None, None, 'cursor and limit must be integers'
+    if not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+        return None, None, f'limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}'
+    view = args.get('view', 'full')
+    if view not in ('full', 'summary'):
+        return None, None, "view must be 'full' or 'summary'"
+
+    filters = {
+        'status': args.get('status') or None,
+        'model': normalize_model_name(args['model']) if args.get('model') else None,
+    }
+    # from / to: วันที่ (YYYY-MM-DD รวมทั้งวัน) หรือ ISO datetime - เทียบกับ created_at (เวลา server)
+    for name, key in (('from', 'since'), ('to', 'until')):
+        value = args.get(name)
+        if not value:
+            continue
         try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error loading history: {e}")
-            return []
-    return []
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return None, None, f'{name} must be an ISO date (YYYY-MM-DD) or datetime'
+        if name == 'to' and len(value) == 10:
+            parsed += timedelta(days=1)
+        filters[key] = parsed.isoformat()
+    has_reference = args.get('has_reference')
+    if has_reference:
+        if has_reference.lower() not in ('true', 'false', '1', '0'):
+            return None, None, 'has_reference must be true or false'
+        filters['has_reference'] = has_reference.lower() in ('true', '1')
+    return {'cursor': cursor, 'limit': limit, 'summary': view == 'summary'}, filters, None
 
 
-def save_history(history):
-    """บันทึก job history ลง file"""
-    try:
-        # จำกัดไม่เกิน MAX_HISTORY_JOBS
-        if len(history) > MAX_HISTORY_JOBS:
-            history = history[:MAX_HISTORY_JOBS]
-        
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Error saving history: {e}")
+def normalize_model_name(model: str) -> str:
+    """Accept model names with or without the models/ prefix."""
+    if model in ["gemini-2.5-flash-image", "gemini-3-pro-image-preview"]:
+        return f"models/{model}"
+    return model
 
 
+# Job History Functions
 def add_to_history(job):
     """เพิ่ม job เข้า history"""
     try:
-        history = load_history()
-        
         # สร้าง history entry (เก็บเฉพาะข้อมูลที่จำเป็น)
         completed_results = [r for r in job.get('results', []) if r.get('status') == 'completed' and r.get('filename')]
         history_entry = {
@@ -124,19 +373,24 @@ def add_to_history(job):
             'has_reference': job.get('has_reference', False),
             'reference_type': job.get('reference_type', ''),
             'character_consistency': job.get('character_consistency', False),
-            'results': [{'filename': r['filename'], 'prompt': r.get('prompt', '')} for r in completed_results]
+            'model_fallback': job.get('model_fallback', False),
+            'variations': job.get('variations', False),
+            'output_format': job.get('output_format', 'png'),
+            'output_quality': job.get('output_quality', OUTPUT_QUALITY_DEFAULT),
+            'results': [
+                {'filename': r['filename'], 'prompt': r.get('prompt', ''), 'model': r.get('model', job['model']),
+                 'thumbnail_url': r.get('thumbnail_url')}
+                for r in completed_results
+            ]
         }
         
-        # เพิ่มเข้าด้านหน้า (ใหม่สุด)
-        history.insert(0, history_entry)
-        
-        # บันทึก
-        save_history(history)
+        # เพิ่มเป็นรายการใหม่สุด (เกิน MAX_HISTORY_JOBS ตัดรายการเก่าสุดทิ้ง)
+        history_store.add(history_entry)
     except Exception as e:
         print(f"Error adding to history: {e}")
 
 
-def create_job(prompts: list, model: str, mode: str, master_prompts: str = "", suffix: str = "", negative_prompts: str = "", aspect_ratio: str = "1:1", has_reference: bool = False, reference_type: str = "", character_consistency: bool = False) -> str:
+def create_job(prompts: list, model: str, mode: str, master_prompts: str = "", suffix: str = "", negative_prompts: str = "", aspect_ratio: str = "1:1", has_reference: bool = False, reference_type: str = "", character_consistency: bool = False, model_fallback: bool = False, output_format: str = "png", output_quality: int = OUTPUT_QUALITY_DEFAULT, variations: bool = False) -> str:
     """สร้าง job ใหม่และ return job_id"""
     job_id = str(uuid.uuid4())
 
@@ -150,6 +404,8 @@ def create_job(prompts: list, model: str, mode: str, master_prompts: str = "", s
         'suffix': suffix,
         'negative_prompts': negative_prompts,
         'aspect_ratio': aspect_ratio,
+        'output_format': output_format,
+        'output_quality': output_quality,
         'total': len(prompts),
         'completed': 0,
         'failed': 0,
@@ -164,45 +420,171 @@ def create_job(prompts: list, model: str, mode: str, master_prompts: str = "", s
         job_data['reference_type'] = reference_type
     if character_consistency:
         job_data['character_consistency'] = True
+    if model_fallback:
+        job_data['model_fallback'] = True
+    if variations:
+        job_data['variations'] = True
 
-    with jobs_lock:
-        jobs[job_id] = job_data
+    job_store.create(job_data)
 
     return job_id
 
 
 def update_job_progress(job_id: str, current: int, total: int, result: dict):
     """Update job progress (callback function)"""
-    with jobs_lock:
-        if job_id in jobs:
-            job = jobs[job_id]
-            job['completed'] = current
-            job['results'].append(result)
-            
-            if result['status'] == 'failed':
-                job['failed'] += 1
-            
-            # Check if finished
-            if current >= total:
-                job['status'] = 'completed'
-                job['finished_at'] = datetime.now().isoformat()
+    if result.get('thumbnail'):
+        result = dict(result, thumbnail_url=thumbnail_url(result['filename']))
+    job_store.append_result(job_id, current, total, result)
+    if job_archives is not None and result.get('status') == 'completed' and result.get('filename'):
+        try:
+            job_archives.add(job_id, result['filename'], os.path.join(STATIC_FOLDER, result['filename']))
+        except Exception as e:
+            print(f"[Job {job_id[:8]}] Failed to add image to archive: {e}")
+
+
+def job_manifest(job: dict):
+    """
+    manifest.json ของ Download All + รายการไฟล์ที่ยังอยู่บน disk
+    ใช้ได้ทั้ง job จาก job store และ entry ใน history (ซึ่งเก็บเฉพาะรูปที่สำเร็จ)
+    Returns: (manifest dict, [(ชื่อใน ZIP, path)])
+    """
+    manifest = {
+        'job_id': job['id'],
+        'created_at': job.get('created_at'),
+        'finished_at': job.get('finished_at'),
+        'model': job.get('model'),
+        'mode': job.get('mode'),
+        'aspect_ratio': job.get('aspect_ratio', '1:1'),
+        'master_prompts': job.get('master_prompts', ''),
+        'suffix': job.get('suffix', ''),
+        'negative_prompts': job.get('negative_prompts', ''),
+        'images': []
+    }
+    files = []
+    for i, result in enumerate(job.get('results', [])):
+        if result.get('status', 'completed') == 'completed' and result.get('filename'):
+            filepath = os.path.join(STATIC_FOLDER, result['filename'])
+            if os.path.exists(filepath):
+                files.append((result['filename'], filepath))
+                manifest['images'].append({
+                    'index': i + 1,
+                    'filename': result['filename'],
+                    'prompt': result.get('prompt', ''),
+                    'timestamp': result.get('timestamp', '')
+                })
+    return manifest, files
+
+
+def finalize_job_archive(job: dict):
+    """ปิด archive ของ job ที่จบแล้ว (เขียน manifest) - Download All ส่งไฟล์นี้ได้ทันที"""
+    if job_archives is None:
+        return
+    try:
+        job_archives.finalize(job['id'], job_manifest(job)[0])
+    except Exception as e:
+        print(f"[Job {job['id'][:8]}] Failed to finalize archive: {e}")
+
+
+def cancel_check_for(job_id: str):
+    """Return cancel_check callable ที่อ่าน flag จาก job store (เห็นการกดหยุดจากทุก worker)"""
+    def cancel_check():
+        return job_store.is_cancel_requested(job_id)
+    return cancel_check
+
+
+def mark_job_started(job_id: str):
+    """ตั้งสถานะ processing และ return job (หรือ None ถ้าไม่เจอ)"""
+    def start(job):
+        job['status'] = 'processing'
+        job['started_at'] = datetime.now().isoformat()
+        return job
+    return job_store.mutate(job_id, start)
+
+
+def finalize_job(job_id: str):
+    """ปิด job หลัง generate จบ: เติมผล cancelled ถ้าถูกยกเลิก แล้วบันทึกลง history"""
+    def finish(job):
+        if job.get('cancel_requested'):
+            job['status'] = 'cancelled'
+            # เติมผลลัพธ์ที่ยังไม่มีเป็น cancelled เพื่อให้ UI แสดงครบ
+            prompts = job['prompts']
+            master_prompts = job.get('master_prompts', job.get('prefix', ''))
+            suffix = job.get('suffix', '')
+            negative_prompts = job.get('negative_prompts', '')
+            for i in range(len(job['results']), len(prompts)):
+                full_prompt = f"{master_prompts}{prompts[i]}{suffix}"
+                if negative_prompts:
+                    full_prompt += f", avoid: {negative_prompts}"
+                full_prompt = full_prompt.strip()
+                job['results'].append({
+                    'status': 'cancelled',
+                    'prompt': full_prompt,
+                    'filename': None,
+                    'error': 'Cancelled',
+                    'model': job.get('model', ''),
+                    'timestamp': datetime.now().isoformat()
+                })
+            job['completed'] = len(prompts)
+        else:
+            job['status'] = 'completed'
+        job['finished_at'] = datetime.now().isoformat()
+        return job
+
+    job = job_store.mutate(job_id, finish)
+    if job is not None:
+        finalize_job_archive(job)
+        # เพิ่มเข้า history
+        add_to_history(job)
+
+
+def fail_job(job_id: str, error: str):
+    """Mark job เป็น error"""
+    def fail(job):
+        job['status'] = 'error'
+        job['error'] = error
+        job['finished_at'] = datetime.now().isoformat()
+        return job
+
+    job = job_store.mutate(job_id, fail)
+    if job is not None:
+        finalize_job_archive(job)
+
+
+def enqueue_job(job_id: str, target, *args):
+    """
+    ส่ง job เข้าคิวของ scheduler
+    Returns: (queue_position, None) หรือ (None, 429 response) ถ้าคิวเต็ม
+    """
+    try:
+        return scheduler.submit(job_id, target, *args), None
+    except QueueFullError as e:
+        # ไม่รับ job นี้ - ลบออกจาก store เพื่อไม่ให้ค้างเป็น pending
+        job_store.delete(job_id)
+        response = jsonify({
+            'success': False,
+            'error': 'Server is busy: generation queue is full. Please try again shortly.',
+            'queue_position': e.queued + 1,
+            'queue_capacity': e.capacity
+        })
+        response.headers['Retry-After'] = '30'
+        return None, (response, 429)
 
 
 def process_generation(job_id: str, api_key: str):
     """Background task สำหรับ generate images"""
     print(f"[Job {job_id[:8]}] Starting generation...")
-    with jobs_lock:
-        if job_id not in jobs:
-            print(f"[Job {job_id[:8]}] Error: Job not found")
-            return
-        
-        job = jobs[job_id]
-        job['status'] = 'processing'
-        job['started_at'] = datetime.now().isoformat()
+    job = mark_job_started(job_id)
+    if job is None:
+        print(f"[Job {job_id[:8]}] Error: Job not found")
+        return
+    if job.get('cancel_requested'):
+        # ถูกยกเลิกระหว่างรอคิว
+        finalize_job(job_id)
+        return
     
     try:
         # สร้าง ImageGenerator instance ใหม่สำหรับ user นี้ (ใช้ API key ของเขา)
-        image_generator = ImageGenerator(api_key=api_key, output_dir=STATIC_FOLDER)
+        image_generator = build_image_generator(api_key, job)
         
         # Get job details
         prompts = job['prompts']
@@ -214,9 +596,7 @@ def process_generation(job_id: str, api_key: str):
         aspect_ratio = job.get('aspect_ratio', '1:1')
         
         # Cancel check: ตรวจสอบว่าผู้ใช้กดหยุดหรือไม่
-        def cancel_check():
-            with jobs_lock:
-                return jobs.get(job_id, {}).get('cancel_requested', False)
+        cancel_check = cancel_check_for(job_id)
         
         # Progress callback
         def progress_callback(current, total, result):
@@ -238,15 +618,14 @@ def process_generation(job_id: str, api_key: str):
                 full_prompt_1 += f", avoid: {negative_prompts}"
             full_prompt_1 = full_prompt_1.strip()
 
-            executor = ThreadPoolExecutor(max_workers=1)
-            future = executor.submit(image_generator.generate_single, prompt=full_prompt_1, model=model, filename_prefix="batch_1", aspect_ratio=aspect_ratio)
-            result1 = None
-            try:
-                result1 = future.result(timeout=timeout_per_image)
-            except FuturesTimeoutError:
-                result1 = {'status': 'failed', 'prompt': full_prompt_1, 'filename': None, 'error': f'Timeout after {timeout_per_image}s', 'model': model, 'timestamp': datetime.now().isoformat()}
-            finally:
-                executor.shutdown(wait=False)
+            result1 = image_generator.generate_single(
+                prompt=full_prompt_1,
+                model=model,
+                filename_prefix="batch_1",
+                aspect_ratio=aspect_ratio,
+                timeout_seconds=timeout_per_image,
+                job_id=job_id
+            )
 
             progress_callback(1, len(prompts), result1)
 
@@ -275,14 +654,16 @@ def process_generation(job_id: str, api_key: str):
                         result = image_generator.generate_single_with_reference(
                             prompt=prompts[idx],
                             reference_image_bytes=ref_bytes,
-                            mime_type='image/png',
+                            mime_type=OUTPUT_FORMATS[image_generator.output_format][2],
                             reference_type='person',
                             model=model,
                             filename_prefix=f"batch_{idx + 1}",
                             aspect_ratio=aspect_ratio,
                             master_prompts=master_prompts,
                             suffix=suffix,
-                            negative_prompts=negative_prompts
+                            negative_prompts=negative_prompts,
+                            timeout_seconds=timeout_per_image,
+                            job_id=job_id
                         )
                         progress_callback(idx + 1, len(prompts), result)
             else:
@@ -306,79 +687,49 @@ def process_generation(job_id: str, api_key: str):
                 negative_prompts=negative_prompts,
                 aspect_ratio=aspect_ratio,
                 cancel_check=cancel_check,
-                timeout_seconds=timeout_per_image
+                timeout_seconds=timeout_per_image,
+                job_id=job_id,
+                variations=job.get('variations', False)
             )
         else:  # parallel
             image_generator.generate_batch_parallel(
                 prompts=prompts,
                 model=model,
-                max_workers=MAX_WORKERS,
+                max_workers=PARALLEL_CONCURRENCY,
                 progress_callback=progress_callback,
                 master_prompts=master_prompts,
                 suffix=suffix,
                 negative_prompts=negative_prompts,
                 aspect_ratio=aspect_ratio,
                 cancel_check=cancel_check,
-                timeout_seconds=timeout_per_image
+                timeout_seconds=timeout_per_image,
+                job_id=job_id,
+                variations=job.get('variations', False)
             )
         
-        # Update final status (ถ้าถูกยกเลิกจะตั้งในบล็อกด้านล่าง)
-        with jobs_lock:
-            if job_id in jobs:
-                job = jobs[job_id]
-                if job.get('cancel_requested'):
-                    job['status'] = 'cancelled'
-                    # เติมผลลัพธ์ที่ยังไม่มีเป็น cancelled เพื่อให้ UI แสดงครบ
-                    prompts = job['prompts']
-                    master_prompts = job.get('master_prompts', job.get('prefix', ''))
-                    suffix = job.get('suffix', '')
-                    negative_prompts = job.get('negative_prompts', '')
-                    for i in range(len(job['results']), len(prompts)):
-                        full_prompt = f"{master_prompts}{prompts[i]}{suffix}"
-                        if negative_prompts:
-                            full_prompt += f", avoid: {negative_prompts}"
-                        full_prompt = full_prompt.strip()
-                        job['results'].append({
-                            'status': 'cancelled',
-                            'prompt': full_prompt,
-                            'filename': None,
-                            'error': 'Cancelled',
-                            'model': job.get('model', ''),
-                            'timestamp': datetime.now().isoformat()
-                        })
-                    job['completed'] = len(prompts)
-                else:
-                    job['status'] = 'completed'
-                job['finished_at'] = datetime.now().isoformat()
-                
-                # เพิ่มเข้า history
-                add_to_history(job)
+        # Update final status (ถ้าถูกยกเลิกจะเติมผล cancelled ให้ครบ)
+        finalize_job(job_id)
     
     except Exception as e:
         print(f"[Job {job_id[:8]}] CRITICAL ERROR: {str(e)}")
         import traceback
         print(traceback.format_exc())
-        with jobs_lock:
-            if job_id in jobs:
-                jobs[job_id]['status'] = 'error'
-                jobs[job_id]['error'] = str(e)
-                jobs[job_id]['finished_at'] = datetime.now().isoformat()
+        fail_job(job_id, str(e))
 
 
 def process_generation_with_reference(job_id: str, api_key: str, reference_image_bytes: bytes, mime_type: str = "image/jpeg"):
     """Background task สำหรับ generate images ด้วย reference image"""
     print(f"[Job {job_id[:8]}] Starting generation with reference...")
-    with jobs_lock:
-        if job_id not in jobs:
-            print(f"[Job {job_id[:8]}] Error: Job not found")
-            return
-
-        job = jobs[job_id]
-        job['status'] = 'processing'
-        job['started_at'] = datetime.now().isoformat()
+    job = mark_job_started(job_id)
+    if job is None:
+        print(f"[Job {job_id[:8]}] Error: Job not found")
+        return
+    if job.get('cancel_requested'):
+        finalize_job(job_id)
+        return
 
     try:
-        image_generator = ImageGenerator(api_key=api_key, output_dir=STATIC_FOLDER)
+        image_generator = build_image_generator(api_key, job)
         prompts = job['prompts']
         model = job['model']
         mode = job['mode']
@@ -388,9 +739,7 @@ def process_generation_with_reference(job_id: str, api_key: str, reference_image
         aspect_ratio = job.get('aspect_ratio', '1:1')
         reference_type = job.get('reference_type', '')
 
-        def cancel_check():
-            with jobs_lock:
-                return jobs.get(job_id, {}).get('cancel_requested', False)
+        cancel_check = cancel_check_for(job_id)
 
         def progress_callback(current, total, result):
             if result.get('status') == 'failed':
@@ -414,7 +763,9 @@ def process_generation_with_reference(job_id: str, api_key: str, reference_image
                 negative_prompts=negative_prompts,
                 aspect_ratio=aspect_ratio,
                 cancel_check=cancel_check,
-                timeout_seconds=timeout_per_image
+                timeout_seconds=timeout_per_image,
+                job_id=job_id,
+                variations=job.get('variations', False)
             )
         else:
             image_generator.generate_batch_with_reference_parallel(
@@ -423,48 +774,25 @@ def process_generation_with_reference(job_id: str, api_key: str, reference_image
                 mime_type=mime_type,
                 reference_type=reference_type,
                 model=model,
-                max_workers=MAX_WORKERS,
+                max_workers=PARALLEL_CONCURRENCY,
                 progress_callback=progress_callback,
                 master_prompts=master_prompts,
                 suffix=suffix,
                 negative_prompts=negative_prompts,
                 aspect_ratio=aspect_ratio,
                 cancel_check=cancel_check,
-                timeout_seconds=timeout_per_image
+                timeout_seconds=timeout_per_image,
+                job_id=job_id,
+                variations=job.get('variations', False)
             )
 
-        with jobs_lock:
-            if job_id in jobs:
-                job = jobs[job_id]
-                if job.get('cancel_requested'):
-                    job['status'] = 'cancelled'
-                    for i in range(len(job['results']), len(prompts)):
-                        full_prompt = f"{master_prompts}{prompts[i]}{suffix}"
-                        if negative_prompts:
-                            full_prompt += f", avoid: {negative_prompts}"
-                        job['results'].append({
-                            'status': 'cancelled',
-                            'prompt': full_prompt.strip(),
-                            'filename': None,
-                            'error': 'Cancelled',
-                            'model': job.get('model', ''),
-                            'timestamp': datetime.now().isoformat()
-                        })
-                    job['completed'] = len(prompts)
-                else:
-                    job['status'] = 'completed'
-                job['finished_at'] = datetime.now().isoformat()
-                add_to_history(job)
+        finalize_job(job_id)
 
     except Exception as e:
         print(f"[Job {job_id[:8]}] CRITICAL ERROR: {str(e)}")
         import traceback
         print(traceback.format_exc())
-        with jobs_lock:
-            if job_id in jobs:
-                jobs[job_id]['status'] = 'error'
-                jobs[job_id]['error'] = str(e)
-                jobs[job_id]['finished_at'] = datetime.now().isoformat()
+        fail_job(job_id, str(e))
 
 
 # ===== Routes =====
@@ -472,14 +800,33 @@ def process_generation_with_reference(job_id: str, api_key: str, reference_image
 @app.route('/')
 def index():
     """หน้าหลัก"""
-    return render_template('index.html')
+    return render_template('index.html', output_format_default=OUTPUT_FORMAT_DEFAULT)
+
+
+@app.route('/api/references', methods=['POST'])
+def upload_reference():
+    """
+    อัปโหลด reference image ครั้งเดียว (multipart/form-data, field "file") แล้วใช้ reference_id แทน base64
+    ใน /api/generate-with-reference และ /api/analyze-reference-type - รูปเดิมได้ id เดิม
+    Response: { "success": true, "reference_id": "...", "mime_type": "image/png", "size": 12345, "deduplicated": false }
+    """
+    file = request.files.get('file')
+    if file is None:
+        return jsonify({'success': False, 'error': 'Multipart field "file" is required'}), 400
+    try:
+        saved = reference_store.save(file.stream)
+    except ReferenceTooLargeError as e:
+        return jsonify({'success': False, 'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({'success': True, **saved})
 
 
 @app.route('/api/analyze-reference-type', methods=['POST'])
 def analyze_reference_type():
     """
     Analyze uploaded image and return reference type (person/animal/object).
-    Request JSON: { "api_key": "...", "reference_image": "data:image/png;base64,..." }
+    Request JSON: { "api_key": "...", "reference_id": "..." } หรือ { "api_key": "...", "reference_image": "data:image/png;base64,..." }
     Response: { "success": true, "type": "person" | "animal" | "object" }
     """
     try:
@@ -490,33 +837,11 @@ def analyze_reference_type():
         if not api_key:
             return jsonify({'success': False, 'error': 'API key is required'}), 400
 
-        ref_data = data.get('reference_image', '')
-        if not ref_data or not ref_data.startswith('data:'):
-            return jsonify({'success': False, 'error': 'Invalid reference image (expect data:image/...;base64,...)'}), 400
-
-        parts = ref_data.split(',', 1)
-        if len(parts) != 2:
-            return jsonify({'success': False, 'error': 'Invalid base64 image data'}), 400
-
-        mime_part = parts[0]
-        if 'image/' in mime_part:
-            mime_type = 'image/jpeg'
-            if 'png' in mime_part:
-                mime_type = 'image/png'
-            elif 'webp' in mime_part:
-                mime_type = 'image/webp'
-        else:
-            mime_type = 'image/jpeg'
-
-        try:
-            image_bytes = base64.b64decode(parts[1])
-        except Exception as e:
-            return jsonify({'success': False, 'error': f'Invalid base64: {str(e)}'}), 400
-
-        if len(image_bytes) > 10 * 1024 * 1024:
-            return jsonify({'success': False, 'error': 'Image too large (max 10MB)'}), 400
+        image_bytes, mime_type, ref_error, ref_status = parse_reference_payload(data)
+        if ref_error:
+            return jsonify({'success': False, 'error': ref_error}), ref_status
 
-        generator = ImageGenerator(api_key=api_key, output_dir=STATIC_FOLDER)
+        generator = build_image_generator(api_key)
         ref_type = generator.analyze_reference_type(image_bytes, mime_type)
 
         return jsonify({'success': True, 'type': ref_type})
@@ -538,7 +863,8 @@ def validate_key():
     Response:
     {
         "valid": true/false,
-        "error": "..." (if invalid)
+        "error": "..." (if invalid),
+        "cached": true/false (ผลจาก cache หรือไม่)
     }
     """
     try:
@@ -553,26 +879,19 @@ def validate_key():
                 'error': 'API key is required'
             }), 400
         
-        # ทดสอบ API key โดยลองสร้าง ImageGenerator และเรียก list models
-        try:
-            import google.generativeai as genai
-            genai.configure(api_key=api_key)
-            list(genai.list_models())  # validate API key by calling API
+        # ทดสอบ API key โดยเรียก list models ด้วย client ของ key นี้ (ผ่าน cache ตาม hash ของ key)
+        outcome = key_validator.validate(api_key)
+        if outcome['valid']:
             return jsonify({
                 'valid': True,
-                'message': 'API key is valid'
+                'message': 'API key is valid',
+                'cached': outcome['cached']
             })
-        except Exception as e:
-            error_msg = str(e)
-            # แปลง error message ให้เข้าใจง่าย
-            if 'API_KEY_INVALID' in error_msg or 'invalid' in error_msg.lower():
-                error_msg = 'API key ไม่ถูกต้อง'
-            elif 'permission' in error_msg.lower():
-                error_msg = 'API key ไม่มีสิทธิ์เข้าถึง Gemini API'
-            return jsonify({
-                'valid': False,
-                'error': error_msg
-            }), 400
+        return jsonify({
+            'valid': False,
+            'error': outcome['error'],
+            'cached': outcome['cached']
+        }), 503 if outcome.get('transient') else 400
     
     except Exception as e:
         return jsonify({
@@ -581,6 +900,42 @@ def validate_key():
         }), 500
 
 
+@app.route('/api/models', methods=['POST'])
+def list_models():
+    """
+    รายชื่อ model ที่ API key นี้ใช้ได้ (ใช้ผลเดียวกับ /api/validate-key จาก cache)
+    
+    Request JSON:
+    {
+        "api_key": "..."
+    }
+    
+    Response:
+    {
+        "success": true,
+        "models": [{"name", "display_name", "description", "supported_generation_methods", ...}, ...],
+        "image_models": ["models/...", ...],
+        "cached": true/false
+    }
+    """
+    data = get_json_payload()
+    if not data:
+        return jsonify({'success': False, 'error': 'JSON body is required'}), 400
+    api_key = data.get('api_key', '').strip()
+    if not api_key:
+        return jsonify({'success': False, 'error': 'API key is required'}), 400
+
+    outcome = key_validator.validate(api_key)
+    if not outcome['valid']:
+        return jsonify({'success': False, 'error': outcome['error']}), 503 if outcome.get('transient') else 400
+    return jsonify({
+        'success': True,
+        'models': outcome['models'],
+        'image_models': [m['name'] for m in outcome['models'] if is_image_model(m)],
+        'cached': outcome['cached']
+    })
+
+
 @app.route('/api/generate', methods=['POST'])
 def generate():
     """
@@ -655,6 +1010,12 @@ def generate():
         suffix = data.get('suffix', '')
         negative_prompts = data.get('negative_prompts', '')
         aspect_ratio = data.get('aspect_ratio', '1:1')
+        model_fallback = bool(data.get('model_fallback', MODEL_FALLBACK_DEFAULT))
+        # variations: prompt ซ้ำกันตั้งใจให้ได้รูปคนละแบบ (ไม่งั้น prompt ซ้ำ generate ครั้งเดียวแล้วใช้ผลร่วมกัน)
+        variations = bool(data.get('variations', False))
+        output_format, quality, output_error = parse_output_options(data)
+        if output_error:
+            return jsonify({'success': False, 'error': output_error}), 400
 
         # Character consistency requires sequential mode
         if character_consistency:
@@ -683,18 +1044,21 @@ def generate():
             mode = 'sequential'
         
         # Create job
-        job_id = create_job(prompts, model, mode, master_prompts, suffix, negative_prompts, aspect_ratio, character_consistency=character_consistency)
+        job_id = create_job(prompts, model, mode, master_prompts, suffix, negative_prompts, aspect_ratio,
+                            character_consistency=character_consistency, model_fallback=model_fallback,
+                            output_format=output_format, output_quality=quality, variations=variations)
         
-        # Start background processing (ส่ง api_key เข้าไปด้วย)
-        thread = threading.Thread(target=process_generation, args=(job_id, api_key))
-        thread.daemon = True
-        thread.start()
+        # ส่งเข้าคิวของ scheduler (ส่ง api_key เข้าไปด้วย)
+        queue_position, error_response = enqueue_job(job_id, process_generation, job_id, api_key)
+        if error_response:
+            return error_response
         
         return jsonify({
             'success': True,
             'job_id': job_id,
             'message': f'Started generating {len(prompts)} images',
-            'total': len(prompts)
+            'total': len(prompts),
+            'queue_position': queue_position
         })
     
     except Exception as e:
@@ -708,7 +1072,8 @@ def generate():
 def generate_with_reference():
     """
     API endpoint สำหรับ generate images ด้วย reference image
-    Request JSON: api_key, reference_image (data:image/...;base64,...), reference_type (person|animal|object),
+    Request JSON: api_key, reference_id (จาก /api/references) หรือ reference_image (data:image/...;base64,...),
+                 reference_type (person|animal|object),
                  prompts, model, mode, master_prompts, suffix, negative_prompts, aspect_ratio
     """
     try:
@@ -719,11 +1084,7 @@ def generate_with_reference():
         if not api_key:
             return jsonify({'success': False, 'error': 'API key is required'}), 400
 
-        ref_data = data.get('reference_image', '')
-        if not ref_data or not ref_data.startswith('data:'):
-            return jsonify({'success': False, 'error': 'Reference image is required (data:image/...;base64,...)'}), 400
-
-        if not data or 'prompts' not in data:
+        if 'prompts' not in data:
             return jsonify({'success': False, 'error': 'Missing prompts in request'}), 400
 
         prompts_raw = data['prompts']
@@ -737,24 +1098,9 @@ def generate_with_reference():
         if not prompts:
             return jsonify({'success': False, 'error': 'No valid prompts provided'}), 400
 
-        parts = ref_data.split(',', 1)
-        if len(parts) != 2:
-            return jsonify({'success': False, 'error': 'Invalid base64 image data'}), 400
-
-        mime_part = parts[0]
-        mime_type = 'image/jpeg'
-        if 'png' in mime_part:
-            mime_type = 'image/png'
-        elif 'webp' in mime_part:
-            mime_type = 'image/webp'
-
-        try:
-            reference_image_bytes = base64.b64decode(parts[1])
-        except Exception as e:
-            return jsonify({'success': False, 'error': f'Invalid base64: {str(e)}'}), 400
-
-        if len(reference_image_bytes) > 10 * 1024 * 1024:
-            return jsonify({'success': False, 'error': 'Image too large (max 10MB)'}), 400
+        reference_image_bytes, mime_type, ref_error, ref_status = parse_reference_payload(data)
+        if ref_error:
+            return jsonify({'success': False, 'error': ref_error}), ref_status
 
         model = data.get('model', ImageGenerator.MODEL_NANO_BANANA)
         mode = data.get('mode', 'sequential')
@@ -765,6 +1111,12 @@ def generate_with_reference():
         reference_type = (data.get('reference_type', '') or '').strip().lower()
         if reference_type not in ('person', 'animal', 'object'):
             reference_type = ''
+        model_fallback = bool(data.get('model_fallback', MODEL_FALLBACK_DEFAULT))
+        # variations: prompt ซ้ำกันตั้งใจให้ได้รูปคนละแบบ (ไม่งั้น prompt ซ้ำ generate ครั้งเดียวแล้วใช้ผลร่วมกัน)
+        variations = bool(data.get('variations', False))
+        output_format, quality, output_error = parse_output_options(data)
+        if output_error:
+            return jsonify({'success': False, 'error': output_error}), 400
 
         model = normalize_model_name(model)
         valid_models = [ImageGenerator.MODEL_NANO_BANANA, ImageGenerator.MODEL_NANO_BANANA_PRO,
@@ -778,20 +1130,21 @@ def generate_with_reference():
             mode = 'sequential'
 
         job_id = create_job(prompts, model, mode, master_prompts, suffix, negative_prompts, aspect_ratio,
-                            has_reference=True, reference_type=reference_type)
+                            has_reference=True, reference_type=reference_type, model_fallback=model_fallback,
+                            output_format=output_format, output_quality=quality, variations=variations)
 
-        thread = threading.Thread(
-            target=process_generation_with_reference,
-            args=(job_id, api_key, reference_image_bytes, mime_type)
+        queue_position, error_response = enqueue_job(
+            job_id, process_generation_with_reference, job_id, api_key, reference_image_bytes, mime_type
         )
-        thread.daemon = True
-        thread.start()
+        if error_response:
+            return error_response
 
         return jsonify({
             'success': True,
             'job_id': job_id,
             'message': f'Started generating {len(prompts)} images with reference',
-            'total': len(prompts)
+            'total': len(prompts),
+            'queue_position': queue_position
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -805,19 +1158,32 @@ def cancel_job(job_id):
     Response:
     { "success": true, "message": "..." }
     """
-    with jobs_lock:
-        if job_id not in jobs:
-            return jsonify({
-                'success': False,
-                'error': 'Job not found'
-            }), 404
-        job = jobs[job_id]
-        if job['status'] != 'processing':
-            return jsonify({
-                'success': True,
-                'message': 'Job is not running (already completed or cancelled)'
-            })
+    def request_cancel(job):
+        if job['status'] not in ('pending', 'processing'):
+            return 'not_running'
         job['cancel_requested'] = True
+        return job['status']
+
+    outcome = job_store.mutate(job_id, request_cancel)
+    if outcome is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+    if outcome == 'not_running':
+        return jsonify({
+            'success': True,
+            'message': 'Job is not running (already completed or cancelled)'
+        })
+    # abort call ที่กำลังวิ่งอยู่ใน process นี้ทันที (process อื่นจะเห็น flag ใน job store รอบ poll ถัดไป)
+    inflight_calls.cancel(job_id)
+    if outcome == 'pending' and scheduler.discard(job_id):
+        # ยังรออยู่ในคิวของ process นี้ - ปิด job ได้ทันที
+        finalize_job(job_id)
+        return jsonify({
+            'success': True,
+            'message': 'Job cancelled before it started.'
+        })
     
     return jsonify({
         'success': True,
@@ -830,32 +1196,113 @@ def get_status(job_id):
     """
     API endpoint สำหรับตรวจสอบสถานะของ job
     
+    Query:
+        since: (optional) โหมด delta - ส่งเฉพาะ results ตั้งแต่ index นี้ ไม่มี prompts
+               พร้อม 'results_since' / 'version' และ ETag (ส่ง If-None-Match กลับมา ถ้าไม่มีอะไรเปลี่ยนตอบ 304)
+    
     Response:
     {
         "success": true,
         "job": { ... }
     }
     """
-    with jobs_lock:
-        if job_id not in jobs:
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = max(0, int(since))
+        except ValueError:
             return jsonify({
                 'success': False,
-                'error': 'Job not found'
-            }), 404
-        
-        job = jobs[job_id].copy()
+                'error': 'since must be an integer'
+            }), 400
+        job = job_store.get_since(job_id, since)
+    else:
+        job = job_store.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+    if job['status'] == 'pending':
+        job['queue_position'] = scheduler.queue_position(job_id)
     
-    return jsonify({
+    response = jsonify({
         'success': True,
         'job': job
     })
+    if since is not None:
+        response.set_etag(f"{job_id}:{job['version']}:{since}:{job.get('queue_position', '')}")
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+    return response
+
+
+def sse_event(event: str, data, event_id=None) -> str:
+    """Format 1 event ตาม text/event-stream"""
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@app.route('/api/events/<job_id>', methods=['GET'])
+def job_events(job_id):
+    """
+    Server-Sent Events ของ job: ส่งเฉพาะผลรูปใหม่ (delta) ทันทีที่ update_job_progress บันทึก
+
+    Events:
+        result - {"index": n, "result": {...}} (id = จำนวนผลที่ส่งไปแล้ว ใช้ resume ด้วย Last-Event-ID)
+        status - สถานะ job แบบย่อ (ไม่มี prompts / results) ส่งเมื่อ job เปลี่ยน
+        done   - job จบแล้ว (completed / cancelled / error)
+    """
+    try:
+        since = max(0, int(request.headers.get('Last-Event-ID') or request.args.get('since', 0)))
+    except ValueError:
+        since = 0
+    snapshot = job_store.get_since(job_id, since)
+    if snapshot is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+
+    def stream(snapshot, since):
+        yield "retry: 2000\n\n"
+        stream_until = time.monotonic() + SSE_MAX_STREAM_SECONDS
+        version = None
+        while True:
+            for result in snapshot.pop('results'):
+                yield sse_event('result', {'index': since, 'result': result}, event_id=since + 1)
+                since += 1
+            if snapshot['version'] != version:
+                version = snapshot['version']
+                if snapshot['status'] == 'pending':
+                    snapshot['queue_position'] = scheduler.queue_position(job_id)
+                yield sse_event('status', snapshot)
+            if snapshot['status'] in JOB_FINISHED_STATUSES:
+                yield sse_event('done', {'status': snapshot['status']})
+                return
+            if time.monotonic() >= stream_until:
+                return
+            if job_store.wait_for_change(job_id, version, SSE_KEEPALIVE_SECONDS) == version:
+                yield ": keepalive\n\n"
+                continue
+            snapshot = job_store.get_since(job_id, since)
+            if snapshot is None:
+                # job ถูกลบ - ปิด stream (browser ต่อใหม่จะได้ 404 แล้วเลิก)
+                return
+
+    return Response(
+        stream_with_context(stream(snapshot, since)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 
 @app.route('/api/jobs', methods=['GET'])
 def get_all_jobs():
     """API endpoint สำหรับดูรายการ jobs ทั้งหมด"""
-    with jobs_lock:
-        jobs_list = list(jobs.values())
+    jobs_list = job_store.list()
     
     return jsonify({
         'success': True,
@@ -863,6 +1310,55 @@ def get_all_jobs():
     })
 
 
+@app.route('/api/scheduler', methods=['GET'])
+def scheduler_status():
+    """ดูสถานะ worker pool / คิว / in-flight API calls ของ process นี้"""
+    return jsonify({
+        'success': True,
+        'scheduler': scheduler.stats(),
+        'inflight_jobs': inflight_calls.stats()
+    })
+
+
+@app.route('/api/concurrency', methods=['GET'])
+def concurrency_status():
+    """limit ปัจจุบัน + ประวัติการปรับของ adaptive limiter แต่ละ (key, model) - key แสดงเป็น fingerprint"""
+    return jsonify({
+        'success': True,
+        'enabled': ADAPTIVE_CONCURRENCY,
+        'limiters': concurrency_limiters.stats() if concurrency_limiters else []
+    })
+
+
+@app.route('/api/circuits', methods=['GET'])
+def circuit_status():
+    """สถานะ circuit breaker แต่ละ (key, model) - key แสดงเป็น fingerprint"""
+    return jsonify({
+        'success': True,
+        'enabled': BREAKER_ENABLED,
+        'circuits': circuit_breakers.stats() if circuit_breakers else []
+    })
+
+
+@app.route('/api/model-health', methods=['GET'])
+def model_health_status():
+    """latency / error rate (EWMA) ของแต่ละ (key, model) ที่ใช้ตัดสินใจ fallback - key แสดงเป็น fingerprint"""
+    return jsonify({
+        'success': True,
+        'models': model_router.stats()
+    })
+
+
+@app.route('/api/result-cache', methods=['GET'])
+def result_cache_status():
+    """จำนวนรูป / ขนาด / จำนวน hit ของ result cache"""
+    return jsonify({
+        'success': True,
+        'enabled': RESULT_CACHE_ENABLED,
+        'cache': result_cache.stats() if result_cache else None
+    })
+
+
 @app.route('/api/download/<filename>', methods=['GET'])
 def download_image(filename):
     """Download รูปภาพเดียว"""
@@ -875,83 +1371,88 @@ def download_image(filename):
         }), 404
 
 
+@app.route('/api/thumbnails/<filename>', methods=['GET'])
+def get_thumbnail(filename):
+    """
+    Thumbnail WebP ของรูป - ชื่อไฟล์ไม่ซ้ำกัน จึง cache ได้ยาว (immutable)
+    ถ้ายังสร้างไม่เสร็จ (หรือเป็นรูปเก่าที่ไม่มี thumbnail) สร้างจากรูปเต็มให้ทันที
+    """
+    if secure_filename(filename) != filename or not filename.endswith('.webp'):
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    thumb_path = os.path.join(THUMBNAIL_FOLDER, filename)
+    if not os.path.exists(thumb_path):
+        stem = os.path.splitext(filename)[0]
+        source = next((os.path.join(STATIC_FOLDER, stem + ext) for ext in IMAGE_EXTENSIONS
+                       if os.path.exists(os.path.join(STATIC_FOLDER, stem + ext))), None)
+        if source is None:
+            return jsonify({'success': False, 'error': 'Not found'}), 404
+        try:
+            with open(source, 'rb') as f:
+                thumbnail = make_thumbnail(f.read(), THUMBNAIL_SIZE)
+            os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+            write_file_atomic(thumb_path, thumbnail)
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)}), 500
+    response = send_from_directory(THUMBNAIL_FOLDER, filename, max_age=THUMBNAIL_CACHE_SECONDS)
+    response.headers['Cache-Control'] = f'public, max-age={THUMBNAIL_CACHE_SECONDS}, immutable'
+    return response
+
+
 @app.route('/api/download-all/<job_id>', methods=['GET'])
 def download_all(job_id):
-    """Download รูปทั้งหมดของ job เป็น ZIP"""
-    with jobs_lock:
-        if job_id not in jobs:
-            return jsonify({
-                'success': False,
-                'error': 'Job not found'
-            }), 404
-        
-        job = jobs[job_id].copy()
+    """
+    Download รูปทั้งหมดของ job เป็น ZIP (job ที่กำลังรัน / จบแล้ว หรือ job ใน history)
+    - ถ้ามี archive ที่ปิดแล้ว (JOB_ARCHIVES_ENABLED) ส่งไฟล์นั้นเลย รองรับ Range / If-Range
+    - ไม่งั้นสร้างแบบ stream ระหว่างส่ง (ZIP_STORED + manifest.json) ไม่เขียน ZIP ลง disk
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        job = history_store.get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
     
-    try:
-        # Create ZIP file
-        zip_filename = f"batch_{job_id[:8]}.zip"
-        zip_path = os.path.join(STATIC_FOLDER, zip_filename)
+    zip_filename = f"batch_{job_id[:8]}.zip"
 
-        manifest = {
-            'job_id': job['id'],
-            'created_at': job.get('created_at'),
-            'finished_at': job.get('finished_at'),
-            'model': job.get('model'),
-            'mode': job.get('mode'),
-            'aspect_ratio': job.get('aspect_ratio', '1:1'),
-            'master_prompts': job.get('master_prompts', ''),
-            'suffix': job.get('suffix', ''),
-            'negative_prompts': job.get('negative_prompts', ''),
-            'images': []
-        }
+    archive_path = job_archives.ready_path(job_id) if job_archives is not None else None
+    if archive_path:
+        return send_file(archive_path, mimetype='application/zip', as_attachment=True,
+                         download_name=zip_filename, conditional=True)
 
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for i, result in enumerate(job['results']):
-                if result['status'] == 'completed' and result['filename']:
-                    filepath = os.path.join(STATIC_FOLDER, result['filename'])
-                    if os.path.exists(filepath):
-                        zipf.write(filepath, result['filename'])
-                        manifest['images'].append({
-                            'index': i + 1,
-                            'filename': result['filename'],
-                            'prompt': result.get('prompt', ''),
-                            'timestamp': result.get('timestamp', '')
-                        })
-            zipf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    manifest, files = job_manifest(job)
+    manifest_bytes = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
 
-        return send_file(zip_path, as_attachment=True, download_name=zip_filename)
-    
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500
+    return Response(
+        stream_with_context(iter_zip(files, [('manifest.json', manifest_bytes)])),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'}
+    )
 
 
 @app.route('/api/delete/<job_id>', methods=['DELETE'])
 def delete_job(job_id):
     """ลบ job และรูปภาพที่เกี่ยวข้อง"""
-    with jobs_lock:
-        if job_id not in jobs:
-            return jsonify({
-                'success': False,
-                'error': 'Job not found'
-            }), 404
-        
-        job = jobs[job_id]
-        
-        # ลบรูปภาพ
-        for result in job['results']:
-            if result['status'] == 'completed' and result['filename']:
-                filepath = os.path.join(STATIC_FOLDER, result['filename'])
+    job = job_store.delete(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
+    
+    # ลบรูปภาพ (และ thumbnail)
+    for result in job['results']:
+        if result['status'] == 'completed' and result['filename']:
+            for filepath in (os.path.join(STATIC_FOLDER, result['filename']),
+                             os.path.join(THUMBNAIL_FOLDER, thumbnail_filename(result['filename']))):
                 try:
                     if os.path.exists(filepath):
                         os.remove(filepath)
                 except Exception:
                     pass
-        
-        # ลบ job
-        del jobs[job_id]
+    if job_archives is not None:
+        job_archives.delete(job_id)
     
     return jsonify({
         'success': True,
@@ -963,13 +1464,17 @@ def perform_cleanup():
     """ทำการลบรูปเก่า (internal function)"""
     try:
         max_age_hours = AUTO_CLEANUP_DAYS * 24
-        temp_generator = ImageGenerator(api_key="dummy", output_dir=STATIC_FOLDER)
+        temp_generator = ImageGenerator(api_key="dummy", output_dir=STATIC_FOLDER, thumbnail_dir=THUMBNAIL_FOLDER)
         deleted = temp_generator.cleanup_old_images(max_age_hours)
+        pruned = job_store.prune(max_age_hours * 3600)
+        if job_archives is not None:
+            job_archives.prune(max_age_hours * 3600)
+        reference_store.prune(max_age_hours * 3600)
         
         cleanup_state['last_cleanup'] = datetime.now().isoformat()
         cleanup_state['files_deleted'] = deleted
         
-        print(f"[Auto-cleanup] Deleted {deleted} files older than {AUTO_CLEANUP_DAYS} days")
+        print(f"[Auto-cleanup] Deleted {deleted} files and {pruned} finished jobs older than {AUTO_CLEANUP_DAYS} days")
         return deleted
     except Exception as e:
         print(f"[Auto-cleanup] Error: {e}")
@@ -1016,7 +1521,7 @@ def cleanup_status():
         total_files = 0
         total_size = 0
         for filename in os.listdir(STATIC_FOLDER):
-            if filename.endswith(('.png', '.jpg', '.jpeg')):
+            if filename.endswith(IMAGE_EXTENSIONS):
                 filepath = os.path.join(STATIC_FOLDER, filename)
                 if os.path.exists(filepath):
                     total_files += 1
@@ -1050,7 +1555,7 @@ def cleanup_status():
 def delete_all_history():
     """Delete all jobs from history"""
     try:
-        save_history([])
+        history_store.clear()
         return jsonify({
             'success': True,
             'message': 'All history deleted'
@@ -1065,13 +1570,93 @@ def delete_all_history():
 
 @app.route('/api/history', methods=['GET'])
 def get_history():
-    """ดูรายการ jobs ทั้งหมดจาก history"""
+    """
+    ดูรายการ jobs จาก history ใหม่สุดก่อน ทีละหน้า
+
+    Query:
+        cursor: next_cursor จากหน้าก่อน
+        limit: จำนวนต่อหน้า (default HISTORY_PAGE_SIZE)
+        view: 'full' (default) หรือ 'summary' (ไม่มี prompts / results)
+        status, model, from, to, has_reference: filter
+
+    Response:
+    {
+        "success": true,
+        "jobs": [...],
+        "next_cursor": 123,            // null เมื่อหมดแล้ว
+        "total": 57,                   // จำนวน job ที่ตรง filter ทั้งหมด (เฉพาะหน้าแรก)
+        "totals": {"jobs": 57, "prompts": 300, "images": 290}  // เฉพาะหน้าแรก
+    }
+    """
+    page_options, filters, error = parse_history_query(request.args)
+    if error:
+        return jsonify({
+            'success': False,
+            'error': error
+        }), 400
+    try:
+        jobs, next_cursor = history_store.page(**page_options, **filters)
+        response = {
+            'success': True,
+            'jobs': jobs,
+            'next_cursor': next_cursor
+        }
+        # ยอดรวมคำนวณเฉพาะหน้าแรก (หน้าถัดไปใช้ค่าเดิมจากหน้าแรก)
+        if page_options['cursor'] is None:
+            totals = history_store.totals(**filters)
+            response.update(total=totals['jobs'], totals=totals)
+        return jsonify(response)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/history/search', methods=['GET'])
+def search_history():
+    """
+    ค้นหา job ใน history จาก prompts / master prompts / suffix (full-text)
+
+    Query:
+        q: คำค้น (ทุกคำต้องตรง คำสุดท้ายตรงแบบ prefix)
+        limit: จำนวนผลสูงสุด (default 20)
+        view: 'summary' (default) หรือ 'full'
+
+    Response:
+    {
+        "success": true,
+        "jobs": [{..., "score": -3.2, "match": "... [red] [sneakers] ..."}],
+        "total": 3
+    }
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({
+            'success': False,
+            'error': 'q is required'
+        }), 400
+    try:
+        limit = int(request.args.get('limit', 20))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+        return jsonify({
+            'success': False,
+            'error': f'limit must be between 1 and {HISTORY_MAX_PAGE_SIZE}'
+        }), 400
+    view = request.args.get('view', 'summary')
+    if view not in ('full', 'summary'):
+        return jsonify({
+            'success': False,
+            'error': "view must be 'full' or 'summary'"
+        }), 400
     try:
-        history = load_history()
+        jobs = history_store.search(query, limit=limit, summary=view == 'summary')
         return jsonify({
             'success': True,
-            'jobs': history,
-            'total': len(history)
+            'jobs': jobs,
+            'total': len(jobs)
         })
     except Exception as e:
         return jsonify({
@@ -1084,8 +1669,7 @@ def get_history():
 def get_history_job(job_id):
     """ดู job เดียวจาก history"""
     try:
-        history = load_history()
-        job = next((j for j in history if j['id'] == job_id), None)
+        job = history_store.get(job_id)
         
         if not job:
             return jsonify({
@@ -1108,27 +1692,12 @@ def get_history_job(job_id):
 def delete_history_job(job_id):
     """ลบ job จาก history"""
     try:
-        history = load_history()
-        
-        # หา index ของ job ที่ต้องการลบ
-        job_index = None
-        for i, job in enumerate(history):
-            if job.get('id') == job_id:
-                job_index = i
-                break
-        
-        if job_index is None:
+        if not history_store.delete(job_id):
             return jsonify({
                 'success': False,
                 'error': 'Job not found in history'
             }), 404
         
-        # ลบ job จาก history
-        history.pop(job_index)
-        
-        # บันทึก history ใหม่
-        save_history(history)
-        
         return jsonify({
             'success': True,
             'message': 'Job deleted from history'
@@ -1160,8 +1729,7 @@ def rerun_job(job_id):
             }), 400
         
         # หา job ใน history
-        history = load_history()
-        old_job = next((j for j in history if j['id'] == job_id), None)
+        old_job = history_store.get(job_id)
         
         if not old_job:
             return jsonify({
@@ -1178,19 +1746,24 @@ def rerun_job(job_id):
             suffix=old_job.get('suffix', ''),
             negative_prompts=old_job.get('negative_prompts', ''),
             aspect_ratio=old_job.get('aspect_ratio', '1:1'),
-            character_consistency=old_job.get('character_consistency', False)
+            character_consistency=old_job.get('character_consistency', False),
+            model_fallback=old_job.get('model_fallback', False),
+            output_format=old_job.get('output_format', 'png'),
+            output_quality=old_job.get('output_quality', OUTPUT_QUALITY_DEFAULT),
+            variations=old_job.get('variations', False)
         )
         
-        # Start background processing
-        thread = threading.Thread(target=process_generation, args=(new_job_id, api_key))
-        thread.daemon = True
-        thread.start()
+        # ส่งเข้าคิวของ scheduler
+        queue_position, error_response = enqueue_job(new_job_id, process_generation, new_job_id, api_key)
+        if error_response:
+            return error_response
         
         return jsonify({
             'success': True,
             'job_id': new_job_id,
             'message': f'Re-running job with {len(old_job["prompts"])} prompts',
-            'total': len(old_job['prompts'])
+            'total': len(old_job['prompts']),
+            'queue_position': queue_position
         })
     
     except Exception as e:
@@ -1207,7 +1780,7 @@ def cleanup():
         max_age_hours = request.json.get('max_age_hours', 24) if request.json else 24
         
         # สร้าง temporary ImageGenerator instance สำหรับ cleanup
-        temp_generator = ImageGenerator(api_key="dummy", output_dir=STATIC_FOLDER)
+        temp_generator = ImageGenerator(api_key="dummy", output_dir=STATIC_FOLDER, thumbnail_dir=THUMBNAIL_FOLDER)
         deleted = temp_generator.cleanup_old_images(max_age_hours)
         
         return jsonify({
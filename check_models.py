@@ -1,10 +1,12 @@
 """
 Check available models in Google Generative AI
+ใช้รายชื่อ model จาก cache เดียวกับ /api/validate-key (รันซ้ำภายใน KEY_VALIDATION_TTL ไม่ต้องเรียก API)
 """
 
 import os
 from dotenv import load_dotenv
-import google.generativeai as genai
+from key_validation import KeyValidator, is_image_model, load_or_create_salt
+from shared_cache import SharedCache
 
 load_dotenv()
 api_key = os.getenv('GOOGLE_API_KEY')
@@ -13,32 +15,44 @@ if not api_key:
     print("❌ API Key not found")
     exit(1)
 
-genai.configure(api_key=api_key)
+DATA_FOLDER = 'data'
+salt = os.getenv('KEY_CACHE_SALT', '')
+validator = KeyValidator(
+    SharedCache(
+        os.getenv('SHARED_CACHE_PATH', os.path.join(DATA_FOLDER, 'cache.db')),
+        'key_validation',
+        int(os.getenv('KEY_VALIDATION_TTL', '300'))
+    ),
+    salt.encode('utf-8') if salt else load_or_create_salt(
+        os.getenv('KEY_CACHE_SALT_PATH', os.path.join(DATA_FOLDER, 'key_cache.salt'))
+    ),
+    negative_ttl_seconds=int(os.getenv('KEY_VALIDATION_NEGATIVE_TTL', '60'))
+)
 
 print("=" * 60)
 print("Available Models:")
 print("=" * 60)
 
 try:
-    models = genai.list_models()
-    
+    models = validator.list_models(api_key)
+
     print("\n🎨 Image Generation Models:")
     print("-" * 60)
-    image_models = [m for m in models if 'image' in m.name.lower() or 'imagen' in m.name.lower()]
-    
+    image_models = [m for m in models if is_image_model(m)]
+
     if image_models:
         for model in image_models:
-            print(f"✅ {model.name}")
-            print(f"   Display Name: {model.display_name}")
-            print(f"   Description: {model.description}")
+            print(f"✅ {model['name']}")
+            print(f"   Display Name: {model['display_name']}")
+            print(f"   Description: {model['description']}")
             print()
     else:
         print("❌ No image generation models found")
-    
+
     print("\n📝 All Available Models:")
     print("-" * 60)
     for model in models:
-        print(f"- {model.name}")
-        
+        print(f"- {model['name']}")
+
 except Exception as e:
     print(f"❌ Error: {e}")
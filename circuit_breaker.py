@@ -0,0 +1,208 @@
+"""
+Circuit Breaker Module
+ตัดวงจรต่อ (API key, model) เมื่อ Gemini ล่ม - ไม่ต้องรอ timeout + retry ทีละรูปจนครบทั้ง batch
+- closed: เรียกได้ปกติ นับผลของ call ล่าสุดใน window
+- open: สัดส่วน fail เกิน threshold -> ทุก call fail ทันทีด้วย CircuitOpenError จนครบ open_seconds
+- half_open: ปล่อย call ทดลองจำนวนจำกัด (call อื่นรอผล) ถ้าสำเร็จกลับเป็น closed ถ้า fail กลับไป open
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from concurrency import key_fingerprint
+from gemini_errors import is_retryable_error
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Circuit เปิดอยู่ - ไม่เรียก API (fail ทันที)"""
+
+    def __init__(self, model: str, retry_in: float, failure_rate: float):
+        super().__init__(
+            f"Circuit open for {model}: Gemini is failing ({failure_rate:.0%} of recent calls), "
+            f"skipping call - retry in {math.ceil(retry_in)}s"
+        )
+        self.model = model
+        self.retry_in = retry_in
+
+
+class CallAttempt:
+    """สถานะของ call ใน guard() - ผู้เรียก mark_sent() ตอนส่ง request ไป Gemini จริง"""
+
+    def __init__(self):
+        self.sent = False
+
+    def mark_sent(self):
+        self.sent = True
+
+
+class CircuitBreaker:
+    """Breaker ของ (key, model) เดียว - guard() ใช้บน engine loop (stats() อ่านจาก thread อื่นได้)"""
+
+    def __init__(self, model: str, failure_rate: float = 0.5, window_size: int = 20, min_calls: int = 5,
+                 open_seconds: float = 30.0, half_open_calls: int = 1):
+        self.model = model
+        self.failure_rate_threshold = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.open_count = 0
+        self._outcomes: deque = deque(maxlen=max(self.min_calls, window_size))
+        self._trials = 0
+        self._trial_done: Optional[asyncio.Event] = None
+        self._lock = threading.Lock()
+
+    def _failure_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.open_count += 1
+        self._trials = 0
+        print(f"[Circuit] {self.model} OPEN (failure rate {self._failure_rate():.0%})")
+
+    def is_open(self) -> bool:
+        """True ถ้าวงจรเปิดอยู่และยังไม่ถึงเวลาปล่อย call ทดลอง"""
+        with self._lock:
+            return self.state == OPEN and time.monotonic() - self.opened_at < self.open_seconds
+
+    def _wake_trial_waiters(self):
+        if self._trial_done is not None:
+            self._trial_done.set()
+            self._trial_done = None
+
+    async def _before_call(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                if self.state == OPEN:
+                    if now - self.opened_at < self.open_seconds:
+                        raise CircuitOpenError(
+                            self.model, self.open_seconds - (now - self.opened_at), self._failure_rate()
+                        )
+                    self.state = HALF_OPEN
+                    self._trials = 0
+                if self.state != HALF_OPEN:
+                    return
+                if self._trials < self.half_open_calls:
+                    self._trials += 1
+                    return
+                if self._trial_done is None:
+                    self._trial_done = asyncio.Event()
+                trial_done = self._trial_done
+            # มี call ทดลองวิ่งอยู่ครบแล้ว - รอผลแล้วตัดสินใหม่
+            await trial_done.wait()
+
+    def _record(self, success: bool):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                if success:
+                    print(f"[Circuit] {self.model} CLOSED (trial call succeeded)")
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open(time.monotonic())
+                self._wake_trial_waiters()
+                return
+            self._outcomes.append(success)
+            if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                    and self._failure_rate() >= self.failure_rate_threshold):
+                self._open(time.monotonic())
+
+    def _release_trial(self):
+        # call ทดลองถูกยกเลิกกลางทาง (ไม่รู้ผล) - คืนสิทธิ์ให้ call ถัดไปลองแทน
+        with self._lock:
+            if self.state == HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+                self._wake_trial_waiters()
+
+    @asynccontextmanager
+    async def guard(self, deadline: Optional[float] = None):
+        """
+        ครอบ 1 call - raise CircuitOpenError ถ้าวงจรเปิด (yield CallAttempt)
+        error ที่ retry ได้ (5xx, 429, network) และการโดนตัดเพราะเลย deadline นับเป็น failure
+        error ถาวร (prompt ผิด / safety) ไม่ใช่ปัญหาของ service จึงนับเป็น success
+        นับผลเฉพาะ call ที่ mark_sent() แล้ว - ถูกยกเลิก / error ระหว่างรอคิวในเครื่อง (rate limit, slot)
+        ไม่ใช่ความผิดของ Gemini จึงไม่นับ
+        """
+        await self._before_call()
+        attempt = CallAttempt()
+        try:
+            yield attempt
+        except asyncio.CancelledError:
+            if attempt.sent and deadline is not None and time.monotonic() >= deadline - 0.05:
+                self._record(False)
+            else:
+                self._release_trial()
+            raise
+        except Exception as e:
+            if attempt.sent:
+                self._record(not is_retryable_error(e))
+            else:
+                self._release_trial()
+            raise
+        else:
+            if attempt.sent:
+                self._record(True)
+            else:
+                self._release_trial()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            retry_in = max(0.0, self.open_seconds - (time.monotonic() - self.opened_at)) if self.state == OPEN else 0.0
+            return {
+                "state": self.state,
+                "failure_rate": round(self._failure_rate(), 3),
+                "recent_calls": len(self._outcomes),
+                "open_count": self.open_count,
+                "retry_in": round(retry_in, 1)
+            }
+
+
+class CircuitBreakers:
+    """CircuitBreaker แยกตาม (api_key, model) - LRU เก็บได้สูงสุด max_entries คู่"""
+
+    def __init__(self, failure_rate: float = 0.5, window_size: int = 20, min_calls: int = 5,
+                 open_seconds: float = 30.0, half_open_calls: int = 1, max_entries: int = 256):
+        self.settings = dict(failure_rate=failure_rate, window_size=window_size, min_calls=min_calls,
+                             open_seconds=open_seconds, half_open_calls=half_open_calls)
+        self.max_entries = max(1, max_entries)
+        self._breakers: "OrderedDict[Tuple[str, str], CircuitBreaker]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str, model: str) -> CircuitBreaker:
+        key = (api_key, model)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(model, **self.settings)
+                self._breakers[key] = breaker
+                while len(self._breakers) > self.max_entries:
+                    self._breakers.popitem(last=False)
+            else:
+                self._breakers.move_to_end(key)
+            return breaker
+
+    def guard(self, api_key: str, model: str, deadline: Optional[float] = None):
+        return self.get(api_key, model).guard(deadline)
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            items = list(self._breakers.items())
+        return [
+            dict(breaker.stats(), key=key_fingerprint(api_key), model=model)
+            for (api_key, model), breaker in items
+        ]
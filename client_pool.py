@@ -0,0 +1,102 @@
+"""
+Client Pool Module
+เก็บ Gemini client แยกตาม API key (LRU) แทนการเรียก genai.configure ซึ่งเปลี่ยน global state ของ SDK
+แต่ละ key ได้ transport/connection ของตัวเองที่ใช้ซ้ำได้ข้าม job
+"""
+
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+
+
+class KeyedClient:
+    """ชุด client ของ API key เดียว - สร้าง transport ครั้งเดียวแล้วใช้ซ้ำ"""
+
+    def __init__(self, api_key: str):
+        # _ClientManager คือตัวที่ genai.configure ใช้อยู่ภายใน แต่ที่นี่สร้างแยกต่อ key ไม่แตะ global
+        self._manager = genai_client._ClientManager()
+        self._manager.configure(api_key=api_key)
+        self._lock = threading.Lock()
+        self._models: Dict[str, genai.GenerativeModel] = {}
+        self._async_models: Dict[str, tuple] = {}
+        self._async_client = None
+
+    def _get(self, name: str):
+        with self._lock:
+            return self._manager.get_default_client(name)
+
+    @property
+    def generative(self):
+        """Sync GenerativeServiceClient ของ key นี้"""
+        return self._get("generative")
+
+    @property
+    def model_service(self):
+        """ModelServiceClient ของ key นี้ (ใช้ list models)"""
+        return self._get("model")
+
+    def generative_model(self, model_name: str) -> genai.GenerativeModel:
+        """GenerativeModel ที่ผูกกับ client ของ key นี้ (cache ต่อชื่อ model)"""
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is None:
+                model = genai.GenerativeModel(model_name=model_name)
+                model._client = self._manager.get_default_client("generative")
+                self._models[model_name] = model
+            return model
+
+    def generative_model_async(self, model_name: str) -> genai.GenerativeModel:
+        """
+        GenerativeModel สำหรับ generate_content_async บน event loop ที่กำลังรันอยู่
+        (grpc async channel ผูกกับ loop ที่สร้างมัน จึง cache แยกตาม loop)
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            cached = self._async_models.get(model_name)
+            if cached is not None and cached[0] is loop:
+                return cached[1]
+            if self._async_client is None or self._async_client[0] is not loop:
+                self._async_client = (loop, self._manager.make_client("generative_async"))
+            model = genai.GenerativeModel(model_name=model_name)
+            model._async_client = self._async_client[1]
+            self._async_models[model_name] = (loop, model)
+            return model
+
+    def list_models(self) -> List:
+        """เรียก list models ด้วย key นี้ (ใช้ตรวจว่า key ใช้งานได้)"""
+        return list(genai.list_models(client=self.model_service))
+
+
+class ClientPool:
+    """LRU pool ของ KeyedClient - เก็บได้สูงสุด max_size keys"""
+
+    def __init__(self, max_size: int = 32):
+        self.max_size = max(1, max_size)
+        self._clients: "OrderedDict[str, KeyedClient]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str) -> KeyedClient:
+        with self._lock:
+            keyed = self._clients.get(api_key)
+            if keyed is not None:
+                self._clients.move_to_end(api_key)
+                return keyed
+            keyed = KeyedClient(api_key)
+            self._clients[api_key] = keyed
+            while len(self._clients) > self.max_size:
+                # key ที่ไม่ได้ใช้นานสุดถูกปล่อย - channel จะถูกปิดเมื่อไม่มี job ไหนถืออยู่แล้ว
+                self._clients.popitem(last=False)
+            return keyed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'keys': len(self._clients), 'max_size': self.max_size}
+
+
+# Pool กลางของ process (ใช้ร่วมกันทุก ImageGenerator)
+default_client_pool = ClientPool(max_size=int(os.getenv('CLIENT_POOL_SIZE', '32')))
@@ -0,0 +1,202 @@
+"""
+Adaptive Concurrency Module
+จำกัดจำนวน call ที่วิ่งพร้อมกันต่อ (API key, model) แบบ AIMD
+- call สำเร็จ: เพิ่ม limit ทีละนิด (+1 ต่อ limit calls ที่สำเร็จ)
+- เจอ 429 / 503: ลด limit ลงครึ่งหนึ่ง (ครั้งเดียวต่อ 1 ระลอก error)
+ทำให้แต่ละ key วิ่งได้เร็วที่สุดเท่าที่ quota tier ของมันรับได้ โดยไม่ต้องจูน MAX_WORKERS เอง
+"""
+
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from gemini_errors import is_overload_error
+
+
+def key_fingerprint(api_key: str) -> str:
+    """ตัวระบุ key ที่แสดงผลได้ (ไม่เปิดเผย key จริง)"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+class AdaptiveLimiter:
+    """
+    Limiter ของ (key, model) เดียว - ใช้บน engine loop เท่านั้น
+    (stats() อ่านจาก thread อื่นได้)
+    """
+
+    def __init__(self, initial: int = 3, min_limit: int = 1, max_limit: int = 16,
+                 decrease_factor: float = 0.5, history_size: int = 50):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.decrease_factor = decrease_factor
+        self._limit = float(min(self.max_limit, max(self.min_limit, initial)))
+        self._inflight = 0
+        self._epoch = 0  # เพิ่มทุกครั้งที่ลด limit - call ที่เริ่มก่อนการลดไม่ทำให้ลดซ้ำ
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+        self.successes = 0
+        self.overloads = 0
+        self.history: deque = deque(maxlen=history_size)
+        self._record("initial")
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _record(self, reason: str):
+        self.history.append({
+            "time": datetime.now().isoformat(),
+            "limit": self.limit,
+            "reason": reason
+        })
+
+    def _wake_waiters(self):
+        free = self.limit - self._inflight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def _wait_available(self):
+        """รอจนมี slot ว่าง (ยังไม่จอง)"""
+        while self._inflight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # ได้สิทธิ์แล้วแต่ถูก cancel - ส่งต่อให้ตัวถัดไป
+                    self._wake_waiters()
+                raise
+
+    def _try_acquire(self) -> Optional[int]:
+        """จอง slot ถ้าว่าง - return epoch หรือ None ถ้าเต็ม"""
+        with self._lock:
+            if self._inflight >= self.limit:
+                return None
+            self._inflight += 1
+            return self._epoch
+
+    async def _acquire(self, stack: AsyncExitStack, gate: Optional[Callable]) -> int:
+        """
+        จอง slot (และ gate ถ้ามี) - รอ slot ว่างก่อนโดยไม่ถือ gate แล้วค่อยเข้า gate แล้วจอง slot
+        ระหว่างรอ gate ถ้า slot ถูกคนอื่นจองไป ปล่อย gate แล้วรอใหม่
+        inflight จึงนับเฉพาะ call ที่ผ่าน gate แล้ว (วิ่งอยู่จริง) และ call ที่รอ slot ไม่กัน gate ของ key อื่น
+        """
+        while True:
+            await self._wait_available()
+            if gate is None:
+                epoch = self._try_acquire()
+                if epoch is not None:
+                    return epoch
+                continue
+            attempt = AsyncExitStack()
+            try:
+                await attempt.enter_async_context(gate())
+            except asyncio.CancelledError:
+                # ถูกปลุกให้ใช้ slot ว่างแต่ถูกยกเลิกระหว่างรอ gate - ส่งต่อให้ตัวถัดไป
+                self._wake_waiters()
+                raise
+            epoch = self._try_acquire()
+            if epoch is not None:
+                stack.push_async_exit(attempt)
+                return epoch
+            await attempt.aclose()
+
+    def _release(self):
+        with self._lock:
+            self._inflight -= 1
+        self._wake_waiters()
+
+    def _on_success(self):
+        with self._lock:
+            self.successes += 1
+            before = self.limit
+            self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+            if self.limit != before:
+                self._record("increase")
+        self._wake_waiters()
+
+    def _on_overload(self, epoch: int):
+        with self._lock:
+            self.overloads += 1
+            if epoch != self._epoch:
+                return  # ระลอกเดียวกับที่ลดไปแล้ว
+            self._epoch += 1
+            self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+            self._record("decrease")
+
+    @asynccontextmanager
+    async def slot(self, gate: Optional[Callable] = None):
+        """
+        จอง slot สำหรับ call 1 ครั้ง - ผลของ call (สำเร็จ / overload) ถูกใช้ปรับ limit
+        gate: factory ของ context manager ระดับ process (เช่น call gate ของ scheduler) ที่ต้องได้ก่อน slot
+        """
+        async with AsyncExitStack() as stack:
+            epoch = await self._acquire(stack, gate)
+            try:
+                yield
+            except Exception as e:
+                if is_overload_error(e):
+                    self._on_overload(epoch)
+                raise
+            else:
+                self._on_success()
+            finally:
+                self._release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "inflight": self._inflight,
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "successes": self.successes,
+                "overloads": self.overloads,
+                "history": list(self.history)
+            }
+
+
+class ConcurrencyLimiters:
+    """AdaptiveLimiter แยกตาม (api_key, model) - LRU เก็บได้สูงสุด max_entries คู่"""
+
+    def __init__(self, initial: int = 3, min_limit: int = 1, max_limit: int = 16, max_entries: int = 256):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max(1, max_limit)
+        self.max_entries = max(1, max_entries)
+        self._limiters: "OrderedDict[Tuple[str, str], AdaptiveLimiter]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str, model: str) -> AdaptiveLimiter:
+        key = (api_key, model)
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = AdaptiveLimiter(self.initial, self.min_limit, self.max_limit)
+                self._limiters[key] = limiter
+                while len(self._limiters) > self.max_entries:
+                    self._limiters.popitem(last=False)
+            else:
+                self._limiters.move_to_end(key)
+            return limiter
+
+    def slot(self, api_key: str, model: str, gate: Optional[Callable] = None):
+        return self.get(api_key, model).slot(gate)
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            items = list(self._limiters.items())
+        return [
+            dict(limiter.stats(), key=key_fingerprint(api_key), model=model)
+            for (api_key, model), limiter in items
+        ]
@@ -0,0 +1,88 @@
+"""
+Engine Loop Module
+event loop กลาง 1 ตัวต่อ process (รันใน background thread) สำหรับ AsyncImageGenerator
+โค้ด sync (Flask route, scheduler worker) ส่ง coroutine มารันผ่าน run_sync()
+"""
+
+import asyncio
+import os
+import threading
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar('T')
+
+_lock = threading.Lock()
+_loop = None
+_loop_pid = None
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_engine_loop() -> asyncio.AbstractEventLoop:
+    """Return event loop กลาง (สร้างใหม่ถ้ายังไม่มี หรือถ้า process ถูก fork มา)"""
+    global _loop, _loop_pid
+    with _lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_loop, args=(loop,), name="gen-event-loop", daemon=True)
+            thread.start()
+            _loop, _loop_pid = loop, os.getpid()
+        return _loop
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """รัน coroutine บน engine loop แล้วรอผล - ห้ามเรียกจากใน engine loop เอง"""
+    return asyncio.run_coroutine_threadsafe(coro, get_engine_loop()).result()
+
+
+class InflightRegistry:
+    """
+    ทะเบียนงานที่กำลังวิ่งอยู่บน engine loop แยกตาม job_id
+    /api/cancel เรียก cancel(job_id) เพื่อ abort call ที่ค้างอยู่ทันที (ไม่ต้องรอ poll รอบถัดไป)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[int, Callable[[], None]]] = {}
+        self._next_token = 0
+
+    @contextmanager
+    def track(self, job_id: Optional[str], cancel_fn: Callable[[], None]):
+        """ลงทะเบียน cancel_fn (เรียกบน engine loop) ระหว่างที่อยู่ใน block นี้"""
+        if not job_id:
+            yield
+            return
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._entries.setdefault(job_id, {})[token] = cancel_fn
+        try:
+            yield
+        finally:
+            with self._lock:
+                entries = self._entries.get(job_id, {})
+                entries.pop(token, None)
+                if not entries:
+                    self._entries.pop(job_id, None)
+
+    def cancel(self, job_id: str) -> int:
+        """สั่ง cancel ทุกงานของ job นี้ใน process นี้ - return จำนวนงานที่ถูกสั่ง"""
+        with self._lock:
+            cancel_fns = list(self._entries.get(job_id, {}).values())
+        if cancel_fns:
+            loop = get_engine_loop()
+            for cancel_fn in cancel_fns:
+                loop.call_soon_threadsafe(cancel_fn)
+        return len(cancel_fns)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {job_id: len(entries) for job_id, entries in self._entries.items()}
+
+
+# ทะเบียนกลางของ process
+inflight_calls = InflightRegistry()
@@ -0,0 +1,95 @@
+"""
+Gemini Errors Module
+จัดกลุ่ม error ที่ได้จาก Gemini API (google.api_core exceptions หรือข้อความ error)
+"""
+
+import re
+from typing import Optional
+
+from google.api_core import exceptions as gexc
+from google.generativeai.types import BlockedPromptException, StopCandidateException
+
+# HTTP status ที่หมายถึง quota เต็ม / server รับไม่ไหว
+OVERLOAD_STATUS_CODES = (429, 503)
+OVERLOAD_MARKERS = ("resource_exhausted", "resource exhausted", "too many requests", "overloaded", "unavailable")
+# "Please retry in 12.5s" / "retryDelay": "7s" / "retry-after: 500ms" ในข้อความ error
+_RETRY_HINT = re.compile(r"retry(?:[ _-]?delay|[ _-]?after| in)[\"']?\s*[:=]?\s*[\"']?([\d.]+)\s*(ms|s)", re.IGNORECASE)
+
+
+def error_status_code(exc: BaseException):
+    """HTTP status code ของ error (ถ้ามี)"""
+    code = getattr(exc, "code", None)
+    try:
+        return int(code) if code is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_overload_error(exc: BaseException) -> bool:
+    """True ถ้า error บอกว่าเรียกเร็ว/ถี่เกิน (429 ResourceExhausted) หรือ server overload (503)"""
+    if isinstance(exc, (gexc.ResourceExhausted, gexc.TooManyRequests, gexc.ServiceUnavailable)):
+        return True
+    if error_status_code(exc) in OVERLOAD_STATUS_CODES:
+        return True
+    message = str(exc).lower()
+    return any(marker in message for marker in OVERLOAD_MARKERS) or message.startswith(("429", "503"))
+
+
+class SafetyBlockedError(Exception):
+    """Prompt หรือผลลัพธ์ถูก safety filter บล็อก - ส่งซ้ำก็ได้ผลเดิม"""
+
+
+# finish_reason ของ candidate ที่หมายถึงถูกบล็อก (ไม่ใช่แค่ไม่มีรูป)
+BLOCKING_FINISH_REASONS = ("SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "IMAGE_SAFETY")
+
+
+def response_block_reason(response) -> Optional[str]:
+    """เหตุผลที่ response ถูกบล็อก (prompt_feedback / finish_reason) หรือ None"""
+    feedback = getattr(response, "prompt_feedback", None)
+    reason = getattr(getattr(feedback, "block_reason", None), "name", None)
+    if reason and reason != "BLOCK_REASON_UNSPECIFIED":
+        return f"prompt blocked ({reason})"
+    for candidate in getattr(response, "candidates", None) or []:
+        finish = getattr(getattr(candidate, "finish_reason", None), "name", None)
+        if finish in BLOCKING_FINISH_REASONS:
+            return f"response blocked ({finish})"
+    return None
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    True ถ้าลองใหม่แล้วมีโอกาสสำเร็จ (overload, 5xx, timeout, network)
+    False สำหรับ error ถาวร: request ผิด (400), key ใช้ไม่ได้ (401/403), model ไม่มี (404), safety block
+    """
+    if isinstance(exc, (SafetyBlockedError, BlockedPromptException, StopCandidateException)):
+        return False
+    if is_overload_error(exc):
+        return True
+    if isinstance(exc, gexc.ClientError):
+        return False
+    if isinstance(exc, ValueError) and "blocked prompt" in str(exc):
+        return False
+    return True
+
+
+def server_retry_delay(exc: BaseException) -> Optional[float]:
+    """เวลารอที่ server แนะนำ (RetryInfo, Retry-After header หรือ 'retry in Xs' ในข้อความ) เป็นวินาที"""
+    for detail in getattr(exc, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            seconds = getattr(delay, "seconds", 0) + getattr(delay, "nanos", 0) / 1e9
+            if seconds > 0:
+                return seconds
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    retry_after = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+    match = _RETRY_HINT.search(str(exc))
+    if match:
+        value = float(match.group(1))
+        return value / 1000 if match.group(2).lower() == "ms" else value
+    return None
+
@@ -0,0 +1,365 @@
+"""
+History Store Module
+ประวัติ job ที่จบแล้วใน SQLite (WAL mode) แทนไฟล์ jobs_history.json
+- เพิ่ม / อ่าน / ลบ ทีละ job ไม่ต้อง parse และเขียนทั้งไฟล์ใหม่ทุกครั้ง
+- ทุก gunicorn worker เขียนพร้อมกันได้โดยไม่ทับกัน
+- ย้ายข้อมูลจาก jobs_history.json เดิมให้อัตโนมัติครั้งแรก
+- แบ่งหน้าแบบ cursor (seq) + filter status / model / ช่วงวันที่ / has_reference ผ่าน index
+  view แบบ summary อ่านจากคอลัมน์ summary (ไม่มี prompts / results) ไม่ต้อง parse entry เต็ม
+- ค้นหา prompt แบบ full-text ด้วย FTS5 (index อัปเดตทุกครั้งที่เพิ่ม / ลบ job)
+  ถ้า SQLite ไม่มี FTS5 ใช้ LIKE scan แทน (ช้ากว่าแต่ผลเหมือนกัน ไม่มี ranking)
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# field ที่ไม่อยู่ใน summary (ขนาดโตตามจำนวนรูป / prompt)
+SUMMARY_EXCLUDED_FIELDS = ('prompts', 'results')
+
+# คอลัมน์ที่เพิ่มทีหลัง - db เก่าถูก ALTER + เติมค่าจาก data ตอนเปิด
+EXTRA_COLUMNS = {
+    'has_reference': 'INTEGER NOT NULL DEFAULT 0',
+    'total': 'INTEGER NOT NULL DEFAULT 0',
+    'success_count': 'INTEGER NOT NULL DEFAULT 0',
+    'summary': 'TEXT',
+}
+
+
+# คอลัมน์ของ FTS index (rowid = history.seq)
+SEARCH_COLUMNS = ('prompts', 'master_prompts', 'suffix', 'result_prompts')
+# สระ / วรรณยุกต์ไทย (combining marks) - นับเป็นส่วนของคำ ไม่งั้นคำไทยถูกตัดกลางคำ
+THAI_MARKS = "\u0e31\u0e34\u0e35\u0e36\u0e37\u0e38\u0e39\u0e3a\u0e47\u0e48\u0e49\u0e4a\u0e4b\u0e4c\u0e4d\u0e4e"
+SEARCH_TOKEN = re.compile(f"[\\w{THAI_MARKS}]+")
+
+
+def search_document(entry: Dict) -> Tuple[str, str, str, str]:
+    """ข้อความของ entry ที่ index ไว้ค้นหา ตามลำดับ SEARCH_COLUMNS"""
+    prompts = [p for p in entry.get('prompts') or [] if isinstance(p, str)]
+    known = set(prompts)
+    # prompt ต่อรูป (ที่รวม master / suffix แล้ว) - เก็บเฉพาะที่ต่างจาก prompts
+    result_prompts = []
+    for result in entry.get('results') or []:
+        prompt = result.get('prompt')
+        if isinstance(prompt, str) and prompt and prompt not in known:
+            known.add(prompt)
+            result_prompts.append(prompt)
+    return (
+        "\n".join(prompts),
+        entry.get('master_prompts') or '',
+        entry.get('suffix') or '',
+        "\n".join(result_prompts),
+    )
+
+
+def search_terms(query: str) -> List[str]:
+    """คำค้นจาก query ของผู้ใช้ (ตัวอักษร / ตัวเลข, ตัวพิมพ์เล็ก)"""
+    return SEARCH_TOKEN.findall((query or '').lower())
+
+
+def summarize_entry(entry: Dict) -> Dict:
+    """Projection แบบย่อของ history entry: ไม่มี prompts / results แต่มีจำนวนไว้แสดงผล"""
+    summary = {k: v for k, v in entry.items() if k not in SUMMARY_EXCLUDED_FIELDS}
+    summary['prompt_count'] = len(entry.get('prompts') or [])
+    results = entry.get('results') or []
+    summary['result_count'] = len(results)
+    summary['cover_thumbnail_url'] = results[0].get('thumbnail_url') if results else None
+    return summary
+
+
+class HistoryStore:
+    """
+    1 แถวต่อ job: คอลัมน์ที่ใช้ค้น / เรียง + entry เต็มเป็น JSON
+    ลำดับใหม่สุดก่อนตาม seq (ลำดับที่เพิ่มเข้ามา)
+    """
+
+    def __init__(self, path: str, max_jobs: int = 10000):
+        """
+        Args:
+            path: ไฟล์ SQLite
+            max_jobs: จำนวน job สูงสุดที่เก็บ (เก่าสุดถูกลบเมื่อเกิน, 0 = ไม่จำกัด)
+        """
+        self.path = path
+        self.max_jobs = max_jobs
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS history (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT NOT NULL UNIQUE,
+                created_at TEXT,
+                status TEXT,
+                model TEXT,
+                data TEXT NOT NULL
+            );
+        """)
+        self._migrate(conn)
+        conn.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_history_status ON history (status, seq);
+            CREATE INDEX IF NOT EXISTS idx_history_model ON history (model, seq);
+            CREATE INDEX IF NOT EXISTS idx_history_reference ON history (has_reference, seq);
+            CREATE INDEX IF NOT EXISTS idx_history_created ON history (created_at);
+        """)
+        self.fts_enabled = self._init_search(conn)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connection ใช้ข้าม thread ไม่ได้ - เปิด 1 connection ต่อ thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection):
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        missing = [name for name in EXTRA_COLUMNS if name not in columns]
+        if not missing:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # worker อื่นอาจ migrate ไปแล้วระหว่างรอ lock
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+            for name in EXTRA_COLUMNS:
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE history ADD COLUMN {name} {EXTRA_COLUMNS[name]}")
+            rows = conn.execute("SELECT seq, data FROM history WHERE summary IS NULL").fetchall()
+            for seq, data in rows:
+                conn.execute(
+                    "UPDATE history SET has_reference = ?, total = ?, success_count = ?, summary = ? WHERE seq = ?",
+                    self._derived_columns(json.loads(data)) + (seq,)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _init_search(self, conn: sqlite3.Connection) -> bool:
+        """สร้าง FTS5 index (+ trigger ลบตาม history) และเติม index ให้ job เดิม - return False ถ้าไม่มี FTS5"""
+        try:
+            conn.executescript(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                    {', '.join(SEARCH_COLUMNS)}, tokenize = "unicode61 remove_diacritics 2 tokenchars '{THAI_MARKS}'"
+                );
+                CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                    DELETE FROM history_fts WHERE rowid = old.seq;
+                END;
+            """)
+        except sqlite3.OperationalError as e:
+            print(f"[History] FTS5 unavailable, search falls back to a table scan: {e}")
+            return False
+        if conn.execute("SELECT 1 FROM history_fts LIMIT 1").fetchone() is None:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # worker อื่นอาจเติมไปแล้วระหว่างรอ lock
+                if conn.execute("SELECT 1 FROM history_fts LIMIT 1").fetchone() is None:
+                    for seq, data in conn.execute("SELECT seq, data FROM history").fetchall():
+                        self._index(conn, seq, json.loads(data))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return True
+
+    @staticmethod
+    def _index(conn: sqlite3.Connection, seq: int, entry: Dict):
+        conn.execute(
+            f"INSERT INTO history_fts (rowid, {', '.join(SEARCH_COLUMNS)}) VALUES (?, ?, ?, ?, ?)",
+            (seq,) + search_document(entry)
+        )
+
+    @staticmethod
+    def _derived_columns(entry: Dict) -> Tuple:
+        return (
+            1 if entry.get('has_reference') else 0,
+            int(entry.get('total') or len(entry.get('prompts') or [])),
+            int(entry.get('success_count') or 0),
+            json.dumps(summarize_entry(entry), ensure_ascii=False),
+        )
+
+    def _insert(self, conn: sqlite3.Connection, entry: Dict):
+        # ลบแถวเดิม (trigger ลบออกจาก FTS index ด้วย)
+        conn.execute("DELETE FROM history WHERE id = ?", (entry['id'],))
+        cursor = conn.execute(
+            "INSERT INTO history (id, created_at, status, model, data, has_reference, total, success_count, summary)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (entry['id'], entry.get('created_at'), entry.get('status'), entry.get('model'),
+             json.dumps(entry, ensure_ascii=False)) + self._derived_columns(entry)
+        )
+        if self.fts_enabled:
+            self._index(conn, cursor.lastrowid, entry)
+
+    def _trim(self, conn: sqlite3.Connection):
+        if self.max_jobs > 0:
+            conn.execute(
+                "DELETE FROM history WHERE seq NOT IN (SELECT seq FROM history ORDER BY seq DESC LIMIT ?)",
+                (self.max_jobs,)
+            )
+
+    def add(self, entry: Dict) -> None:
+        """เพิ่ม job (ใหม่สุด) - ถ้ามี id เดิมอยู่แล้วแทนที่"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert(conn, entry)
+            self._trim(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._conn().execute("SELECT data FROM history WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list(self, limit: Optional[int] = None) -> List[Dict]:
+        """job ทั้งหมด ใหม่สุดก่อน"""
+        rows = self._conn().execute(
+            "SELECT data FROM history ORDER BY seq DESC LIMIT ?", (-1 if limit is None else limit,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    @staticmethod
+    def _filters(status: Optional[str] = None, model: Optional[str] = None, since: Optional[str] = None,
+                 until: Optional[str] = None, has_reference: Optional[bool] = None) -> Tuple[List[str], List]:
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if model:
+            clauses.append("model = ?")
+            params.append(model)
+        if since:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until:
+            clauses.append("created_at < ?")
+            params.append(until)
+        if has_reference is not None:
+            clauses.append("has_reference = ?")
+            params.append(1 if has_reference else 0)
+        return clauses, params
+
+    def page(self, cursor: Optional[int] = None, limit: int = 50, summary: bool = False,
+             **filters) -> Tuple[List[Dict], Optional[int]]:
+        """
+        1 หน้าของ history ใหม่สุดก่อน
+
+        Args:
+            cursor: next_cursor จากหน้าก่อน (None = หน้าแรก)
+            limit: จำนวน job ต่อหน้า
+            summary: True = ใช้ projection แบบย่อ (ไม่มี prompts / results)
+            **filters: status, model, since / until (ISO, until ไม่รวม), has_reference
+
+        Returns:
+            (jobs, next_cursor) - next_cursor เป็น None เมื่อหมดแล้ว
+        """
+        clauses, params = self._filters(**filters)
+        if cursor is not None:
+            clauses.append("seq < ?")
+            params.append(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        column = "summary" if summary else "data"
+        rows = self._conn().execute(
+            f"SELECT seq, {column} FROM history {where} ORDER BY seq DESC LIMIT ?", params + [limit + 1]
+        ).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [json.loads(row[1]) for row in rows[:limit]], next_cursor
+
+    def totals(self, **filters) -> Dict:
+        """จำนวน job / prompt / รูปที่สำเร็จ ของ history ที่ตรง filter"""
+        clauses, params = self._filters(**filters)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        jobs, prompts, images = self._conn().execute(
+            f"SELECT COUNT(*), COALESCE(SUM(total), 0), COALESCE(SUM(success_count), 0) FROM history {where}",
+            params
+        ).fetchone()
+        return {'jobs': jobs, 'prompts': prompts, 'images': images}
+
+    def search(self, query: str, limit: int = 20, summary: bool = True) -> List[Dict]:
+        """
+        ค้นหา job จาก prompts / master_prompts / suffix / prompt ต่อรูป
+        ทุกคำใน query ต้องตรง (คำสุดท้ายตรงแบบ prefix) เรียงตาม bm25 แล้วใหม่สุดก่อน
+
+        Returns:
+            list ของ job (summary หรือ entry เต็ม) แต่ละอันมี 'score' (ยิ่งน้อยยิ่งตรง, None ถ้าไม่มี FTS5)
+            และ 'match' (ข้อความรอบคำที่เจอ)
+        """
+        terms = search_terms(query)
+        if not terms:
+            return []
+        column = "summary" if summary else "data"
+        conn = self._conn()
+        if self.fts_enabled:
+            match = " ".join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+            rows = conn.execute(
+                f"SELECT h.{column}, bm25(history_fts), snippet(history_fts, -1, '[', ']', '…', 12)"
+                f" FROM history_fts JOIN history h ON h.seq = history_fts.rowid"
+                f" WHERE history_fts MATCH ? ORDER BY bm25(history_fts), h.seq DESC LIMIT ?",
+                (match.strip(), limit)
+            ).fetchall()
+        else:
+            # ไม่มี FTS5: scan ทั้งตาราง (LIKE ไม่สนตัวพิมพ์เล็กใหญ่เฉพาะ ASCII)
+            clauses = " AND ".join("data LIKE ?" for _ in terms)
+            rows = conn.execute(
+                f"SELECT {column}, NULL, NULL FROM history WHERE {clauses} ORDER BY seq DESC LIMIT ?",
+                [f"%{term}%" for term in terms] + [limit]
+            ).fetchall()
+        jobs = []
+        for data, score, snippet in rows:
+            job = json.loads(data)
+            job['score'] = round(score, 6) if score is not None else None
+            job['match'] = snippet
+            jobs.append(job)
+        return jobs
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def delete(self, job_id: str) -> bool:
+        """ลบ job - return False ถ้าไม่เจอ"""
+        cursor = self._conn().execute("DELETE FROM history WHERE id = ?", (job_id,))
+        return cursor.rowcount > 0
+
+    def clear(self) -> None:
+        self._conn().execute("DELETE FROM history")
+
+    def import_json(self, json_path: str) -> int:
+        """
+        ย้าย history จากไฟล์ JSON เดิม (list ใหม่สุดก่อน) ถ้ายังไม่เคยย้าย
+        เปลี่ยนชื่อไฟล์เดิมเป็น .migrated เมื่อเสร็จ - return จำนวน job ที่ย้าย
+        """
+        if not os.path.exists(json_path):
+            return 0
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"[History] Failed to read {json_path}: {e}")
+            return 0
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            imported = 0
+            # เพิ่มจากเก่าสุดไปใหม่สุด ให้ seq เรียงเหมือนเดิม
+            for entry in reversed(entries if isinstance(entries, list) else []):
+                if isinstance(entry, dict) and entry.get('id'):
+                    self._insert(conn, entry)
+                    imported += 1
+            self._trim(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        try:
+            os.replace(json_path, json_path + '.migrated')
+        except OSError:
+            pass
+        print(f"[History] Imported {imported} jobs from {json_path}")
+        return imported
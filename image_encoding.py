@@ -0,0 +1,166 @@
+"""
+Image Encoding Module
+แปลงรูปจาก model เป็น format ที่ job ขอ (png / webp / jpeg / avif)
+encode ใน ProcessPoolExecutor ของ process นั้น - งาน CPU ของ PIL ไม่แย่ง GIL กับ Flask / engine loop
+ถ้ารูปเป็น format ที่ต้องการอยู่แล้ว ใช้ bytes เดิมเลย ไม่ decode / encode ซ้ำ
+thumbnail (WebP ขนาดเล็ก) สำหรับ gallery / history ก็สร้างใน pool เดียวกัน
+"""
+
+import asyncio
+import atexit
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
+from PIL import Image, features
+
+# format -> (ชื่อ format ของ PIL, นามสกุลไฟล์, mime type)
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png", "image/png"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "avif": ("AVIF", ".avif", "image/avif"),
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+# นามสกุลของรูปที่ระบบสร้าง (ใช้ตอน cleanup / นับไฟล์)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".avif")
+DEFAULT_QUALITY = 85
+# thumbnail: ด้านยาวสุด (px) และ quality ของ WebP
+THUMBNAIL_SIZE = 384
+THUMBNAIL_QUALITY = 75
+
+# magic bytes ของ format ที่ model ส่งกลับมาได้
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+)
+
+# จำนวน process ที่ใช้ encode (0 = encode ใน thread ของ process นี้)
+ENCODE_WORKERS = int(os.getenv('ENCODE_WORKERS', '2'))
+
+_lock = threading.Lock()
+_pool = None
+_pool_pid = None
+
+
+def normalize_output_format(value: Optional[str]) -> Optional[str]:
+    """ชื่อ format มาตรฐาน ('jpg' -> 'jpeg') หรือ None ถ้าไม่รองรับ"""
+    value = (value or "").strip().lower()
+    value = FORMAT_ALIASES.get(value, value)
+    return value if value in OUTPUT_FORMATS else None
+
+
+@lru_cache(maxsize=None)
+def is_format_supported(output_format: str) -> bool:
+    """Pillow build นี้ encode format นี้ได้หรือไม่ (AVIF ต้องมี libavif - wheel บางรุ่นไม่มี)"""
+    if output_format == "avif":
+        return features.check("avif")
+    return output_format in OUTPUT_FORMATS
+
+
+def output_extension(output_format: str) -> str:
+    return OUTPUT_FORMATS[output_format][1]
+
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """Format จริงของรูปจาก magic bytes ('png' / 'jpeg' / 'webp' / 'avif') หรือ None ถ้าไม่รู้จัก"""
+    for signature, image_format in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[4:12] in (b"ftypavif", b"ftypavis"):
+        return "avif"
+    return None
+
+
+def encode_image(data: bytes, output_format: str = "png", quality: int = DEFAULT_QUALITY) -> bytes:
+    """Encode รูปเป็น output_format (รันใน process pool ได้ - ไม่มี state)"""
+    if sniff_image_format(data) == output_format:
+        return data
+    pil_format = OUTPUT_FORMATS[output_format][0]
+    image = Image.open(io.BytesIO(data))
+    options = {}
+    if output_format == "jpeg":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        options = {"quality": quality, "optimize": True}
+    elif output_format in ("webp", "avif"):
+        options = {"quality": quality}
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def thumbnail_filename(filename: str) -> str:
+    """ชื่อไฟล์ thumbnail ของรูป (ชื่อเดิม นามสกุล .webp)"""
+    return f"{os.path.splitext(filename)[0]}.webp"
+
+
+def make_thumbnail(data: bytes, size: int = THUMBNAIL_SIZE, quality: int = THUMBNAIL_QUALITY) -> bytes:
+    """ย่อรูปให้ด้านยาวสุดไม่เกิน size แล้ว encode เป็น WebP"""
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (size, size))  # JPEG: decode ที่ขนาดเล็กเลย
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.save(buffer, "WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def _pool_context():
+    """
+    start method ของ worker ใน pool - ห้าม fork: process แม่มีหลาย thread (gthread, engine loop, gRPC)
+    fork ตอนนั้นอาจติด lock ที่ thread อื่นถืออยู่ค้างไปทั้ง child
+    forkserver import __main__ ครั้งเดียวใน server - worker ที่ fork จาก server ไม่ต้องรัน __main__ ซ้ำทุกตัว
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["__main__", __name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def get_encode_pool() -> Optional[ProcessPoolExecutor]:
+    """ProcessPoolExecutor ของ process นี้ (สร้างใหม่ถ้า process ถูก fork มา) หรือ None ถ้าปิดไว้"""
+    global _pool, _pool_pid
+    if ENCODE_WORKERS <= 0:
+        return None
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=ENCODE_WORKERS, mp_context=_pool_context())
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@atexit.register
+def shutdown_encode_pool():
+    """ปิด pool ของ process นี้ตอนออก (worker ของ forkserver ไม่ตายตาม process แม่เอง)"""
+    global _pool
+    with _lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+async def encode_image_async(data: bytes, output_format: str = "png", quality: int = DEFAULT_QUALITY) -> bytes:
+    """encode_image บน engine loop - ส่งไป process pool เฉพาะเมื่อต้อง transcode จริง"""
+    if sniff_image_format(data) == output_format:
+        return data
+    pool = get_encode_pool()
+    if pool is None:
+        return await asyncio.to_thread(encode_image, data, output_format, quality)
+    return await asyncio.get_running_loop().run_in_executor(pool, encode_image, data, output_format, quality)
+
+
+async def make_thumbnail_async(data: bytes, size: int = THUMBNAIL_SIZE, quality: int = THUMBNAIL_QUALITY) -> bytes:
+    """make_thumbnail บน engine loop (process pool)"""
+    pool = get_encode_pool()
+    if pool is None:
+        return await asyncio.to_thread(make_thumbnail, data, size, quality)
+    return await asyncio.get_running_loop().run_in_executor(pool, make_thumbnail, data, size, quality)
@@ -3,15 +3,27 @@ Image Generator Module
 ใช้ Google Gemini API (Nano Banana models) สำหรับสร้างรูปภาพจาก text prompts
 """
 
+import asyncio
 import os
+import tempfile
 import time
-import io
-import base64
+from contextlib import nullcontext
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
-from typing import List, Dict, Callable, Optional
-from PIL import Image
-import google.generativeai as genai
+from typing import Awaitable, Callable, Dict, List, Optional
+from circuit_breaker import CallAttempt, CircuitBreakers, CircuitOpenError
+from client_pool import ClientPool, default_client_pool
+from concurrency import ConcurrencyLimiters
+from engine_loop import inflight_calls, run_sync
+from gemini_errors import SafetyBlockedError, is_retryable_error, response_block_reason
+from image_encoding import (
+    DEFAULT_QUALITY, IMAGE_EXTENSIONS, THUMBNAIL_SIZE, encode_image_async, make_thumbnail_async,
+    normalize_output_format, output_extension, sniff_image_format, thumbnail_filename
+)
+from model_router import ModelRouter
+from rate_limit import RateLimiter, RateLimitTimeoutError
+from result_cache import ResultCache, link_or_copy, reference_digest, result_cache_key
+from retry_policy import RetryBudget, RetryPolicy, default_retry_policy
+from shared_cache import SharedCache
 
 # Aspect ratio prompt prefixes (shared - avoid duplication)
 ASPECT_RATIO_PREFIXES = {
@@ -26,6 +38,12 @@ ASPECT_RATIO_PREFIXES = {
     "4:5": "Create an image in 4:5 almost square portrait aspect ratio. "
 }
 
+# ความถี่ในการเช็คว่าผู้ใช้กดยกเลิก job หรือไม่ (วินาที)
+CANCEL_POLL_SECONDS = 1.0
+
+# งานเบื้องหลัง (thumbnail / result cache) ที่กำลังวิ่งบน engine loop - เก็บ reference ไว้ไม่ให้ task ถูก GC ก่อนเสร็จ
+_background_tasks = set()
+
 
 def get_aspect_ratio_prefix(aspect_ratio: str) -> str:
     """Return prompt prefix for aspect ratio, or empty string for 1:1."""
@@ -34,73 +52,471 @@ def get_aspect_ratio_prefix(aspect_ratio: str) -> str:
     return ASPECT_RATIO_PREFIXES.get(aspect_ratio, f"Create an image in {aspect_ratio} aspect ratio. ")
 
 
-class ImageGenerator:
-    """Class สำหรับจัดการการสร้างรูปภาพด้วย Google Gemini API"""
+def validate_model_aspect_ratio(model: str, aspect_ratio: str) -> Optional[str]:
+    """Non-Pro image model only supports the default square aspect ratio."""
+    if model != AsyncImageGenerator.MODEL_NANO_BANANA_PRO and aspect_ratio != "1:1":
+        return "Aspect ratio other than 1:1 requires Nano Banana Pro"
+    return None
+
+
+def write_file_atomic(filepath: str, data: bytes):
+    """เขียนไฟล์ชั่วคราวใน directory เดียวกันแล้ว os.replace - ไม่มีใครเห็นไฟล์ที่เขียนไม่ครบ"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".", prefix=".tmp_", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _read_file(filepath: str) -> bytes:
+    with open(filepath, "rb") as f:
+        return f.read()
+
+
+def dedupe_indexes(keys: List[str]) -> Dict[int, List[int]]:
+    """index แรกของแต่ละ key -> index อื่นที่ key ซ้ำกัน (เฉพาะ key ที่ซ้ำ)"""
+    first: Dict[str, int] = {}
+    duplicates: Dict[int, List[int]] = {}
+    for idx, key in enumerate(keys):
+        if key in first:
+            duplicates.setdefault(first[key], []).append(idx)
+        else:
+            first[key] = idx
+    return duplicates
+
+
+def variant_numbers(keys: List[str]) -> List[int]:
+    """ลำดับที่ key นั้นปรากฏซ้ำ (0, 1, 2, ...) ของแต่ละ index"""
+    seen: Dict[str, int] = {}
+    numbers = []
+    for key in keys:
+        numbers.append(seen.get(key, 0))
+        seen[key] = numbers[-1] + 1
+    return numbers
+
+
+def compose_prompt(prompt: str, master_prompts: str = "", suffix: str = "", negative_prompts: str = "",
+                   aspect_ratio: str = "1:1", hint: str = "") -> str:
+    """ประกอบ prompt เต็ม: hint + aspect prefix + master + prompt + suffix + ', avoid: ...'"""
+    full_prompt = f"{hint}{get_aspect_ratio_prefix(aspect_ratio or '1:1')}{master_prompts}{prompt}{suffix}"
+    if negative_prompts:
+        full_prompt += f", avoid: {negative_prompts}"
+    return full_prompt.strip()
+
+
+class AsyncImageGenerator:
+    """
+    Engine แบบ asyncio สำหรับสร้างรูปด้วย Gemini
+    event loop เดียวคุม request ที่วิ่งพร้อมกันได้จำนวนมาก (ไม่ใช้ thread ต่อรูป)
+    timeout ใช้ asyncio.wait_for ซึ่ง cancel call ที่ค้างจริง ไม่ทิ้งเป็น thread ค้าง
+    """
 
     # Model options
     MODEL_NANO_BANANA = "models/gemini-2.5-flash-image"
     MODEL_NANO_BANANA_PRO = "models/gemini-3-pro-image-preview"
-    
-    def __init__(self, api_key: str, output_dir: str = "static/generated"):
+    MODEL_ANALYZE = "models/gemini-2.5-flash"  # ใช้จำแนกประเภท reference image
+
+    ANALYZE_TIMEOUT = 30  # timeout ของ call วิเคราะห์ประเภท reference (วินาที)
+
+    def __init__(
+        self,
+        api_key: str,
+        output_dir: str = "static/generated",
+        call_gate: Optional[Callable] = None,
+        client_pool: Optional[ClientPool] = None,
+        concurrency_limiters: Optional[ConcurrencyLimiters] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        circuit_breakers: Optional[CircuitBreakers] = None,
+        model_router: Optional[ModelRouter] = None,
+        allow_model_fallback: bool = False,
+        output_format: str = "png",
+        output_quality: int = DEFAULT_QUALITY,
+        thumbnail_dir: Optional[str] = None,
+        thumbnail_size: int = THUMBNAIL_SIZE,
+        result_cache: Optional[ResultCache] = None
+    ):
         """
-        Initialize Image Generator
-        
         Args:
             api_key: Google Gemini API key
             output_dir: โฟลเดอร์สำหรับเก็บรูปที่สร้าง
+            call_gate: factory ของ async context manager ที่ครอบทุก API call
+                       (เช่น GenerationScheduler.call_slot) ใช้จำกัดจำนวน call พร้อมกันรวมทุก job
+            client_pool: pool ของ client แยกตาม API key (default: pool กลางของ process)
+            concurrency_limiters: AIMD limiter ต่อ (key, model) - ปรับจำนวน call พร้อมกันตาม 429/503
+                                  (None = ไม่จำกัดเพิ่ม)
+            retry_policy: นโยบาย retry (default: policy กลางที่ตั้งค่าผ่าน env)
+            rate_limiter: token bucket ต่อ (key, model) - ทุก call รอ token ก่อน (None = ไม่จำกัดอัตรา)
+            circuit_breakers: circuit breaker ต่อ (key, model) - fail ทันทีเมื่อ model ล่ม (None = ไม่ใช้)
+            model_router: เก็บ latency / error rate ของแต่ละ model และเลือก model สำรองเมื่อ model หลักมีปัญหา
+            allow_model_fallback: ให้ router ส่ง prompt ไป model สำรองได้ (opt-in ต่อ job)
+            output_format: format ของไฟล์รูป ('png' / 'webp' / 'jpeg' / 'avif')
+            output_quality: quality ของ format แบบ lossy (1-100)
+            thumbnail_dir: โฟลเดอร์ของ thumbnail WebP ที่สร้างเบื้องหลังหลังบันทึกรูป (None = ไม่สร้าง)
+            thumbnail_size: ด้านยาวสุดของ thumbnail (px)
+            result_cache: cache ผลลัพธ์แบบ content-addressed - request ที่เหมือนกันใช้รูปเดิมแทนการเรียก API (None = ไม่ใช้)
         """
         self.api_key = api_key
         self.output_dir = output_dir
-        self.client = None
-        
-        # สร้างโฟลเดอร์ถ้ายังไม่มี
+        self.call_gate = call_gate or nullcontext
+        self.client_pool = client_pool or default_client_pool
+        self.concurrency_limiters = concurrency_limiters
+        self.retry_policy = retry_policy or default_retry_policy
+        self.rate_limiter = rate_limiter
+        self.circuit_breakers = circuit_breakers
+        self.model_router = model_router
+        self.allow_model_fallback = allow_model_fallback
+        self.output_format = normalize_output_format(output_format)
+        if self.output_format is None:
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.output_quality = max(1, min(100, int(output_quality)))
+        self.thumbnail_dir = thumbnail_dir
+        self.thumbnail_size = thumbnail_size
+        self.result_cache = result_cache
+        self.client = self.client_pool.get(api_key)
         os.makedirs(output_dir, exist_ok=True)
-        
-        # Initialize client
-        self._init_client()
-    
-    def _init_client(self):
-        """Initialize Google GenAI client"""
+        if thumbnail_dir:
+            os.makedirs(thumbnail_dir, exist_ok=True)
+
+    @staticmethod
+    def _placeholder(status: str, prompt: str, model: str, error: str) -> Dict:
+        """ผลลัพธ์ของรูปที่ไม่ได้ generate (timeout / cancelled)"""
+        return {
+            "status": status,
+            "prompt": prompt,
+            "filename": None,
+            "error": error,
+            "model": model,
+            "timestamp": datetime.now().isoformat()
+        }
+
+    def _get_reference_type_hint(self, reference_type: str) -> str:
+        """Get prompt hint based on reference type."""
+        hints = {
+            "person": "Keep the same person and face as in the reference image; pose and body position may change according to the prompt. ",
+            "animal": "Keep exactly the same creature as in the reference image. ",
+            "object": "Keep exactly the same object as in the reference image. "
+        }
+        return hints.get(reference_type, "")
+
+    def _output_path(self, filename_prefix: str, image_format: Optional[str] = None):
+        """ชื่อ / path ของไฟล์ผลลัพธ์ใหม่ (default: output_format) - return (filename, filepath)"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        filename = f"{filename_prefix}_{timestamp}{output_extension(image_format or self.output_format)}"
+        return filename, os.path.join(self.output_dir, filename)
+
+    def _save_image(self, image_data: bytes, filename_prefix: str, image_format: Optional[str] = None):
+        """เขียนรูป (encode เป็น image_format แล้ว) ลง disk แบบ atomic - return (filename, filepath)"""
+        filename, filepath = self._output_path(filename_prefix, image_format)
+        write_file_atomic(filepath, image_data)
+        return filename, filepath
+
+    def _link_image(self, source_path: str, filename_prefix: str):
+        """Hardlink รูปที่มีอยู่แล้ว (result cache / รูปของ prompt ซ้ำ) เป็นไฟล์ผลลัพธ์ใหม่ - return (filename, filepath)"""
+        filename, filepath = self._output_path(filename_prefix)
+        link_or_copy(source_path, filepath)
+        # hardlink ใช้ inode (และ mtime) เดียวกับไฟล์เดิม - ตั้ง mtime เป็นตอนนี้ ไม่ให้ auto-cleanup (ตัดสินจาก mtime)
+        # ลบรูปที่เพิ่งได้ไปเหมือนเป็นรูปเก่า
+        os.utime(filepath)
+        return filename, filepath
+
+    def _circuit_guard(self, model: str, deadline: Optional[float]):
+        """circuit breaker ของ (key, model) นี้ - raise CircuitOpenError ถ้าวงจรเปิด"""
+        if self.circuit_breakers is None:
+            return nullcontext(CallAttempt())
+        return self.circuit_breakers.guard(self.api_key, model, deadline)
+
+    def _concurrency_slot(self, model: str):
+        """call gate ของ process + slot ของ adaptive limiter สำหรับ (key, model) นี้ (ได้ gate ก่อน slot)"""
+        if self.concurrency_limiters is None:
+            return self.call_gate()
+        return self.concurrency_limiters.slot(self.api_key, model, self.call_gate)
+
+    def _route(self, model: str, aspect_ratio: str):
+        """เลือก model ของ call ถัดไป - return (model, เหตุผลที่ fallback หรือ None)"""
+        if self.model_router is None or not self.allow_model_fallback:
+            return model, None
+        return self.model_router.choose(self.api_key, model, aspect_ratio)
+
+    def _observe(self, model: str, started: float, success: bool):
+        if self.model_router is not None:
+            self.model_router.observe(self.api_key, model, time.monotonic() - started, success)
+
+    async def _call_model(self, model: str, contents, deadline: Optional[float]):
+        """
+        เรียก generate_content_async 1 ครั้ง ผ่านทุกด่าน:
+        circuit breaker -> rate limit (token bucket) -> call gate ของ process -> adaptive concurrency
+        latency / ผลของ call ถูกส่งให้ model_router (error ถาวรไม่นับเป็นปัญหาของ model)
+        """
+        generation_model = self.client.generative_model_async(model)
+        async with self._circuit_guard(model, deadline) as attempt:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(self.api_key, model, deadline)
+            try:
+                async with self._concurrency_slot(model):
+                    started = time.monotonic()
+                    attempt.mark_sent()
+                    try:
+                        response = await generation_model.generate_content_async(
+                            contents, request_options=self._request_options(deadline)
+                        )
+                    except asyncio.CancelledError:
+                        if deadline is not None and time.monotonic() >= deadline - 0.05:
+                            self._observe(model, started, False)
+                        raise
+                    except Exception as e:
+                        self._observe(model, started, not is_retryable_error(e))
+                        raise
+                    self._observe(model, started, True)
+                    return response
+            except asyncio.CancelledError:
+                if self.rate_limiter is not None and not attempt.sent:
+                    # ได้ token แล้วแต่ถูกยกเลิกระหว่างรอ slot - คืน token ที่ไม่ได้ใช้
+                    await asyncio.shield(asyncio.to_thread(self.rate_limiter.refund, self.api_key, model))
+                raise
+
+    @staticmethod
+    def _request_options(deadline: Optional[float]) -> Dict:
+        """
+        Options ที่ส่งลง transport: ปิด retry ซ่อนของ SDK (retry ทำเองใน _generate)
+        และตั้ง timeout ของ RPC ให้ตรงกับเวลาที่เหลือก่อน deadline
+        """
+        options = {"retry": None}
+        if deadline is not None:
+            options["timeout"] = max(0.1, deadline - time.monotonic())
+        return options
+
+    async def _save_image_guarded(self, image_data: bytes, filename_prefix: str):
+        """
+        Encode เป็น output_format (process pool - ข้ามถ้าเป็น format นั้นอยู่แล้ว) แล้วบันทึกใน thread
+        encode ไม่ได้ (เช่น Pillow ไม่มี encoder) บันทึกเป็น format เดิมจาก model แทน - ไม่ทิ้งรูปที่จ่ายเงินไปแล้ว
+        ถ้า call ถูกยกเลิกระหว่างบันทึก ลบไฟล์ทิ้ง ไม่ให้เหลือรูปกำพร้า
+        """
+        image_format = self.output_format
         try:
-            genai.configure(api_key=self.api_key)
-            self.client = genai
+            image_data = await encode_image_async(image_data, self.output_format, self.output_quality)
         except Exception as e:
-            raise ValueError(f"Failed to initialize Gemini API client: {str(e)}") from e
-    
-    def analyze_reference_type(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
+            image_format = sniff_image_format(image_data)
+            if image_format is None:
+                raise
+            print(f"[ImageGen] Encode to {self.output_format} failed, keeping {image_format}: {e}")
+        save = asyncio.ensure_future(asyncio.to_thread(self._save_image, image_data, filename_prefix, image_format))
+
+        def discard_saved_file(fut):
+            if not fut.cancelled() and fut.exception() is None:
+                try:
+                    os.remove(fut.result()[1])
+                except OSError:
+                    pass
+
+        try:
+            return await asyncio.shield(save)
+        except asyncio.CancelledError:
+            save.add_done_callback(discard_saved_file)
+            raise
+
+    def _start_thumbnail(self, image_data: bytes, filename: str) -> Optional[str]:
+        """
+        สร้าง thumbnail เบื้องหลัง (ไม่รอ) - return ชื่อไฟล์ thumbnail หรือ None ถ้าปิดไว้
+        ถ้ามีคนขอ thumbnail ก่อนสร้างเสร็จ route ฝั่ง app สร้างจากรูปเต็มให้แทน
+        """
+        if not self.thumbnail_dir:
+            return None
+        thumb_name = thumbnail_filename(filename)
+        task = asyncio.ensure_future(
+            self._write_thumbnail(image_data, os.path.join(self.thumbnail_dir, thumb_name))
+        )
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        return thumb_name
+
+    async def _write_thumbnail(self, image_data: bytes, thumb_path: str):
+        try:
+            thumbnail = await make_thumbnail_async(image_data, self.thumbnail_size)
+            await asyncio.to_thread(write_file_atomic, thumb_path, thumbnail)
+        except Exception as e:
+            print(f"[ImageGen] Thumbnail failed ({os.path.basename(thumb_path)}): {e}")
+
+    async def _load_cached(self, cache_key: str, result: Dict, filename_prefix: str, model: str) -> bool:
+        """
+        ใช้รูปจาก result cache ถ้ามี - format ตรงกัน hardlink ไฟล์เลย ไม่ตรง encode ใหม่จาก bytes ใน cache
+        return False ถ้าไม่มีใน cache หรืออ่านไม่ได้ (ไปเรียก API ตามปกติ)
+        """
+        try:
+            cached = await asyncio.to_thread(self.result_cache.get, cache_key)
+            if cached is None:
+                return False
+            cache_path, cached_format = cached
+            image_data = None
+            if cached_format != self.output_format or self.thumbnail_dir:
+                image_data = await asyncio.to_thread(_read_file, cache_path)
+            if cached_format == self.output_format:
+                filename, filepath = await asyncio.to_thread(self._link_image, cache_path, filename_prefix)
+            else:
+                filename, filepath = await self._save_image_guarded(image_data, filename_prefix)
+        except Exception as e:
+            print(f"[ImageGen] Result cache read failed, generating instead: {e}")
+            return False
+        result.update(status="completed", error=None, filename=filename, filepath=filepath,
+                      model=model, requested_model=model, fallback=False, cached=True)
+        thumbnail = self._start_thumbnail(image_data, filename) if image_data is not None else None
+        if thumbnail:
+            result["thumbnail"] = thumbnail
+        return True
+
+    def _start_cache_store(self, cache_key: str, image_data: bytes, model: str, filepath: str):
+        """เก็บรูปดิบที่เพิ่ง generate ลง result cache เบื้องหลัง (ไม่รอ)"""
+        # ถ้าไฟล์ผลลัพธ์เป็น bytes เดียวกัน (ไม่ได้ transcode) hardlink แทนการเขียนซ้ำ
+        source_path = filepath if sniff_image_format(image_data) == self.output_format else None
+        task = asyncio.ensure_future(self._store_in_cache(cache_key, image_data, model, source_path))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    async def _store_in_cache(self, cache_key: str, image_data: bytes, model: str, source_path: Optional[str]):
+        try:
+            await asyncio.to_thread(self.result_cache.put, cache_key, image_data, model, source_path)
+        except Exception:
+            try:
+                # ไฟล์ผลลัพธ์อาจถูกลบไปก่อน - เขียน bytes ลง cache แทน
+                await asyncio.to_thread(self.result_cache.put, cache_key, image_data, model)
+            except Exception as e:
+                print(f"[ImageGen] Result cache store failed: {e}")
+
+    async def _generate(self, model: str, contents, result: Dict, filename_prefix: str, log_tag: str = "",
+                        deadline: Optional[float] = None, retry_budget: Optional[RetryBudget] = None,
+                        aspect_ratio: str = "1:1", cache_key: Optional[str] = None) -> Dict:
+        """
+        เรียก generate_content_async พร้อม retry ตาม retry_policy แล้วบันทึกรูปแรกที่ได้
+        deadline (time.monotonic) ถูกส่งลง transport และหยุด retry เมื่อเวลาไม่พอ
+        retry_budget (ถ้ามี) คือ retry ที่เหลือของทั้ง job
+        ทุก attempt เลือก model ผ่าน router (ถ้าเปิด fallback) - result["model"] คือ model ที่ใช้จริง
+        cache_key (ถ้ามี result cache): hit แล้วไม่เรียก API เลย (result["cached"] = True)
+        ผลที่ได้จาก model ที่ขอจริง (ไม่ใช่ fallback) ถูกเก็บลง cache
+        """
+        if cache_key and self.result_cache is not None:
+            if await self._load_cached(cache_key, result, filename_prefix, model):
+                return result
+
+        policy = self.retry_policy
+        image_data = None
+
+        for attempt in range(policy.max_attempts):
+            call_model, fallback_reason = self._route(model, aspect_ratio)
+            result["model"] = call_model
+            result["requested_model"] = model
+            result["fallback"] = call_model != model
+            if fallback_reason:
+                result["fallback_reason"] = fallback_reason
+                print(f"[ImageGen] {model} degraded ({fallback_reason}), using {call_model}{log_tag}")
+            else:
+                result.pop("fallback_reason", None)
+            try:
+                response = await self._call_model(call_model, contents, deadline)
+                blocked = response_block_reason(response)
+                if blocked:
+                    raise SafetyBlockedError(f"Blocked by safety filters: {blocked}")
+                for part in response.parts or []:
+                    if hasattr(part, 'inline_data') and part.inline_data:
+                        image_data = part.inline_data.data
+                        break
+                if image_data is None:
+                    raise RuntimeError("No image data in response")
+                break
+            except (CircuitOpenError, RateLimitTimeoutError) as e:
+                result["error"] = str(e)
+                break
+            except Exception as e:
+                result["error"] = str(e)
+                print(f"[ImageGen] Attempt {attempt + 1} failed{log_tag}: {e}")
+                delay = policy.next_delay(e, attempt, deadline, retry_budget)
+                if delay is None:
+                    break
+                print(f"[ImageGen] Retry {attempt + 1}/{policy.max_attempts - 1} in {delay:.1f}s{log_tag}...")
+                await asyncio.sleep(delay)
+
+        if image_data is None:
+            result["status"] = "failed"
+            return result
+
+        # encode / เขียนไฟล์นอก event loop ไม่ให้ block call อื่น - อยู่นอก retry:
+        # error ในเครื่อง (encode / disk) เรียก model ซ้ำก็ไม่หาย แค่เสียเงินเพิ่ม
+        try:
+            filename, filepath = await self._save_image_guarded(image_data, filename_prefix)
+        except Exception as e:
+            print(f"[ImageGen] Saving image failed{log_tag}: {e}")
+            result["status"] = "failed"
+            result["error"] = f"Failed to save image: {e}"
+            return result
+        result["status"] = "completed"
+        result["error"] = None
+        result["filename"] = filename
+        result["filepath"] = filepath
+        thumbnail = self._start_thumbnail(image_data, filename)
+        if thumbnail:
+            result["thumbnail"] = thumbnail
+        if cache_key and self.result_cache is not None and result["model"] == model:
+            self._start_cache_store(cache_key, image_data, model, filepath)
+        return result
+
+    async def classify_reference_type(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
+        """จำแนก reference image เป็น person / animal / object - raise ถ้าเรียก API ไม่สำเร็จ"""
+        response = await self._call_model(self.MODEL_ANALYZE, [
+            {"mime_type": mime_type, "data": image_bytes},
+            "Is this image primarily of a person, animal, or object? Reply with exactly one word: person, animal, or object."
+        ], time.monotonic() + self.ANALYZE_TIMEOUT)
+        text = (response.text or "").strip().lower()
+        if "person" in text:
+            return "person"
+        if "animal" in text:
+            return "animal"
+        if "object" in text:
+            return "object"
+        return "object"  # fallback
+
+    async def analyze_reference_type(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
         """
         Analyze an image and return reference type: person, animal, or object.
         Uses Gemini vision model for classification.
         """
         try:
-            model = genai.GenerativeModel("models/gemini-2.5-flash")
-            pil_image = Image.open(io.BytesIO(image_bytes))
-            response = model.generate_content([
-                pil_image,
-                "Is this image primarily of a person, animal, or object? Reply with exactly one word: person, animal, or object."
-            ])
-            text = (response.text or "").strip().lower()
-            if "person" in text:
-                return "person"
-            if "animal" in text:
-                return "animal"
-            if "object" in text:
-                return "object"
-            return "object"  # fallback
+            return await self.classify_reference_type(image_bytes, mime_type)
         except Exception as e:
             print(f"[ImageGen] analyze_reference_type error: {e}")
             return "object"
 
-    def _get_reference_type_hint(self, reference_type: str) -> str:
-        """Get prompt hint based on reference type."""
-        hints = {
-            "person": "Keep the same person and face as in the reference image; pose and body position may change according to the prompt. ",
-            "animal": "Keep exactly the same creature as in the reference image. ",
-            "object": "Keep exactly the same object as in the reference image. "
+    async def generate_single(
+        self,
+        prompt: str,
+        model: str = MODEL_NANO_BANANA,
+        filename_prefix: str = "img",
+        aspect_ratio: str = "1:1",
+        deadline: Optional[float] = None,
+        retry_budget: Optional[RetryBudget] = None,
+        variant: int = 0
+    ) -> Dict:
+        result = {
+            "status": "pending",
+            "prompt": prompt,
+            "filename": None,
+            "error": None,
+            "model": model,
+            "aspect_ratio": aspect_ratio,
+            "timestamp": datetime.now().isoformat()
         }
-        return hints.get(reference_type, "")
+        print(f"[ImageGen] Generating image (aspect_ratio={aspect_ratio}), prompt length={len(prompt)}")
+        cache_key = result_cache_key(prompt, model, aspect_ratio, variant=variant) if self.result_cache is not None else None
+        return await self._generate(
+            model, prompt, result, filename_prefix,
+            deadline=deadline, retry_budget=retry_budget, aspect_ratio=aspect_ratio, cache_key=cache_key
+        )
 
-    def generate_single_with_reference(
+    async def generate_single_with_reference(
         self,
         prompt: str,
         reference_image_bytes: bytes,
@@ -111,11 +527,17 @@ class ImageGenerator:
         aspect_ratio: str = "1:1",
         master_prompts: str = "",
         suffix: str = "",
-        negative_prompts: str = ""
+        negative_prompts: str = "",
+        deadline: Optional[float] = None,
+        retry_budget: Optional[RetryBudget] = None,
+        reference_sha256: Optional[str] = None,
+        variant: int = 0
     ) -> Dict:
         """
         Generate image from text + reference image (image-to-image).
         Sends [image, prompt] to Gemini.
+        reference_sha256: digest ของ reference (batch คำนวณครั้งเดียว) ใช้เป็นส่วนของ result cache key
+        variant: ลำดับของ prompt ซ้ำที่ขอรูปคนละแบบ (แยก result cache key)
         """
         result = {
             "status": "pending",
@@ -126,181 +548,492 @@ class ImageGenerator:
             "timestamp": datetime.now().isoformat()
         }
 
-        generation_model = genai.GenerativeModel(model_name=model)
-        pil_ref = Image.open(io.BytesIO(reference_image_bytes))
-
         hint = self._get_reference_type_hint(reference_type) if reference_type else ""
-        aspect_prefix = get_aspect_ratio_prefix(aspect_ratio or "1:1")
-        full_prompt = f"{hint}{aspect_prefix}{master_prompts}{prompt}{suffix}"
-        if negative_prompts:
-            full_prompt += f", avoid: {negative_prompts}"
-        full_prompt = full_prompt.strip()
-
-        last_error = None
-        for attempt in range(1 + self.MAX_RETRIES):
-            if attempt > 0:
-                print(f"[ImageGen] Retry {attempt}/{self.MAX_RETRIES} (reference)...")
-                time.sleep(self.RETRY_DELAY)
-            try:
-                response = generation_model.generate_content([pil_ref, full_prompt])
-                if response.parts:
-                    for part in response.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            pil_out = Image.open(io.BytesIO(part.inline_data.data))
-                            ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                            filename = f"{filename_prefix}_{ts}.png"
-                            filepath = os.path.join(self.output_dir, filename)
-                            pil_out.save(filepath, "PNG")
-                            result["status"] = "completed"
-                            result["filename"] = filename
-                            result["filepath"] = filepath
-                            return result
-                last_error = "No image data in response"
-            except Exception as e:
-                last_error = str(e)
-                print(f"[ImageGen] Attempt {attempt + 1} failed (reference): {last_error}")
+        full_prompt = compose_prompt(prompt, master_prompts, suffix, negative_prompts, aspect_ratio, hint)
+        # ส่ง bytes เดิมเป็น blob ตรงๆ ไม่ต้อง decode/encode ด้วย PIL ทุก call
+        reference_blob = {"mime_type": mime_type, "data": reference_image_bytes}
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = result_cache_key(
+                full_prompt, model, aspect_ratio,
+                reference_sha256 or reference_digest(reference_image_bytes), reference_type, variant
+            )
+        return await self._generate(
+            model, [reference_blob, full_prompt], result, filename_prefix, " (reference)",
+            deadline=deadline, retry_budget=retry_budget, aspect_ratio=aspect_ratio, cache_key=cache_key
+        )
 
-        result["status"] = "failed"
-        result["error"] = last_error
-        return result
+    async def with_timeout(self, coro: Awaitable[Dict], timeout_seconds: Optional[float], prompt: str, model: str,
+                           job_id: Optional[str] = None) -> Dict:
+        """
+        รอผลไม่เกิน timeout_seconds - ถ้าเกิน call จะถูก cancel และได้ผล failed
+        ถ้าระบุ job_id: /api/cancel ของ job นั้น abort call นี้ได้ทันที (ได้ผล cancelled)
+        """
+        task = asyncio.ensure_future(coro)
+        cancel_requested = False
 
-    MAX_RETRIES = 2  # จำนวนครั้งที่ retry เมื่อ fail (ไม่นับครั้งแรก)
-    RETRY_DELAY = 3  # วินาทีระหว่าง retry
+        def cancel():
+            nonlocal cancel_requested
+            cancel_requested = True
+            task.cancel()
 
-    def generate_single(
+        with inflight_calls.track(job_id, cancel):
+            try:
+                if not timeout_seconds:
+                    return await task
+                return await asyncio.wait_for(task, timeout_seconds)
+            except asyncio.TimeoutError:
+                return self._placeholder("failed", prompt, model, f"Timeout after {timeout_seconds}s")
+            except asyncio.CancelledError:
+                if not cancel_requested:
+                    raise
+                return self._placeholder("cancelled", prompt, model, "Cancelled")
+
+    async def _fan_out_result(self, result: Dict, filename_prefix: str) -> Dict:
+        """
+        ผลของ prompt ซ้ำที่ไม่ได้ generate เอง: สำเนาผลของ index แรก
+        รูปที่สำเร็จได้ไฟล์ของตัวเอง (hardlink - ไม่กินที่เพิ่ม) ลบ / zip แยกกันได้
+        """
+        copy = dict(result, timestamp=datetime.now().isoformat(), deduplicated=True)
+        if result.get("status") != "completed" or not result.get("filepath"):
+            return copy
+        try:
+            filename, filepath = await asyncio.to_thread(self._link_image, result["filepath"], filename_prefix)
+        except Exception as e:
+            return dict(copy, status="failed", filename=None, filepath=None, thumbnail=None,
+                        error=f"Failed to copy duplicate result: {e}")
+        copy.update(filename=filename, filepath=filepath)
+        copy.pop("thumbnail", None)
+        if result.get("thumbnail") and self.thumbnail_dir:
+            # thumbnail ของรูปแรกอาจยังสร้างไม่เสร็จ - ถ้ายังไม่มี route ฝั่ง app สร้างจากรูปเต็มเมื่อถูกขอ
+            copy["thumbnail"] = thumbnail_filename(filename)
+            try:
+                await asyncio.to_thread(
+                    link_or_copy, os.path.join(self.thumbnail_dir, result["thumbnail"]),
+                    os.path.join(self.thumbnail_dir, copy["thumbnail"])
+                )
+            except OSError:
+                pass
+        return copy
+
+    async def _run_batch(
         self,
-        prompt: str,
-        model: str = MODEL_NANO_BANANA,
-        filename_prefix: str = "img",
-        aspect_ratio: str = "1:1"
-    ) -> Dict:
-        result = {
-            "status": "pending",
-            "prompt": prompt,
-            "filename": None,
-            "error": None,
-            "model": model,
-            "aspect_ratio": aspect_ratio,
-            "timestamp": datetime.now().isoformat()
-        }
+        total: int,
+        run_item: Callable[[int, float], Awaitable[Dict]],
+        placeholder_prompt: Callable[[int], str],
+        model: str,
+        concurrency: int,
+        progress_callback: Optional[Callable],
+        cancel_check: Optional[Callable[[], bool]],
+        timeout_seconds: Optional[int],
+        job_id: Optional[str] = None,
+        duplicates: Optional[Dict[int, List[int]]] = None
+    ) -> List[Dict]:
+        """
+        รันทุก item บน event loop โดยจำกัดจำนวนพร้อมกันด้วย semaphore
+        - duplicates (index แรก -> index ที่ prompt ซ้ำกัน): รันเฉพาะ index แรก
+          แล้วกระจายผลไปทุก index ที่ซ้ำ (นับ progress ครบทุก index เหมือนรันเอง)
+        - timeout ต่อรูปด้วย asyncio.wait_for + deadline ที่ส่งลงไปถึง transport และ retry loop
+        - ถ้าผู้ใช้กดยกเลิก (cancel_check หรือ inflight_calls.cancel(job_id)):
+          cancel call ที่ค้างอยู่ แล้วเติมผลที่เหลือเป็น cancelled
+        - progress_callback ถูกเรียกทีละครั้ง (เรียงตามลำดับที่เสร็จ) ใน thread แยก
+        """
+        timeout_sec = timeout_seconds or 120
+        results: List[Optional[Dict]] = [None] * total
+        completed = 0
+        report_lock = asyncio.Lock()
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        cancelled = asyncio.Event()
+        tasks: List[asyncio.Task] = []
+        pending_reports: List[asyncio.Future] = []
 
-        generation_model = genai.GenerativeModel(model_name=model)
-        print(f"[ImageGen] Generating image (aspect_ratio={aspect_ratio}), prompt length={len(prompt)}")
+        def trigger_cancel():
+            cancelled.set()
+            current = asyncio.current_task()
+            for task in tasks:
+                if task is not current:
+                    task.cancel()
 
-        last_error = None
-        for attempt in range(1 + self.MAX_RETRIES):
-            if attempt > 0:
-                print(f"[ImageGen] Retry {attempt}/{self.MAX_RETRIES}...")
-                time.sleep(self.RETRY_DELAY)
-            try:
-                response = generation_model.generate_content(prompt)
-                if response.parts:
-                    for part in response.parts:
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            pil_image = Image.open(io.BytesIO(part.inline_data.data))
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-                            filename = f"{filename_prefix}_{timestamp}.png"
-                            filepath = os.path.join(self.output_dir, filename)
-                            pil_image.save(filepath, "PNG")
-                            result["status"] = "completed"
-                            result["filename"] = filename
-                            result["filepath"] = filepath
-                            return result
-                last_error = "No image data in response"
-            except Exception as e:
-                last_error = str(e)
-                print(f"[ImageGen] Attempt {attempt + 1} failed: {last_error}")
+        async def is_cancelled() -> bool:
+            if not cancelled.is_set() and cancel_check and await asyncio.to_thread(cancel_check):
+                trigger_cancel()
+            return cancelled.is_set()
 
-        result["status"] = "failed"
-        result["error"] = last_error
-        return result
+        async def report(idx: int, result: Dict):
+            nonlocal completed
+            async with report_lock:
+                if results[idx] is not None:
+                    return
+                results[idx] = result
+                completed += 1
+                if progress_callback:
+                    await asyncio.to_thread(progress_callback, completed, total, result)
 
-    def generate_batch_with_reference_sequential(
+        async def report_with_duplicates(idx: int, result: Dict):
+            await report(idx, result)
+            for dup_idx in duplicates.get(idx, ()):
+                await report(dup_idx, await self._fan_out_result(result, f"batch_{dup_idx + 1}"))
+
+        async def run_one(idx: int):
+            async with semaphore:
+                if await is_cancelled():
+                    return
+                deadline = time.monotonic() + timeout_sec
+                try:
+                    result = await asyncio.wait_for(run_item(idx, deadline), timeout_sec)
+                except asyncio.TimeoutError:
+                    result = self._placeholder("failed", placeholder_prompt(idx), model, f"Timeout after {timeout_sec}s")
+                except Exception as e:
+                    result = self._placeholder("failed", placeholder_prompt(idx), model, str(e))
+                # shield: ถ้าถูก cancel ระหว่างบันทึกผล ผลของรูปที่เสร็จแล้วต้องไม่หาย
+                future = asyncio.ensure_future(report_with_duplicates(idx, result))
+                pending_reports.append(future)
+                await asyncio.shield(future)
+                await is_cancelled()
+
+        async def watch_cancel():
+            while not cancelled.is_set():
+                await asyncio.sleep(CANCEL_POLL_SECONDS)
+                await is_cancelled()
+
+        duplicates = duplicates or {}
+        skipped = {dup_idx for dup_indexes in duplicates.values() for dup_idx in dup_indexes}
+        tasks.extend(asyncio.create_task(run_one(idx)) for idx in range(total) if idx not in skipped)
+        watcher = asyncio.create_task(watch_cancel()) if cancel_check else None
+        try:
+            with inflight_calls.track(job_id, trigger_cancel):
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.gather(*pending_reports, return_exceptions=True)
+        finally:
+            if watcher:
+                watcher.cancel()
+
+        # ถ้ายกเลิก: เติมผลลัพธ์ที่ยังไม่มีเป็น cancelled
+        if cancelled.is_set():
+            for idx in range(total):
+                if results[idx] is None:
+                    await report(idx, self._placeholder("cancelled", placeholder_prompt(idx), model, "Cancelled"))
+
+        return results
+
+    async def generate_batch(
+        self,
+        prompts: List[str],
+        model: str = MODEL_NANO_BANANA,
+        concurrency: int = 1,
+        progress_callback: Optional[Callable] = None,
+        master_prompts: str = "",
+        suffix: str = "",
+        negative_prompts: str = "",
+        aspect_ratio: str = "1:1",
+        cancel_check: Optional[Callable[[], bool]] = None,
+        timeout_seconds: Optional[int] = 120,
+        job_id: Optional[str] = None,
+        variations: bool = False
+    ) -> List[Dict]:
+        """
+        Generate หลายรูปจาก text prompts (concurrency=1 คือทีละรูปตามลำดับ)
+        prompt เต็มที่ซ้ำกันเรียก API ครั้งเดียวแล้วใช้ผลร่วมกัน
+        ยกเว้น variations=True (ตั้งใจขอหลายแบบ) - ทุก index generate เองเป็นคนละรูป
+        """
+        full_prompts = [
+            compose_prompt(p, master_prompts, suffix, negative_prompts, aspect_ratio) for p in prompts
+        ]
+        duplicates = None if variations else dedupe_indexes(full_prompts)
+        variants = variant_numbers(full_prompts) if variations else [0] * len(prompts)
+        retry_budget = self.retry_policy.new_budget(len(prompts) - sum(map(len, (duplicates or {}).values())))
+        return await self._run_batch(
+            total=len(prompts),
+            run_item=lambda idx, deadline: self.generate_single(
+                prompt=full_prompts[idx],
+                model=model,
+                filename_prefix=f"batch_{idx + 1}",
+                aspect_ratio=aspect_ratio,
+                deadline=deadline,
+                retry_budget=retry_budget,
+                variant=variants[idx]
+            ),
+            placeholder_prompt=lambda idx: full_prompts[idx],
+            model=model,
+            concurrency=concurrency,
+            progress_callback=progress_callback,
+            cancel_check=cancel_check,
+            timeout_seconds=timeout_seconds,
+            job_id=job_id,
+            duplicates=duplicates
+        )
+
+    async def generate_batch_with_reference(
         self,
         prompts: List[str],
         reference_image_bytes: bytes,
         mime_type: str = "image/jpeg",
         reference_type: str = "",
         model: str = MODEL_NANO_BANANA,
+        concurrency: int = 1,
         progress_callback: Optional[Callable] = None,
         master_prompts: str = "",
         suffix: str = "",
         negative_prompts: str = "",
         aspect_ratio: str = "1:1",
         cancel_check: Optional[Callable[[], bool]] = None,
-        timeout_seconds: Optional[int] = 120
+        timeout_seconds: Optional[int] = 120,
+        job_id: Optional[str] = None,
+        variations: bool = False
     ) -> List[Dict]:
-        """Generate images with reference, sequential."""
-        results = []
-        total = len(prompts)
-        timeout_sec = timeout_seconds or 120
-
-        for idx, prompt in enumerate(prompts, 1):
-            if cancel_check and cancel_check():
-                break
-
-            executor = ThreadPoolExecutor(max_workers=1)
-            future = executor.submit(
-                self.generate_single_with_reference,
-                prompt=prompt,
+        """
+        Generate หลายรูปด้วย reference image (concurrency=1 คือทีละรูปตามลำดับ)
+        prompt ซ้ำกันเรียก API ครั้งเดียว (เหมือน generate_batch) ยกเว้น variations=True
+        """
+        full_prompts = [compose_prompt(p, master_prompts, suffix, negative_prompts) for p in prompts]
+        duplicates = None if variations else dedupe_indexes(full_prompts)
+        variants = variant_numbers(full_prompts) if variations else [0] * len(prompts)
+        retry_budget = self.retry_policy.new_budget(len(prompts) - sum(map(len, (duplicates or {}).values())))
+        reference_sha256 = reference_digest(reference_image_bytes) if self.result_cache is not None else None
+        return await self._run_batch(
+            total=len(prompts),
+            run_item=lambda idx, deadline: self.generate_single_with_reference(
+                prompt=prompts[idx],
                 reference_image_bytes=reference_image_bytes,
                 mime_type=mime_type,
                 reference_type=reference_type,
                 model=model,
-                filename_prefix=f"batch_{idx}",
+                filename_prefix=f"batch_{idx + 1}",
                 aspect_ratio=aspect_ratio,
                 master_prompts=master_prompts,
                 suffix=suffix,
-                negative_prompts=negative_prompts
+                negative_prompts=negative_prompts,
+                deadline=deadline,
+                retry_budget=retry_budget,
+                reference_sha256=reference_sha256,
+                variant=variants[idx]
+            ),
+            placeholder_prompt=lambda idx: full_prompts[idx],
+            model=model,
+            concurrency=concurrency,
+            progress_callback=progress_callback,
+            cancel_check=cancel_check,
+            timeout_seconds=timeout_seconds,
+            job_id=job_id,
+            duplicates=duplicates
+        )
+
+
+class ImageGenerator:
+    """
+    Class สำหรับจัดการการสร้างรูปภาพด้วย Google Gemini API
+    API แบบ sync เดิม - ทุก method ส่งงานไปรันบน AsyncImageGenerator ผ่าน event loop กลาง
+    """
+
+    # Model options
+    MODEL_NANO_BANANA = AsyncImageGenerator.MODEL_NANO_BANANA
+    MODEL_NANO_BANANA_PRO = AsyncImageGenerator.MODEL_NANO_BANANA_PRO
+    MODEL_ANALYZE = AsyncImageGenerator.MODEL_ANALYZE
+
+    def __init__(
+        self,
+        api_key: str,
+        output_dir: str = "static/generated",
+        call_gate: Optional[Callable] = None,
+        client_pool: Optional[ClientPool] = None,
+        concurrency_limiters: Optional[ConcurrencyLimiters] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        circuit_breakers: Optional[CircuitBreakers] = None,
+        model_router: Optional[ModelRouter] = None,
+        allow_model_fallback: bool = False,
+        output_format: str = "png",
+        output_quality: int = DEFAULT_QUALITY,
+        thumbnail_dir: Optional[str] = None,
+        thumbnail_size: int = THUMBNAIL_SIZE,
+        result_cache: Optional[ResultCache] = None,
+        reference_type_cache: Optional[SharedCache] = None
+    ):
+        """
+        Initialize Image Generator
+
+        Args:
+            api_key: Google Gemini API key
+            output_dir: โฟลเดอร์สำหรับเก็บรูปที่สร้าง
+            call_gate: factory ของ async context manager ที่ครอบทุก API call (เช่น GenerationScheduler.call_slot)
+                       ใช้จำกัดจำนวน call ที่วิ่งพร้อมกันรวมทุก job
+            client_pool: pool ของ client แยกตาม API key (default: pool กลางของ process)
+            concurrency_limiters: AIMD limiter ต่อ (key, model) ที่ปรับจำนวน call พร้อมกันตาม 429/503
+            retry_policy: นโยบาย retry (default: policy กลางที่ตั้งค่าผ่าน env)
+            rate_limiter: token bucket ต่อ (key, model) - ทุก call รอ token ก่อน (None = ไม่จำกัดอัตรา)
+            circuit_breakers: circuit breaker ต่อ (key, model) - fail ทันทีเมื่อ model ล่ม (None = ไม่ใช้)
+            model_router: เก็บ latency / error rate ของแต่ละ model และเลือก model สำรองเมื่อ model หลักมีปัญหา
+            allow_model_fallback: ให้ router ส่ง prompt ไป model สำรองได้ (opt-in ต่อ job)
+            output_format: format ของไฟล์รูป ('png' / 'webp' / 'jpeg' / 'avif')
+            output_quality: quality ของ format แบบ lossy (1-100)
+            thumbnail_dir: โฟลเดอร์ของ thumbnail WebP ที่สร้างเบื้องหลังหลังบันทึกรูป (None = ไม่สร้าง)
+            thumbnail_size: ด้านยาวสุดของ thumbnail (px)
+            result_cache: cache ผลลัพธ์แบบ content-addressed - request ที่เหมือนกันใช้รูปเดิมแทนการเรียก API (None = ไม่ใช้)
+            reference_type_cache: cache ผลจำแนกประเภท reference ตาม digest ของรูป (None = เรียก API ทุกครั้ง)
+        """
+        self.api_key = api_key
+        self.output_dir = output_dir
+        self.call_gate = call_gate
+        self.client_pool = client_pool or default_client_pool
+        self.concurrency_limiters = concurrency_limiters
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.circuit_breakers = circuit_breakers
+        self.model_router = model_router
+        self.allow_model_fallback = allow_model_fallback
+        self.output_format = output_format
+        self.output_quality = output_quality
+        self.thumbnail_dir = thumbnail_dir
+        self.thumbnail_size = thumbnail_size
+        self.result_cache = result_cache
+        self.reference_type_cache = reference_type_cache
+        self.client = None
+        self.engine = None
+
+        # สร้างโฟลเดอร์ถ้ายังไม่มี
+        os.makedirs(output_dir, exist_ok=True)
+
+        # Initialize client
+        self._init_client()
+
+    def _init_client(self):
+        """Initialize async engine + client ของ key นี้จาก pool (ไม่แตะ global genai.configure)"""
+        try:
+            self.engine = AsyncImageGenerator(
+                api_key=self.api_key,
+                output_dir=self.output_dir,
+                call_gate=self.call_gate,
+                client_pool=self.client_pool,
+                concurrency_limiters=self.concurrency_limiters,
+                retry_policy=self.retry_policy,
+                rate_limiter=self.rate_limiter,
+                circuit_breakers=self.circuit_breakers,
+                model_router=self.model_router,
+                allow_model_fallback=self.allow_model_fallback,
+                output_format=self.output_format,
+                output_quality=self.output_quality,
+                thumbnail_dir=self.thumbnail_dir,
+                thumbnail_size=self.thumbnail_size,
+                result_cache=self.result_cache
             )
-            result = None
-            chunk_sec = 3
-            waited = 0
-            try:
-                while waited < timeout_sec:
-                    try:
-                        result = future.result(timeout=chunk_sec)
-                        break
-                    except FuturesTimeoutError:
-                        waited += chunk_sec
-                        if cancel_check and cancel_check():
-                            hint = self._get_reference_type_hint(reference_type) if reference_type else ""
-                            full_prompt = f"{hint}{master_prompts}{prompt}{suffix}"
-                            if negative_prompts:
-                                full_prompt += f", avoid: {negative_prompts}"
-                            result = {
-                                "status": "cancelled",
-                                "prompt": full_prompt.strip(),
-                                "filename": None,
-                                "error": "Cancelled",
-                                "model": model,
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            break
-                if result is None:
-                    full_prompt = f"{master_prompts}{prompt}{suffix}"
-                    if negative_prompts:
-                        full_prompt += f", avoid: {negative_prompts}"
-                    result = {
-                        "status": "failed",
-                        "prompt": full_prompt.strip(),
-                        "filename": None,
-                        "error": f"Timeout after {timeout_sec} seconds",
-                        "model": model,
-                        "timestamp": datetime.now().isoformat()
-                    }
-            finally:
-                executor.shutdown(wait=False)
-
-            results.append(result)
-            if progress_callback:
-                progress_callback(len(results), total, result)
-            if cancel_check and cancel_check():
-                break
-            if idx < total:
-                time.sleep(0.5)
+            self.client = self.engine.client
+        except Exception as e:
+            raise ValueError(f"Failed to initialize Gemini API client: {str(e)}") from e
 
-        return results
+    @staticmethod
+    def _deadline(timeout_seconds: Optional[int]) -> Optional[float]:
+        return time.monotonic() + timeout_seconds if timeout_seconds else None
+
+    def analyze_reference_type(self, image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
+        """
+        Analyze an image and return reference type: person, animal, or object.
+        Uses Gemini vision model for classification.
+        ถ้ามี reference_type_cache: รูปเดิม (digest เดียวกัน) ได้ผลจาก cache โดยไม่เรียก API
+        """
+        cache_key = None
+        if self.reference_type_cache is not None:
+            cache_key = f"{self.MODEL_ANALYZE}:{reference_digest(image_bytes)}"
+            cached = self.reference_type_cache.get(cache_key)
+            if cached:
+                return cached
+        try:
+            ref_type = run_sync(self.engine.classify_reference_type(image_bytes, mime_type))
+        except Exception as e:
+            # ผลจาก error (fallback เป็น object) ไม่เก็บลง cache
+            print(f"[ImageGen] analyze_reference_type error: {e}")
+            return "object"
+        if cache_key:
+            self.reference_type_cache.set(cache_key, ref_type)
+        return ref_type
+
+    def generate_single_with_reference(
+        self,
+        prompt: str,
+        reference_image_bytes: bytes,
+        mime_type: str = "image/jpeg",
+        reference_type: str = "",
+        model: str = MODEL_NANO_BANANA,
+        filename_prefix: str = "img",
+        aspect_ratio: str = "1:1",
+        master_prompts: str = "",
+        suffix: str = "",
+        negative_prompts: str = "",
+        timeout_seconds: Optional[int] = None,
+        job_id: Optional[str] = None
+    ) -> Dict:
+        """
+        Generate image from text + reference image (image-to-image).
+        Sends [image, prompt] to Gemini.
+        """
+        coro = self.engine.generate_single_with_reference(
+            prompt=prompt,
+            reference_image_bytes=reference_image_bytes,
+            mime_type=mime_type,
+            reference_type=reference_type,
+            model=model,
+            filename_prefix=filename_prefix,
+            aspect_ratio=aspect_ratio,
+            master_prompts=master_prompts,
+            suffix=suffix,
+            negative_prompts=negative_prompts,
+            deadline=self._deadline(timeout_seconds)
+        )
+        placeholder_prompt = compose_prompt(prompt, master_prompts, suffix, negative_prompts)
+        return run_sync(self.engine.with_timeout(coro, timeout_seconds, placeholder_prompt, model, job_id))
+
+    def generate_single(
+        self,
+        prompt: str,
+        model: str = MODEL_NANO_BANANA,
+        filename_prefix: str = "img",
+        aspect_ratio: str = "1:1",
+        timeout_seconds: Optional[int] = None,
+        job_id: Optional[str] = None
+    ) -> Dict:
+        coro = self.engine.generate_single(
+            prompt=prompt,
+            model=model,
+            filename_prefix=filename_prefix,
+            aspect_ratio=aspect_ratio,
+            deadline=self._deadline(timeout_seconds)
+        )
+        return run_sync(self.engine.with_timeout(coro, timeout_seconds, prompt, model, job_id))
+
+    def generate_batch_with_reference_sequential(
+        self,
+        prompts: List[str],
+        reference_image_bytes: bytes,
+        mime_type: str = "image/jpeg",
+        reference_type: str = "",
+        model: str = MODEL_NANO_BANANA,
+        progress_callback: Optional[Callable] = None,
+        master_prompts: str = "",
+        suffix: str = "",
+        negative_prompts: str = "",
+        aspect_ratio: str = "1:1",
+        cancel_check: Optional[Callable[[], bool]] = None,
+        timeout_seconds: Optional[int] = 120,
+        job_id: Optional[str] = None,
+        variations: bool = False
+    ) -> List[Dict]:
+        """Generate images with reference, sequential."""
+        return run_sync(self.engine.generate_batch_with_reference(
+            prompts=prompts,
+            reference_image_bytes=reference_image_bytes,
+            mime_type=mime_type,
+            reference_type=reference_type,
+            model=model,
+            concurrency=1,
+            progress_callback=progress_callback,
+            master_prompts=master_prompts,
+            suffix=suffix,
+            negative_prompts=negative_prompts,
+            aspect_ratio=aspect_ratio,
+            cancel_check=cancel_check,
+            timeout_seconds=timeout_seconds,
+            job_id=job_id,
+            variations=variations
+        ))
 
     def generate_batch_with_reference_parallel(
         self,
@@ -316,86 +1049,28 @@ class ImageGenerator:
         negative_prompts: str = "",
         aspect_ratio: str = "1:1",
         cancel_check: Optional[Callable[[], bool]] = None,
-        timeout_seconds: Optional[int] = 120
+        timeout_seconds: Optional[int] = 120,
+        job_id: Optional[str] = None,
+        variations: bool = False
     ) -> List[Dict]:
         """Generate images with reference, parallel."""
-        results = [None] * len(prompts)
-        total = len(prompts)
-        completed = 0
-        timeout_sec = timeout_seconds or 120
-
-        def gen_with_idx(idx: int, prompt: str):
-            if cancel_check and cancel_check():
-                return idx, {"status": "cancelled", "prompt": "", "filename": None, "error": "Cancelled", "model": model, "timestamp": datetime.now().isoformat()}
-            with ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(
-                    self.generate_single_with_reference,
-                    prompt=prompt,
-                    reference_image_bytes=reference_image_bytes,
-                    mime_type=mime_type,
-                    reference_type=reference_type,
-                    model=model,
-                    filename_prefix=f"batch_{idx+1}",
-                    aspect_ratio=aspect_ratio,
-                    master_prompts=master_prompts,
-                    suffix=suffix,
-                    negative_prompts=negative_prompts
-                )
-                try:
-                    return idx, fut.result(timeout=timeout_sec)
-                except FuturesTimeoutError:
-                    full_prompt = f"{master_prompts}{prompt}{suffix}"
-                    if negative_prompts:
-                        full_prompt += f", avoid: {negative_prompts}"
-                    return idx, {
-                        "status": "failed",
-                        "prompt": full_prompt.strip(),
-                        "filename": None,
-                        "error": f"Timeout after {timeout_sec}s",
-                        "model": model,
-                        "timestamp": datetime.now().isoformat()
-                    }
-
-        executor = ThreadPoolExecutor(max_workers=max_workers)
-        try:
-            future_to_idx = {
-                executor.submit(gen_with_idx, idx, prompt): idx
-                for idx, prompt in enumerate(prompts)
-            }
-            for future in as_completed(future_to_idx):
-                if cancel_check and cancel_check():
-                    break
-                idx = future_to_idx[future]
-                try:
-                    i, res = future.result(timeout=1)
-                except FuturesTimeoutError:
-                    continue
-                results[idx] = res
-                completed += 1
-                if progress_callback:
-                    progress_callback(completed, total, res)
-        finally:
-            executor.shutdown(wait=False)
-
-        if cancel_check and cancel_check():
-            for i in range(len(results)):
-                if results[i] is None:
-                    full_prompt = f"{master_prompts}{prompts[i]}{suffix}"
-                    if negative_prompts:
-                        full_prompt += f", avoid: {negative_prompts}"
-                    results[i] = {
-                        "status": "cancelled",
-                        "prompt": full_prompt.strip(),
-                        "filename": None,
-                        "error": "Cancelled",
-                        "model": model,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    completed += 1
-                    if progress_callback:
-                        progress_callback(completed, total, results[i])
-
-        return results
+        return run_sync(self.engine.generate_batch_with_reference(
+            prompts=prompts,
+            reference_image_bytes=reference_image_bytes,
+            mime_type=mime_type,
+            reference_type=reference_type,
+            model=model,
+            concurrency=max_workers,
+            progress_callback=progress_callback,
+            master_prompts=master_prompts,
+            suffix=suffix,
+            negative_prompts=negative_prompts,
+            aspect_ratio=aspect_ratio,
+            cancel_check=cancel_check,
+            timeout_seconds=timeout_seconds,
+            job_id=job_id,
+            variations=variations
+        ))
 
     def generate_batch_sequential(
         self,
@@ -407,12 +1082,14 @@ class ImageGenerator:
         negative_prompts: str = "",
         aspect_ratio: str = "1:1",
         cancel_check: Optional[Callable[[], bool]] = None,
-        timeout_seconds: Optional[int] = 120
+        timeout_seconds: Optional[int] = 120,
+        job_id: Optional[str] = None,
+        variations: bool = False
     ) -> List[Dict]:
         """
         Generate รูปภาพหลายๆ รูปแบบทีละรูปตามลำดับ
         รองรับการยกเลิกและ timeout ต่อรูป (ถ้ารูปเดียวค้าง รูปอื่นยังทำงานต่อ)
-        
+
         Args:
             prompts: List ของ prompts
             model: Model ที่จะใช้
@@ -423,78 +1100,27 @@ class ImageGenerator:
             aspect_ratio: Aspect ratio ของรูป (1:1, 16:9, 9:16, 21:9, etc.)
             cancel_check: Function ที่ return True ถ้าต้องการหยุด
             timeout_seconds: Timeout ต่อ 1 รูป (วินาที) ถ้าเกินจะ mark failed แล้วทำรูปถัดไป
-            
+            job_id: ถ้าระบุ - /api/cancel ของ job นี้ abort call ที่ค้างอยู่ได้ทันทีผ่าน inflight_calls
+            variations: True = prompt ซ้ำแต่ละบรรทัดได้รูปคนละแบบ, False = prompt ซ้ำ generate ครั้งเดียวแล้วใช้ผลร่วมกัน
+
         Returns:
             List of result dictionaries
         """
-        results = []
-        total = len(prompts)
-        timeout_sec = timeout_seconds or 120
-        
-        for idx, prompt in enumerate(prompts, 1):
-            if cancel_check and cancel_check():
-                break
-            
-            aspect_prefix = get_aspect_ratio_prefix(aspect_ratio or "1:1")
-            full_prompt = f"{aspect_prefix}{master_prompts}{prompt}{suffix}"
-            if negative_prompts:
-                full_prompt += f", avoid: {negative_prompts}"
-            full_prompt = full_prompt.strip()
-
-            # รัน generate_single ใน thread - รอเป็นช่วงสั้นๆ แล้วเช็ค cancel เพื่อไม่ให้กดหยุดแล้วค้าง
-            executor = ThreadPoolExecutor(max_workers=1)
-            future = executor.submit(
-                self.generate_single,
-                prompt=full_prompt,
-                model=model,
-                filename_prefix=f"batch_{idx}",
-                aspect_ratio=aspect_ratio
-            )
-            result = None
-            chunk_sec = 3  # เช็ค cancel ทุก 3 วินาที
-            waited = 0
-            try:
-                while waited < timeout_sec:
-                    try:
-                        result = future.result(timeout=chunk_sec)
-                        break
-                    except FuturesTimeoutError:
-                        waited += chunk_sec
-                        if cancel_check and cancel_check():
-                            result = {
-                                "status": "cancelled",
-                                "prompt": full_prompt,
-                                "filename": None,
-                                "error": "Cancelled",
-                                "model": model,
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            break
-                if result is None:
-                    result = {
-                        "status": "failed",
-                        "prompt": full_prompt,
-                        "filename": None,
-                        "error": f"Timeout after {timeout_sec} seconds",
-                        "model": model,
-                        "timestamp": datetime.now().isoformat()
-                    }
-            finally:
-                executor.shutdown(wait=False)
-            
-            results.append(result)
-            
-            if progress_callback:
-                progress_callback(len(results), total, result)
-            
-            if cancel_check and cancel_check():
-                break
-            
-            if idx < total:
-                time.sleep(0.5)
-        
-        return results
-    
+        return run_sync(self.engine.generate_batch(
+            prompts=prompts,
+            model=model,
+            concurrency=1,
+            progress_callback=progress_callback,
+            master_prompts=master_prompts,
+            suffix=suffix,
+            negative_prompts=negative_prompts,
+            aspect_ratio=aspect_ratio,
+            cancel_check=cancel_check,
+            timeout_seconds=timeout_seconds,
+            job_id=job_id,
+            variations=variations
+        ))
+
     def generate_batch_parallel(
         self,
         prompts: List[str],
@@ -506,115 +1132,56 @@ class ImageGenerator:
         negative_prompts: str = "",
         aspect_ratio: str = "1:1",
         cancel_check: Optional[Callable[[], bool]] = None,
-        timeout_seconds: Optional[int] = 120
+        timeout_seconds: Optional[int] = 120,
+        job_id: Optional[str] = None,
+        variations: bool = False
     ) -> List[Dict]:
         """
         Generate รูปภาพหลายๆ รูปแบบ parallel (พร้อมกัน)
         รองรับการยกเลิก และ timeout ต่อรูป
         """
-        results = [None] * len(prompts)
-        total = len(prompts)
-        completed = 0
-        timeout_sec = timeout_seconds or 120
-        
-        def generate_with_index(idx: int, prompt: str):
-            if cancel_check and cancel_check():
-                return idx, {"status": "cancelled", "prompt": "", "filename": None, "error": "Cancelled"}
-            
-            aspect_prefix = get_aspect_ratio_prefix(aspect_ratio or "1:1")
-            full_prompt = f"{aspect_prefix}{master_prompts}{prompt}{suffix}"
-            if negative_prompts:
-                full_prompt += f", avoid: {negative_prompts}"
-            full_prompt = full_prompt.strip()
-            with ThreadPoolExecutor(max_workers=1) as ex:
-                fut = ex.submit(
-                    self.generate_single,
-                    prompt=full_prompt,
-                    model=model,
-                    filename_prefix=f"batch_{idx+1}",
-                    aspect_ratio=aspect_ratio
-                )
-                try:
-                    result = fut.result(timeout=timeout_sec)
-                except FuturesTimeoutError:
-                    result = {
-                        "status": "failed",
-                        "prompt": full_prompt,
-                        "filename": None,
-                        "error": f"Timeout after {timeout_sec}s",
-                        "model": model,
-                        "timestamp": datetime.now().isoformat()
-                    }
-            return idx, result
-        
-        executor = ThreadPoolExecutor(max_workers=max_workers)
-        try:
-            future_to_idx = {
-                executor.submit(generate_with_index, idx, prompt): idx
-                for idx, prompt in enumerate(prompts)
-            }
-            
-            for future in as_completed(future_to_idx):
-                if cancel_check and cancel_check():
-                    break
-                idx = future_to_idx[future]
-                try:
-                    idx, result = future.result(timeout=1)
-                except FuturesTimeoutError:
-                    continue
-                results[idx] = result
-                completed += 1
-                if progress_callback:
-                    progress_callback(completed, total, result)
-        finally:
-            executor.shutdown(wait=False)
-        
-        # ถ้ายกเลิก: เติมผลลัพธ์ที่ยังไม่มีเป็น cancelled
-        if cancel_check and cancel_check():
-            for i in range(len(results)):
-                if results[i] is None:
-                    # สร้าง full_prompt เหมือนข้างบน
-                    full_prompt = f"{master_prompts}{prompts[i]}{suffix}"
-                    if negative_prompts:
-                        full_prompt += f", avoid: {negative_prompts}"
-                    full_prompt = full_prompt.strip()
-                    results[i] = {
-                        "status": "cancelled",
-                        "prompt": full_prompt,
-                        "filename": None,
-                        "error": "Cancelled",
-                        "model": model,
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    completed += 1
-                    if progress_callback:
-                        progress_callback(completed, total, results[i])
-        
-        return results
-    
+        return run_sync(self.engine.generate_batch(
+            prompts=prompts,
+            model=model,
+            concurrency=max_workers,
+            progress_callback=progress_callback,
+            master_prompts=master_prompts,
+            suffix=suffix,
+            negative_prompts=negative_prompts,
+            aspect_ratio=aspect_ratio,
+            cancel_check=cancel_check,
+            timeout_seconds=timeout_seconds,
+            job_id=job_id,
+            variations=variations
+        ))
+
     def cleanup_old_images(self, max_age_hours: int = 24):
         """
         ลบรูปเก่าที่อายุเกินกำหนด
-        
+
         Args:
             max_age_hours: อายุสูงสุดของไฟล์ (ชั่วโมง)
         """
         now = time.time()
         max_age_seconds = max_age_hours * 3600
-        
+
         deleted = 0
-        for filename in os.listdir(self.output_dir):
-            if filename.endswith(('.png', '.jpg', '.jpeg')):
-                filepath = os.path.join(self.output_dir, filename)
-                file_age = now - os.path.getmtime(filepath)
-                
-                if file_age > max_age_seconds:
-                    try:
-                        os.remove(filepath)
-                        deleted += 1
-                    except Exception:
-                        pass
-        
+        folders = [self.output_dir] + ([self.thumbnail_dir] if self.thumbnail_dir else [])
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            for filename in os.listdir(folder):
+                if filename.endswith(IMAGE_EXTENSIONS):
+                    filepath = os.path.join(folder, filename)
+                    file_age = now - os.path.getmtime(filepath)
+
+                    if file_age > max_age_seconds:
+                        try:
+                            os.remove(filepath)
+                            deleted += 1
+                        except Exception:
+                            pass
+
         return deleted
 
 
@@ -622,18 +1189,18 @@ class ImageGenerator:
 if __name__ == "__main__":
     # Test code
     api_key = os.getenv("GOOGLE_API_KEY")
-    
+
     if not api_key:
         print("Error: GOOGLE_API_KEY not found in environment variables")
         exit(1)
-    
+
     generator = ImageGenerator(api_key)
-    
+
     # Test single generation
     print("Testing single image generation...")
     result = generator.generate_single("A cute cat wearing sunglasses")
     print(f"Result: {result}")
-    
+
     # Test batch sequential
     print("\nTesting batch sequential generation...")
     prompts = [
@@ -641,13 +1208,13 @@ if __name__ == "__main__":
         "A sunset over the ocean",
         "A magical forest with glowing mushrooms"
     ]
-    
+
     def progress_print(current, total, result):
         print(f"Progress: {current}/{total} - Status: {result['status']}")
-    
+
     results = generator.generate_batch_sequential(
         prompts=prompts,
         progress_callback=progress_print
     )
-    
+
     print(f"\nCompleted: {sum(1 for r in results if r['status'] == 'completed')}/{len(results)}")
@@ -0,0 +1,93 @@
+"""
+Job Archive Module
+ZIP ของแต่ละ job ที่เติมทีละรูปทันทีที่รูปเสร็จ (ZIP_STORED) และปิดท้ายด้วย manifest.json ตอน job จบ
+Download All จึงส่งไฟล์ที่มีอยู่แล้วได้ทันที (รองรับ Range) - job ที่หลุดจาก job store ไปอยู่ใน history แล้วก็ใช้ได้
+ระหว่างสร้างใช้ชื่อ <job_id>.zip.part แล้ว os.replace เป็น <job_id>.zip เมื่อ job จบ
+"""
+
+import json
+import os
+import threading
+import time
+import zipfile
+from typing import Dict, Optional
+
+
+class JobArchives:
+    """
+    ZIP ต่อ job ใน folder เดียว - การเขียนของ job เดียวกันเรียงกันด้วย lock ต่อ job
+    (job หนึ่งรันใน process เดียว จึงไม่ต้อง lock ข้าม process)
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _job_lock(self, job_id: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(job_id, threading.Lock())
+
+    def path(self, job_id: str) -> str:
+        if os.path.basename(job_id) != job_id or job_id in ('', '.', '..'):
+            raise ValueError(f"Invalid job id: {job_id}")
+        return os.path.join(self.folder, f"{job_id}.zip")
+
+    def ready_path(self, job_id: str) -> Optional[str]:
+        """path ของ archive ที่ปิดแล้ว (มี manifest) หรือ None ถ้ายังไม่มี"""
+        try:
+            path = self.path(job_id)
+        except ValueError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def add(self, job_id: str, arcname: str, filepath: str):
+        """ต่อท้ายรูป 1 รูปเข้า archive ของ job (ZIP_STORED - รูปถูกบีบอัดมาแล้ว)"""
+        part_path = self.path(job_id) + ".part"
+        with self._job_lock(job_id):
+            with zipfile.ZipFile(part_path, "a", zipfile.ZIP_STORED) as zipf:
+                if arcname not in zipf.NameToInfo:
+                    zipf.write(filepath, arcname)
+
+    def finalize(self, job_id: str, manifest: Dict) -> Optional[str]:
+        """เขียน manifest.json แล้วเปลี่ยนชื่อเป็น archive ที่พร้อมส่ง - return path หรือ None ถ้าไม่มีรูปเลย"""
+        path = self.path(job_id)
+        part_path = path + ".part"
+        with self._job_lock(job_id):
+            if not os.path.exists(part_path):
+                return None
+            with zipfile.ZipFile(part_path, "a", zipfile.ZIP_STORED) as zipf:
+                zipf.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2),
+                              compress_type=zipfile.ZIP_DEFLATED)
+            os.replace(part_path, path)
+        with self._lock:
+            self._locks.pop(job_id, None)
+        return path
+
+    def delete(self, job_id: str):
+        path = self.path(job_id)
+        with self._job_lock(job_id):
+            for p in (path, path + ".part"):
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            self._locks.pop(job_id, None)
+
+    def prune(self, max_age_seconds: float) -> int:
+        """ลบ archive ที่เก่ากว่า max_age_seconds - return จำนวนที่ลบ"""
+        cutoff = time.time() - max_age_seconds
+        deleted = 0
+        for filename in os.listdir(self.folder):
+            if not filename.endswith((".zip", ".zip.part")):
+                continue
+            filepath = os.path.join(self.folder, filename)
+            try:
+                if os.path.getmtime(filepath) < cutoff:
+                    os.remove(filepath)
+                    deleted += 1
+            except OSError:
+                pass
+        return deleted
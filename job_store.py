@@ -0,0 +1,384 @@
+"""
+Job Store Module
+ที่เก็บสถานะ job แบบเปลี่ยน backend ได้ (in-memory หรือ SQLite/WAL ที่ทุก gunicorn worker ใช้ร่วมกัน)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+
+class JobStore:
+    """Interface กลางสำหรับเก็บ job - ทุก method ต้อง thread-safe"""
+
+    def create(self, job_data: Dict) -> None:
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Return a copy of the job (including results) or None."""
+        raise NotImplementedError
+
+    def exists(self, job_id: str) -> bool:
+        return self.get(job_id) is not None
+
+    def mutate(self, job_id: str, fn: Callable[[Dict], object]):
+        """
+        Atomic read-modify-write: เรียก fn(job) แล้วบันทึกผลกลับ
+        fn แก้ job ได้โดยตรง (results เพิ่มต่อท้ายได้อย่างเดียว)
+        Return ค่าที่ fn return หรือ None ถ้าไม่เจอ job
+        """
+        raise NotImplementedError
+
+    def append_result(self, job_id: str, current: int, total: int, result: Dict) -> bool:
+        """บันทึกผลของรูป 1 รูป (semantics เดียวกับ update_job_progress เดิม)"""
+        def apply(job):
+            job['completed'] = current
+            job['results'].append(result)
+            if result['status'] == 'failed':
+                job['failed'] += 1
+            if current >= total:
+                job['status'] = 'completed'
+                job['finished_at'] = datetime.now().isoformat()
+            return True
+        return bool(self.mutate(job_id, apply))
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        raise NotImplementedError
+
+    def get_since(self, job_id: str, since: int = 0) -> Optional[Dict]:
+        """
+        job แบบย่อสำหรับ progress stream: ไม่มี prompts, results เฉพาะ index >= since
+        พร้อม 'version' (เพิ่มทุกครั้งที่ job เปลี่ยน) - return None ถ้าไม่เจอ job
+        """
+        raise NotImplementedError
+
+    def wait_for_change(self, job_id: str, version: int, timeout: float) -> Optional[int]:
+        """
+        รอจน version ของ job ไม่ใช่ version เดิม หรือครบ timeout
+        Return version ปัจจุบัน (เท่าเดิมถ้า timeout) หรือ None ถ้า job ถูกลบ
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _summary(job: Dict, since: int, version: int) -> Dict:
+        summary = {k: v for k, v in job.items() if k not in ('prompts', 'results')}
+        summary['results'] = job['results'][since:]
+        summary['results_since'] = since
+        summary['version'] = version
+        return summary
+
+    def delete(self, job_id: str) -> Optional[Dict]:
+        """ลบ job และ return job ที่ถูกลบ (หรือ None ถ้าไม่เจอ)"""
+        raise NotImplementedError
+
+    def list(self) -> List[Dict]:
+        raise NotImplementedError
+
+    def prune(self, max_age_seconds: float) -> int:
+        """ลบ job ที่จบแล้วและเก่ากว่า max_age_seconds - return จำนวนที่ลบ"""
+        raise NotImplementedError
+
+
+class InMemoryJobStore(JobStore):
+    """เก็บ job ใน dict ของ process เดียว (ใช้กับ dev server หรือ gunicorn -w 1)"""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict] = {}
+        self._created: Dict[str, float] = {}
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+
+    def _touch(self, job_id: str):
+        self._versions[job_id] = self._versions.get(job_id, 0) + 1
+        self._changed.notify_all()
+
+    @staticmethod
+    def _copy(job: Dict) -> Dict:
+        return dict(job, results=list(job['results']))
+
+    def create(self, job_data: Dict) -> None:
+        with self._lock:
+            self._jobs[job_data['id']] = self._copy(job_data)
+            self._created[job_data['id']] = time.time()
+            self._touch(job_data['id'])
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return self._copy(job) if job is not None else None
+
+    def exists(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._jobs
+
+    def mutate(self, job_id: str, fn: Callable[[Dict], object]):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            try:
+                return fn(job)
+            finally:
+                self._touch(job_id)
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            return self._jobs.get(job_id, {}).get('cancel_requested', False)
+
+    def get_since(self, job_id: str, since: int = 0) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return self._summary(job, since, self._versions.get(job_id, 0))
+
+    def wait_for_change(self, job_id: str, version: int, timeout: float) -> Optional[int]:
+        with self._changed:
+            self._changed.wait_for(
+                lambda: job_id not in self._jobs or self._versions.get(job_id, 0) != version, timeout
+            )
+            return self._versions.get(job_id, 0) if job_id in self._jobs else None
+
+    def delete(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._created.pop(job_id, None)
+            self._versions.pop(job_id, None)
+            self._changed.notify_all()
+            return self._jobs.pop(job_id, None)
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            return [self._copy(j) for j in self._jobs.values()]
+
+    def prune(self, max_age_seconds: float) -> int:
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            old_ids = [
+                job_id for job_id, created in self._created.items()
+                if created < cutoff and self._jobs[job_id]['status'] not in ('pending', 'processing')
+            ]
+            for job_id in old_ids:
+                self.delete(job_id)
+        return len(old_ids)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    เก็บ job ใน SQLite (WAL mode) - ทุก process ที่เปิดไฟล์เดียวกันเห็น job ชุดเดียวกัน
+    results แยกเป็น table ของตัวเอง เพื่อให้การเพิ่มผลแต่ละรูปเป็นแค่ INSERT 1 แถว
+    """
+
+    # wait_for_change ของ process อื่นรู้ได้จากการอ่าน version เท่านั้น (poll ถี่เท่านี้)
+    CHANGE_POLL_SECONDS = 0.25
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS job_results (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            );
+        """)
+        self._migrate(conn)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connection ใช้ข้าม thread ไม่ได้ - เปิด 1 connection ต่อ thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _migrate(self, conn: sqlite3.Connection):
+        # database เก่าที่สร้างก่อนมีคอลัมน์ version
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if 'version' in columns:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # worker อื่นอาจ migrate ไปแล้วระหว่างรอ lock
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'version' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _load(self, conn: sqlite3.Connection, job_id: str) -> Optional[Dict]:
+        row = conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        job['results'] = [
+            json.loads(r[0]) for r in conn.execute(
+                "SELECT data FROM job_results WHERE job_id = ? ORDER BY seq", (job_id,)
+            )
+        ]
+        return job
+
+    @staticmethod
+    def _dump(job: Dict) -> str:
+        return json.dumps({k: v for k, v in job.items() if k != 'results'}, ensure_ascii=False)
+
+    def create(self, job_data: Dict) -> None:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, data, created_at) VALUES (?, ?, ?)",
+                (job_data['id'], self._dump(job_data), time.time())
+            )
+            for seq, result in enumerate(job_data.get('results', [])):
+                conn.execute(
+                    "INSERT INTO job_results (job_id, seq, data) VALUES (?, ?, ?)",
+                    (job_data['id'], seq, json.dumps(result, ensure_ascii=False))
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            return self._load(conn, job_id)
+        finally:
+            conn.execute("COMMIT")
+
+    def exists(self, job_id: str) -> bool:
+        row = self._conn().execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None
+
+    def mutate(self, job_id: str, fn: Callable[[Dict], object]):
+        conn = self._conn()
+        # BEGIN IMMEDIATE จอง write lock ก่อนอ่าน - กัน worker อื่นเขียนทับระหว่าง read-modify-write
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job = self._load(conn, job_id)
+            if job is None:
+                conn.execute("COMMIT")
+                return None
+            existing = len(job['results'])
+            ret = fn(job)
+            conn.execute("UPDATE jobs SET data = ?, version = version + 1 WHERE id = ?", (self._dump(job), job_id))
+            for seq in range(existing, len(job['results'])):
+                conn.execute(
+                    "INSERT INTO job_results (job_id, seq, data) VALUES (?, ?, ?)",
+                    (job_id, seq, json.dumps(job['results'][seq], ensure_ascii=False))
+                )
+            conn.execute("COMMIT")
+            return ret
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        row = self._conn().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return False
+        return bool(json.loads(row[0]).get('cancel_requested', False))
+
+    def get_since(self, job_id: str, since: int = 0) -> Optional[Dict]:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            row = conn.execute("SELECT data, version FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = json.loads(row[0])
+            job['results'] = []
+            summary = self._summary(job, 0, row[1])
+            summary['results'] = [
+                json.loads(r[0]) for r in conn.execute(
+                    "SELECT data FROM job_results WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, since)
+                )
+            ]
+            summary['results_since'] = since
+            return summary
+        finally:
+            conn.execute("COMMIT")
+
+    def wait_for_change(self, job_id: str, version: int, timeout: float) -> Optional[int]:
+        deadline = time.monotonic() + timeout
+        conn = self._conn()
+        while True:
+            row = conn.execute("SELECT version FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] != version or time.monotonic() >= deadline:
+                return row[0]
+            time.sleep(min(self.CHANGE_POLL_SECONDS, max(0.0, deadline - time.monotonic())))
+
+    def delete(self, job_id: str) -> Optional[Dict]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job = self._load(conn, job_id)
+            if job is not None:
+                conn.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.execute("COMMIT")
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def list(self) -> List[Dict]:
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            ids = [r[0] for r in conn.execute("SELECT id FROM jobs ORDER BY created_at")]
+            return [job for job in (self._load(conn, job_id) for job_id in ids) if job is not None]
+        finally:
+            conn.execute("COMMIT")
+
+    def prune(self, max_age_seconds: float) -> int:
+        cutoff = time.time() - max_age_seconds
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old_ids = [
+                job_id for job_id, data in conn.execute(
+                    "SELECT id, data FROM jobs WHERE created_at < ?", (cutoff,)
+                ).fetchall()
+                if json.loads(data).get('status') not in ('pending', 'processing')
+            ]
+            for job_id in old_ids:
+                conn.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            conn.execute("COMMIT")
+            return len(old_ids)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def create_job_store(backend: str, path: str) -> JobStore:
+    """สร้าง job store ตาม backend ('sqlite' หรือ 'memory')"""
+    backend = (backend or 'sqlite').lower()
+    if backend == 'memory':
+        return InMemoryJobStore()
+    if backend == 'sqlite':
+        return SQLiteJobStore(path)
+    raise ValueError(f"Unknown job store backend: {backend}")
@@ -0,0 +1,126 @@
+"""
+Key Validation Module
+ตรวจ API key ด้วย list models แล้ว cache ผลไว้ใน SharedCache - validate ซ้ำ (ทุกครั้งที่เปิดหน้า / บันทึก key)
+ไม่ต้องเรียก list models ที่ต้องดึงทุกหน้าผ่าน network ใหม่
+- key ใน cache เป็น HMAC-SHA256 ของ key กับ salt (ไม่เก็บ key จริง และเดา key จาก hash ไม่ได้แม้เห็นไฟล์ cache)
+- key ใช้ได้: เก็บรายชื่อ model ที่ key นั้นเห็น - ใช้ตอบคำถามเรื่อง model / capability ได้จาก cache เดียวกัน
+- key ใช้ไม่ได้ (400 / 401 / 403): cache ผลลบด้วย TTL ที่สั้นกว่า
+- error ชั่วคราว (network / 5xx / 429) ไม่ cache
+"""
+
+import hashlib
+import hmac
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+from client_pool import ClientPool, default_client_pool
+from gemini_errors import is_retryable_error
+from shared_cache import SharedCache
+
+
+def load_or_create_salt(path: str) -> bytes:
+    """
+    salt ที่ทุก worker ใช้ร่วมกัน - สุ่มครั้งแรกแล้วเก็บในไฟล์
+    เขียนลงไฟล์ชั่วคราวแล้ว os.link เข้าชื่อจริง (ล้มเหลวถ้ามีอยู่แล้ว) - worker แรกชนะ และไม่มีใครอ่านเจอไฟล์ที่เขียนไม่เสร็จ
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp_', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(tmp_path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def salted_key_hash(api_key: str, salt: bytes) -> str:
+    return hmac.new(salt, api_key.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def key_error_message(error: Exception) -> str:
+    """ข้อความ error ของ key ที่ผู้ใช้เข้าใจง่าย"""
+    message = str(error)
+    if 'API_KEY_INVALID' in message or 'invalid' in message.lower():
+        return 'API key ไม่ถูกต้อง'
+    if 'permission' in message.lower():
+        return 'API key ไม่มีสิทธิ์เข้าถึง Gemini API'
+    return message
+
+
+def model_info(model) -> Dict:
+    """ข้อมูลของ model จาก list_models ในรูปแบบที่เก็บเป็น JSON ได้"""
+    return {
+        'name': model.name,
+        'display_name': getattr(model, 'display_name', '') or '',
+        'description': getattr(model, 'description', '') or '',
+        'supported_generation_methods': list(getattr(model, 'supported_generation_methods', None) or []),
+        'input_token_limit': getattr(model, 'input_token_limit', None),
+        'output_token_limit': getattr(model, 'output_token_limit', None),
+    }
+
+
+def is_image_model(model: Dict) -> bool:
+    name = model['name'].lower()
+    return 'image' in name or 'imagen' in name
+
+
+class KeyValidator:
+    """ผลตรวจ key + รายชื่อ model ต่อ key ผ่าน cache (ใช้จากหลาย thread ได้)"""
+
+    def __init__(self, cache: SharedCache, salt: bytes, client_pool: Optional[ClientPool] = None,
+                 negative_ttl_seconds: float = 60):
+        """
+        Args:
+            cache: cache ของผลตรวจ (TTL ของ cache ใช้กับ key ที่ใช้ได้)
+            salt: salt ของ hash ของ key (ต้องเหมือนกันทุก worker จึงจะใช้ cache ร่วมกันได้)
+            client_pool: pool ของ client แยกตาม API key (default: pool กลางของ process)
+            negative_ttl_seconds: อายุของผลลบ (key ใช้ไม่ได้)
+        """
+        self.cache = cache
+        self.salt = salt
+        self.client_pool = client_pool or default_client_pool
+        self.negative_ttl_seconds = negative_ttl_seconds
+
+    def validate(self, api_key: str) -> Dict:
+        """
+        Returns:
+            {'valid': bool, 'error': ข้อความหรือ None, 'models': [model_info, ...], 'cached': bool}
+            error ชั่วคราวได้ valid=False พร้อม 'transient': True (ไม่ถูก cache)
+        """
+        cache_key = salted_key_hash(api_key, self.salt)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return dict(cached, cached=True)
+        try:
+            models = [model_info(m) for m in self.client_pool.get(api_key).list_models()]
+        except Exception as e:
+            outcome = {'valid': False, 'error': key_error_message(e), 'models': []}
+            if is_retryable_error(e):
+                return dict(outcome, cached=False, transient=True)
+            self.cache.set(cache_key, outcome, self.negative_ttl_seconds)
+            return dict(outcome, cached=False)
+        outcome = {'valid': True, 'error': None, 'models': models}
+        self.cache.set(cache_key, outcome)
+        return dict(outcome, cached=False)
+
+    def list_models(self, api_key: str) -> List[Dict]:
+        """รายชื่อ model ที่ key นี้ใช้ได้ (จาก cache ถ้ามี) - raise ValueError ถ้า key ใช้ไม่ได้"""
+        outcome = self.validate(api_key)
+        if not outcome['valid']:
+            raise ValueError(outcome['error'])
+        return outcome['models']
+
+    def forget(self, api_key: str) -> None:
+        """ลบผลตรวจของ key นี้ออกจาก cache (ตรวจใหม่ครั้งถัดไป)"""
+        self.cache.delete(salted_key_hash(api_key, self.salt))
@@ -0,0 +1,133 @@
+"""
+Model Router Module
+ติดตามสุขภาพของแต่ละ (API key, model) - latency และสัดส่วน error แบบ EWMA
+และเลือก model สำรอง (Pro -> Flash) ต่อ prompt เมื่อ model หลัก overload หรือช้าเกิน threshold
+ใช้เฉพาะ job ที่เปิด fallback ไว้ (opt-in) และเฉพาะเมื่อ model สำรองรองรับ aspect ratio ของ job
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from circuit_breaker import CircuitBreakers
+from concurrency import key_fingerprint
+
+
+class ModelHealth:
+    """EWMA ของ latency (call ที่สำเร็จ) และ error rate ของ (key, model) เดียว"""
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.last_call = 0.0
+
+    def observe(self, latency: float, success: bool):
+        a = self.alpha
+        self.last_call = time.monotonic()
+        if success:
+            self.latency = latency if self.latency is None else (1 - a) * self.latency + a * latency
+        self.error_rate = (1 - a) * self.error_rate + a * (0.0 if success else 1.0)
+        self.samples += 1
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        fallbacks: Dict[str, str],
+        validate: Callable[[str, str], Optional[str]],
+        circuit_breakers: Optional[CircuitBreakers] = None,
+        latency_threshold: float = 60.0,
+        error_rate_threshold: float = 0.3,
+        min_samples: int = 3,
+        probe_interval: float = 30.0,
+        alpha: float = 0.3,
+        max_entries: int = 256
+    ):
+        """
+        Args:
+            fallbacks: model หลัก -> model สำรอง (เช่น Pro -> Flash)
+            validate: ตรวจว่า model รองรับ aspect ratio หรือไม่ - return ข้อความ error หรือ None
+            circuit_breakers: ถ้า circuit ของ model หลักเปิดอยู่ ให้ใช้ model สำรองทันที
+            latency_threshold: EWMA latency (วินาที) ที่ถือว่า model หลักช้าเกิน
+            error_rate_threshold: EWMA error rate ที่ถือว่า model หลัก overload
+            min_samples: จำนวน call ขั้นต่ำก่อนเชื่อค่า EWMA
+            probe_interval: ระหว่าง fallback ส่ง call ไป model หลักอย่างน้อย 1 ครั้งต่อช่วงนี้ (วินาที)
+                            เพื่อวัดว่าหายดีแล้วหรือยัง
+        """
+        self.fallbacks = dict(fallbacks)
+        self.validate = validate
+        self.circuit_breakers = circuit_breakers
+        self.latency_threshold = latency_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_samples = max(1, min_samples)
+        self.probe_interval = probe_interval
+        self.alpha = alpha
+        self.max_entries = max(1, max_entries)
+        self._health: "OrderedDict[Tuple[str, str], ModelHealth]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, api_key: str, model: str, latency: float, success: bool):
+        """บันทึกผลของ call 1 ครั้ง"""
+        key = (api_key, model)
+        with self._lock:
+            health = self._health.get(key)
+            if health is None:
+                health = self._health[key] = ModelHealth(self.alpha)
+                while len(self._health) > self.max_entries:
+                    self._health.popitem(last=False)
+            else:
+                self._health.move_to_end(key)
+            health.observe(latency, success)
+
+    def degraded_reason(self, api_key: str, model: str) -> Optional[str]:
+        """
+        เหตุผลที่ถือว่า model นี้ไม่พร้อม (circuit เปิด / error rate / latency สูง) หรือ None
+        ถ้าไม่มี call ไป model นี้นานเกิน probe_interval จะ return None 1 ครั้ง (ให้ call นั้นเป็นตัววัด)
+        """
+        if self.circuit_breakers is not None and self.circuit_breakers.get(api_key, model).is_open():
+            return "circuit open"
+        with self._lock:
+            health = self._health.get((api_key, model))
+            if health is None or health.samples < self.min_samples:
+                return None
+            if health.error_rate >= self.error_rate_threshold:
+                reason = f"error rate {health.error_rate:.0%}"
+            elif health.latency is not None and health.latency >= self.latency_threshold:
+                reason = f"latency {health.latency:.1f}s"
+            else:
+                return None
+            now = time.monotonic()
+            if now - health.last_call >= self.probe_interval:
+                health.last_call = now
+                return None
+            return reason
+
+    def choose(self, api_key: str, model: str, aspect_ratio: str = "1:1") -> Tuple[str, Optional[str]]:
+        """
+        เลือก model สำหรับ call ถัดไป
+        Returns: (model ที่จะใช้, เหตุผลที่ fallback หรือ None)
+        """
+        fallback = self.fallbacks.get(model)
+        if not fallback or self.validate(fallback, aspect_ratio):
+            return model, None
+        reason = self.degraded_reason(api_key, model)
+        if reason is None:
+            return model, None
+        return fallback, reason
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            items = list(self._health.items())
+        return [
+            {
+                "key": key_fingerprint(api_key),
+                "model": model,
+                "latency": round(health.latency, 2) if health.latency is not None else None,
+                "error_rate": round(health.error_rate, 3),
+                "samples": health.samples
+            }
+            for (api_key, model), health in items
+        ]
@@ -0,0 +1,206 @@
+"""
+Rate Limit Module
+Token bucket ต่อ (API key, model) - ทุก call ไป Gemini ต้องได้ token ก่อน
+อัตรา (RPM) ตั้งแยกต่อ model เพราะ Nano Banana / Nano Banana Pro มี quota ต่างกัน
+backend 'memory' ใช้ร่วมกันทุก job ใน process, 'sqlite' ใช้ร่วมกันทุก gunicorn worker
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from concurrency import key_fingerprint
+
+
+class RateLimitTimeoutError(Exception):
+    """รอ token ไม่ทัน deadline - ไม่ได้จอง token ไว้ (ไม่ทิ้งหนี้ให้ call ถัดไป)"""
+
+    def __init__(self, model: str, wait: float):
+        super().__init__(f"Rate limit for {model}: next slot in {wait:.1f}s is past the deadline")
+        self.model = model
+        self.wait = wait
+
+
+class RateLimiter:
+    """
+    Interface กลาง - reserve() จอง token 1 ตัวแล้ว return เวลาที่ต้องรอก่อนใช้ได้ (วินาที)
+    การจองล่วงหน้า (token ติดลบได้) ทำให้ call ที่รอคิวเรียงกันตามอัตราพอดี ไม่ต้อง poll
+    ถ้าต้องรอนานกว่า max_wait จะไม่จอง และ call ที่จองแล้วแต่ถูกยกเลิกระหว่างรอจะคืน token (refund)
+    """
+
+    def __init__(self, rates_rpm: Optional[Dict[str, float]] = None, default_rpm: float = 0, burst: int = 1):
+        """
+        Args:
+            rates_rpm: requests per minute ต่อชื่อ model
+            default_rpm: RPM ของ model ที่ไม่ได้ระบุ (0 = ไม่จำกัด)
+            burst: จำนวน call ที่ยิงติดกันได้ทันทีเมื่อ bucket เต็ม
+        """
+        self.rates_rpm = dict(rates_rpm or {})
+        self.default_rpm = default_rpm
+        self.burst = max(1, burst)
+
+    def rate_for(self, model: str) -> float:
+        """อัตราต่อวินาทีของ model (0 = ไม่จำกัด)"""
+        return max(0.0, self.rates_rpm.get(model, self.default_rpm)) / 60.0
+
+    def _refill(self, tokens: Optional[float], updated_at: float, now: float, rate: float) -> float:
+        """token ณ เวลา now หลังเติมตามเวลาที่ผ่านไป (None = bucket ใหม่ เต็ม)"""
+        if tokens is None:
+            return float(self.burst)
+        return min(float(self.burst), tokens + (now - updated_at) * rate)
+
+    @staticmethod
+    def _take(tokens: float, rate: float, max_wait: Optional[float]) -> Tuple[float, bool, float]:
+        """
+        หัก 1 จาก tokens (เติมแล้ว) - return (tokens ใหม่, จองได้หรือไม่, เวลาที่ต้องรอ)
+        ถ้าต้องรอเกิน max_wait ไม่หัก
+        """
+        wait = (1 - tokens) / rate if tokens < 1 else 0.0
+        if max_wait is not None and wait > max_wait:
+            return tokens, False, wait
+        return tokens - 1, True, wait
+
+    def _update(self, api_key: str, model: str, change):
+        """เติม bucket แล้ว change(tokens) -> (tokens ใหม่, ค่าที่ return) แบบ atomic - backend implement"""
+        raise NotImplementedError
+
+    def reserve(self, api_key: str, model: str, max_wait: Optional[float] = None) -> Tuple[bool, float]:
+        """จอง token 1 ตัว - return (จองได้หรือไม่, เวลาที่ต้องรอ) ไม่จองถ้าต้องรอเกิน max_wait"""
+        rate = self.rate_for(model)
+        if rate <= 0:
+            return True, 0.0
+
+        def take(tokens):
+            tokens, reserved, wait = self._take(tokens, rate, max_wait)
+            return tokens, (reserved, wait)
+
+        return self._update(api_key, model, take)
+
+    def refund(self, api_key: str, model: str):
+        """คืน token ที่จองไว้แต่ไม่ได้ใช้ (call ถูกยกเลิก / หมดเวลาระหว่างรอ)"""
+        if self.rate_for(model) > 0:
+            self._update(api_key, model, lambda tokens: (min(float(self.burst), tokens + 1), None))
+
+    async def acquire(self, api_key: str, model: str, deadline: Optional[float] = None):
+        """
+        รอจนได้ token (เรียกบน engine loop) - reserve / refund ที่แตะ disk ย้ายไป thread
+        deadline (time.monotonic): ถ้า token ถัดไปมาไม่ทัน raise RateLimitTimeoutError ทันทีโดยไม่จอง
+        """
+        if self.rate_for(model) <= 0:
+            return
+        max_wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+        reserved, wait = await asyncio.to_thread(self.reserve, api_key, model, max_wait)
+        if not reserved:
+            raise RateLimitTimeoutError(model, wait)
+        if wait <= 0:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            # ยังไม่ได้ใช้ token - คืนให้ call อื่น (shield: การคืนต้องเสร็จแม้ถูกยกเลิกซ้ำ)
+            await asyncio.shield(asyncio.to_thread(self.refund, api_key, model))
+            raise
+
+
+class InMemoryRateLimiter(RateLimiter):
+    """Bucket ใน dict ของ process เดียว"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._buckets: Dict[Tuple[str, str], Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def _update(self, api_key: str, model: str, change):
+        """เติม bucket แล้ว change(tokens) -> (tokens ใหม่, ค่าที่ return) ภายใต้ lock"""
+        key = (api_key, model)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (None, now))
+            tokens, value = change(self._refill(tokens, updated_at, now, self.rate_for(model)))
+            self._buckets[key] = (tokens, now)
+        return value
+
+    async def acquire(self, api_key: str, model: str, deadline: Optional[float] = None):
+        # ไม่มี I/O - จอง / คืนบน loop ได้เลย
+        if self.rate_for(model) <= 0:
+            return
+        max_wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+        reserved, wait = self.reserve(api_key, model, max_wait)
+        if not reserved:
+            raise RateLimitTimeoutError(model, wait)
+        if wait <= 0:
+            return
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self.refund(api_key, model)
+            raise
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    Bucket ใน SQLite (WAL mode) - ทุก process ที่เปิดไฟล์เดียวกันแบ่ง quota ก้อนเดียวกัน
+    เก็บ key เป็น fingerprint (ไม่เก็บ API key จริงลง disk)
+    """
+
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                bucket TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, api_key: str, model: str, change):
+        """เติม bucket แล้ว change(tokens) -> (tokens ใหม่, ค่าที่ return) แล้วเขียนกลับ ใน transaction เดียว"""
+        bucket = f"{key_fingerprint(api_key)}:{model}"
+        conn = self._conn()
+        # ใช้ wall clock เพราะแต่ละ process มี monotonic clock ของตัวเอง
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_buckets WHERE bucket = ?", (bucket,)
+            ).fetchone()
+            tokens, value = change(
+                self._refill(row[0] if row else None, row[1] if row else now, now, self.rate_for(model))
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_buckets (bucket, tokens, updated_at) VALUES (?, ?, ?)",
+                (bucket, tokens, now)
+            )
+            conn.execute("COMMIT")
+            return value
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def create_rate_limiter(backend: str, path: str, rates_rpm: Dict[str, float],
+                        default_rpm: float = 0, burst: int = 1) -> RateLimiter:
+    """สร้าง rate limiter ตาม backend ('sqlite' หรือ 'memory') - ใช้ backend เดียวกับ job store"""
+    backend = (backend or 'sqlite').lower()
+    if backend == 'memory':
+        return InMemoryRateLimiter(rates_rpm, default_rpm, burst)
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(path, rates_rpm, default_rpm, burst)
+    raise ValueError(f"Unknown rate limiter backend: {backend}")
@@ -0,0 +1,118 @@
+"""
+Reference Store Module
+เก็บ reference image ที่อัปโหลดครั้งเดียวแล้วอ้างถึงด้วย reference_id ได้ทุก job (ไม่ต้องส่ง base64 ใน JSON ซ้ำทุกครั้ง)
+- เขียนจาก stream ลงไฟล์ชั่วคราวทีละ chunk พร้อมคำนวณ sha256 (ไม่ต้องอ่านทั้งไฟล์เข้า memory ก่อน)
+- content-addressed: reference_id = sha256 ของรูป - อัปโหลดรูปเดิมซ้ำได้ id เดิมและไม่กินที่เพิ่ม
+- ไฟล์ถูกใช้เมื่อไหร่จะอัปเดต mtime - prune ลบเฉพาะรูปที่ไม่ได้ใช้นานเกินกำหนด
+ทุก worker ใช้ folder เดียวกัน (ไฟล์ถูกสร้างด้วย os.link แบบ atomic และไม่ถูกแก้อีก)
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import BinaryIO, Dict, Tuple
+
+from image_encoding import OUTPUT_FORMATS, sniff_image_format
+
+REFERENCE_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 1024 * 1024
+
+
+class ReferenceTooLargeError(ValueError):
+    """รูปใหญ่เกิน max_bytes"""
+
+
+class ReferenceStore:
+    """reference image ตาม digest ใน folder เดียว - ใช้จาก thread / process ใดก็ได้"""
+
+    def __init__(self, folder: str, max_bytes: int = 10 * 1024 * 1024):
+        """
+        Args:
+            folder: โฟลเดอร์เก็บรูป (<sha256><ext>)
+            max_bytes: ขนาดสูงสุดต่อรูป
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def save(self, stream: BinaryIO) -> Dict:
+        """
+        เขียนรูปจาก stream ลง store (ถ้ามีรูปเดียวกันอยู่แล้วใช้ไฟล์เดิม)
+        Returns: {'reference_id', 'mime_type', 'size', 'deduplicated'}
+        Raises: ReferenceTooLargeError ถ้าใหญ่เกิน / ValueError ถ้าไม่ใช่รูปที่รองรับ
+        """
+        digest = hashlib.sha256()
+        size = 0
+        head = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix='.tmp_', suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ReferenceTooLargeError(f"Image too large (max {self.max_bytes // (1024 * 1024)}MB)")
+                    if len(head) < 32:
+                        head += chunk[:32]
+                    digest.update(chunk)
+                    f.write(chunk)
+            image_format = sniff_image_format(head)
+            if image_format is None:
+                raise ValueError("Unsupported image format (expect JPG, PNG, WebP or AVIF)")
+            reference_id = digest.hexdigest()
+            path = os.path.join(self.folder, reference_id + OUTPUT_FORMATS[image_format][1])
+            try:
+                os.link(tmp_path, path)
+                deduplicated = False
+            except FileExistsError:
+                os.utime(path)
+                deduplicated = True
+        finally:
+            os.remove(tmp_path)
+        return {
+            'reference_id': reference_id,
+            'mime_type': OUTPUT_FORMATS[image_format][2],
+            'size': size,
+            'deduplicated': deduplicated
+        }
+
+    def _find(self, reference_id: str) -> Tuple[str, str]:
+        if not REFERENCE_ID_PATTERN.match(reference_id or ''):
+            raise ValueError(f"Invalid reference id: {reference_id}")
+        for _, extension, mime_type in OUTPUT_FORMATS.values():
+            path = os.path.join(self.folder, reference_id + extension)
+            if os.path.exists(path):
+                return path, mime_type
+        raise KeyError(reference_id)
+
+    def load(self, reference_id: str) -> Tuple[bytes, str]:
+        """
+        Returns: (bytes ของรูป, mime type)
+        Raises: ValueError ถ้า id ผิดรูปแบบ / KeyError ถ้าไม่มี (ไม่เคยอัปโหลดหรือถูก prune ไปแล้ว)
+        """
+        path, mime_type = self._find(reference_id)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            raise KeyError(reference_id)
+        return data, mime_type
+
+    def prune(self, max_age_seconds: float) -> int:
+        """ลบรูปที่ไม่ได้ใช้นานกว่า max_age_seconds - return จำนวนที่ลบ"""
+        cutoff = time.time() - max_age_seconds
+        deleted = 0
+        for filename in os.listdir(self.folder):
+            filepath = os.path.join(self.folder, filename)
+            try:
+                if os.path.getmtime(filepath) < cutoff:
+                    os.remove(filepath)
+                    deleted += 1
+            except OSError:
+                pass
+        return deleted
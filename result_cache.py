@@ -0,0 +1,185 @@
+"""
+Result Cache Module
+Cache ผลของ generation แบบ content-addressed (opt-in) - request ที่เหมือนกันทุกอย่างไม่ต้องเรียก Gemini ซ้ำ
+- key = sha256 ของ (prompt เต็ม, model, aspect ratio, digest ของ reference image, reference type)
+- เก็บรูปดิบจาก model 1 ไฟล์ต่อ key ใน folder เดียว + index ใน SQLite (WAL) ที่ทุก worker ใช้ร่วมกัน
+- จำกัดขนาดรวม (bytes) ลบรายการที่ไม่ได้ใช้นานสุดก่อน (LRU)
+- ตอน hit ถ้า format ตรงกับที่ job ขอ hardlink ไฟล์เข้า output folder ได้เลย (ไม่ copy)
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from image_encoding import OUTPUT_FORMATS, sniff_image_format
+
+# เปลี่ยนเมื่อวิธีประกอบ key เปลี่ยน - entry เดิมจะไม่ถูก hit อีกและหมดไปตาม LRU
+KEY_VERSION = "1"
+
+
+def reference_digest(image_bytes: Optional[bytes]) -> str:
+    """sha256 ของ reference image ('' ถ้าไม่มี)"""
+    return hashlib.sha256(image_bytes).hexdigest() if image_bytes else ""
+
+
+def result_cache_key(full_prompt: str, model: str, aspect_ratio: str = "1:1",
+                     reference_sha256: str = "", reference_type: str = "", variant: int = 0) -> str:
+    """
+    Key ของผลลัพธ์ 1 รูป - ทุกส่วนคั่นด้วย \\0 ไม่ให้ต่อกันแล้วชนกันได้
+    variant: ลำดับของ prompt ซ้ำใน batch ที่ขอรูปหลายแบบ (0 = รูปแรก ใช้ key เดียวกับ request ปกติ)
+    """
+    parts = (KEY_VERSION, full_prompt, model, aspect_ratio or "1:1", reference_sha256, reference_type or "")
+    if variant:
+        parts += (f"variant:{variant}",)
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src: str, dst: str):
+    """Hardlink src -> dst (แทนที่ dst แบบ atomic) - ถ้า filesystem ไม่รองรับ copy แทน"""
+    tmp_path = os.path.join(os.path.dirname(dst) or ".", f".tmp_{uuid.uuid4().hex}.part")
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            with open(src, "rb") as f_src, open(tmp_path, "wb") as f_dst:
+                while True:
+                    chunk = f_src.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f_dst.write(chunk)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class ResultCache:
+    """
+    Cache รูปตาม key - get / put ใช้จาก thread ใดก็ได้ (1 SQLite connection ต่อ thread)
+    ไฟล์ใน cache ไม่ถูกแก้อีกหลังเขียน จึง hardlink ไปเป็นไฟล์ผลลัพธ์ได้อย่างปลอดภัย
+    """
+
+    def __init__(self, folder: str, max_bytes: int = 2 * 1024 ** 3, index_path: Optional[str] = None):
+        """
+        Args:
+            folder: โฟลเดอร์เก็บรูปใน cache
+            max_bytes: ขนาดรวมสูงสุด เกินแล้วลบรายการที่ใช้ล่าสุดนานที่สุด (0 = ไม่จำกัด)
+            index_path: ไฟล์ SQLite ของ index (default: <folder>/index.db)
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.index_path = index_path or os.path.join(folder, "index.db")
+        os.makedirs(folder, exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                format TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                model TEXT,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used);
+        """)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connection ใช้ข้าม thread ไม่ได้ - เปิด 1 connection ต่อ thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """
+        หา entry ของ key แล้วนับเป็นการใช้ล่าสุด
+        Returns: (path ของไฟล์ใน cache, format ของรูป) หรือ None ถ้าไม่มี
+        """
+        conn = self._conn()
+        row = conn.execute("SELECT filename, format FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = os.path.join(self.folder, row[0])
+        if not os.path.exists(path):
+            # ไฟล์หายไป (ถูกลบจากภายนอก) - ลบ entry ทิ้ง
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        conn.execute("UPDATE entries SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+        return path, row[1]
+
+    def put(self, key: str, image_data: bytes, model: str = "", source_path: Optional[str] = None):
+        """
+        เก็บรูปดิบจาก model ลง cache แล้วลบรายการเก่าจนขนาดรวมไม่เกิน max_bytes
+        source_path: ไฟล์ผลลัพธ์ที่มี bytes เดียวกันอยู่แล้ว - hardlink แทนการเขียนซ้ำ
+        """
+        image_format = sniff_image_format(image_data)
+        if image_format is None:
+            return
+        filename = f"{key}{OUTPUT_FORMATS[image_format][1]}"
+        path = os.path.join(self.folder, filename)
+        if source_path:
+            link_or_copy(source_path, path)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".tmp_", suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_data)
+            os.replace(tmp_path, path)
+
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, filename, format, size, model, created_at, last_used, hits)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (key, filename, image_format, len(image_data), model, now, now)
+            )
+            evicted = self._evict(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+
+    def _evict(self, conn: sqlite3.Connection) -> list:
+        """ลบ entry ที่ใช้ล่าสุดนานที่สุดจนขนาดรวมไม่เกิน max_bytes - return ชื่อไฟล์ที่ต้องลบ"""
+        if self.max_bytes <= 0:
+            return []
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = []
+        if total <= self.max_bytes:
+            return evicted
+        for key, filename, size in conn.execute(
+            "SELECT key, filename, size FROM entries ORDER BY last_used"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            evicted.append(filename)
+            total -= size
+        return evicted
+
+    def stats(self) -> dict:
+        entries, size, hits = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0) FROM entries"
+        ).fetchone()
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes, "hits": hits}
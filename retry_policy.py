@@ -0,0 +1,108 @@
+"""
+Retry Policy Module
+ตัดสินว่าจะ retry call ที่ fail หรือไม่ และต้องรอนานเท่าไร
+- error ถาวร (prompt ผิด, key ใช้ไม่ได้, safety block) ไม่ retry
+- exponential backoff + full jitter กันไม่ให้ worker หลายตัว retry พร้อมกันเป็นระลอก
+- ถ้า server บอกเวลารอมา (RetryInfo / Retry-After) ใช้เวลานั้น
+- retry budget ต่อ job จำกัดจำนวน retry รวมทั้ง job
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from gemini_errors import is_retryable_error, server_retry_delay
+
+
+class RetryBudget:
+    """จำนวน retry ที่ job หนึ่งใช้ได้รวมทุกรูป"""
+
+    def __init__(self, retries: int):
+        self.remaining = max(0, retries)
+        self._lock = threading.Lock()
+
+    def try_consume(self) -> bool:
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        max_server_delay: float = 60.0,
+        budget_ratio: float = 0.2,
+        budget_min: int = 3
+    ):
+        """
+        Args:
+            max_attempts: จำนวนครั้งที่เรียกสูงสุดต่อรูป (รวมครั้งแรก)
+            base_delay: เวลารอพื้นฐานของ backoff (วินาที) - รอบที่ n สุ่มระหว่าง 0 ถึง base_delay * 2^n
+            max_delay: เพดานของ backoff (วินาที)
+            max_server_delay: ถ้า server ขอให้รอนานกว่านี้ ไม่ retry (fail เลย)
+            budget_ratio: retry budget ต่อ job = จำนวนรูป x budget_ratio (อย่างน้อย budget_min)
+            budget_min: retry budget ขั้นต่ำต่อ job
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = max(0.0, base_delay)
+        self.max_delay = max(self.base_delay, max_delay)
+        self.max_server_delay = max_server_delay
+        self.budget_ratio = budget_ratio
+        self.budget_min = budget_min
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            max_attempts=int(os.getenv('RETRY_MAX_ATTEMPTS', '3')),
+            base_delay=float(os.getenv('RETRY_BASE_DELAY', '1.0')),
+            max_delay=float(os.getenv('RETRY_MAX_DELAY', '30')),
+            max_server_delay=float(os.getenv('RETRY_MAX_SERVER_DELAY', '60')),
+            budget_ratio=float(os.getenv('RETRY_BUDGET_RATIO', '0.2')),
+            budget_min=int(os.getenv('RETRY_BUDGET_MIN', '3'))
+        )
+
+    def new_budget(self, total_items: int) -> RetryBudget:
+        """Retry budget ของ job ที่มี total_items รูป"""
+        return RetryBudget(max(self.budget_min, int(total_items * self.budget_ratio)))
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: สุ่มระหว่าง 0 ถึง min(max_delay, base_delay * 2^attempt)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def next_delay(
+        self,
+        error: BaseException,
+        attempt: int,
+        deadline: Optional[float] = None,
+        budget: Optional[RetryBudget] = None
+    ) -> Optional[float]:
+        """
+        เวลาที่ต้องรอก่อน retry หลัง attempt (0-based) fail ด้วย error
+        Return None ถ้าไม่ควร retry (error ถาวร / ครบจำนวนครั้ง / เลย deadline / budget หมด)
+        """
+        if attempt + 1 >= self.max_attempts or not is_retryable_error(error):
+            return None
+        delay = server_retry_delay(error)
+        if delay is not None:
+            if delay > self.max_server_delay:
+                return None
+            # jitter เล็กน้อยกันไม่ให้ทุก call กลับมาพร้อมกันตรงเวลาที่ server บอก
+            delay += random.uniform(0, min(1.0, delay * 0.1))
+        else:
+            delay = self.backoff(attempt)
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        if budget is not None and not budget.try_consume():
+            return None
+        return delay
+
+
+# Policy กลางของ process (ตั้งค่าผ่าน env)
+default_retry_policy = RetryPolicy.from_env()
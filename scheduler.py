@@ -0,0 +1,119 @@
+"""
+Generation Scheduler Module
+worker pool ขนาดคงที่ + คิว job แบบจำกัดขนาด แทนการเปิด thread ใหม่ทุก request
+และจำกัดจำนวน API call ที่วิ่งพร้อมกันทั้ง process (ข้ามทุก job)
+"""
+
+import asyncio
+import threading
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Optional
+
+
+class QueueFullError(Exception):
+    """คิวเต็ม - ให้ client ลองใหม่ภายหลัง (HTTP 429)"""
+
+    def __init__(self, queued: int, capacity: int):
+        super().__init__(f"Generation queue is full ({queued}/{capacity} jobs waiting)")
+        self.queued = queued
+        self.capacity = capacity
+
+
+class GenerationScheduler:
+    """
+    รัน job (process_generation ฯลฯ) บน worker thread จำนวนคงที่
+    - submit() รับ job เข้าคิว ถ้าคิวเต็ม raise QueueFullError
+    - call_slot() คือ gate (async) ที่ ImageGenerator ใช้ครอบทุก API call เพื่อจำกัด in-flight calls รวม
+      ทุก call วิ่งบน engine loop เดียวกันของ process จึงใช้ asyncio.Semaphore ตัวเดียวได้
+    """
+
+    def __init__(self, num_workers: int = 2, max_queue: int = 50, max_inflight_calls: int = 6):
+        self.num_workers = max(1, num_workers)
+        self.max_queue = max(1, max_queue)
+        self.max_inflight_calls = max(1, max_inflight_calls)
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._call_slots = asyncio.Semaphore(self.max_inflight_calls)
+        self._inflight_calls = 0
+        self._running: Dict[str, bool] = {}
+        self._workers = []
+
+    def _ensure_workers(self):
+        # Start thread ตอน submit ครั้งแรก (ไม่ start ตอน import เผื่อ gunicorn fork ทีหลัง)
+        if self._workers:
+            return
+        for i in range(self.num_workers):
+            t = threading.Thread(target=self._worker_loop, name=f"gen-worker-{i + 1}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job_id, fn, args = self._queue.popleft()
+                self._running[job_id] = True
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[Scheduler] Job {job_id[:8]} crashed: {e}")
+            finally:
+                with self._cond:
+                    self._running.pop(job_id, None)
+
+    def submit(self, job_id: str, fn: Callable, *args) -> int:
+        """
+        เพิ่ม job เข้าคิว
+        Returns: ตำแหน่งในคิว (1 = ตัวถัดไปที่จะได้รัน)
+        Raises: QueueFullError ถ้าคิวเต็ม
+        """
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                raise QueueFullError(len(self._queue), self.max_queue)
+            self._ensure_workers()
+            self._queue.append((job_id, fn, args))
+            position = len(self._queue)
+            self._cond.notify()
+        return position
+
+    def discard(self, job_id: str) -> bool:
+        """เอา job ที่ยังรอในคิวออก (เช่นผู้ใช้กดยกเลิกก่อนเริ่ม) - return True ถ้าเอาออกได้"""
+        with self._cond:
+            for item in self._queue:
+                if item[0] == job_id:
+                    self._queue.remove(item)
+                    return True
+        return False
+
+    def queue_position(self, job_id: str) -> Optional[int]:
+        """ตำแหน่งในคิวของ job (1-based) หรือ None ถ้าไม่ได้รออยู่ใน process นี้"""
+        with self._cond:
+            for i, item in enumerate(self._queue):
+                if item[0] == job_id:
+                    return i + 1
+        return None
+
+    @asynccontextmanager
+    async def call_slot(self):
+        """จอง slot สำหรับ API call 1 ครั้ง (รอจนกว่าจะมี slot ว่าง)"""
+        async with self._call_slots:
+            with self._cond:
+                self._inflight_calls += 1
+            try:
+                yield
+            finally:
+                with self._cond:
+                    self._inflight_calls -= 1
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'workers': self.num_workers,
+                'running_jobs': len(self._running),
+                'queued_jobs': len(self._queue),
+                'queue_capacity': self.max_queue,
+                'inflight_calls': self._inflight_calls,
+                'max_inflight_calls': self.max_inflight_calls
+            }
@@ -0,0 +1,134 @@
+"""
+Shared Cache Module
+Cache แบบ key -> ค่า (JSON) พร้อม TTL ที่ทุก gunicorn worker ใช้ร่วมกันผ่าน SQLite (WAL)
+- ชั้นแรกเป็น LRU ใน process: hit ซ้ำเป็นแค่ dict lookup ไม่แตะ disk
+- ชั้นที่สองเป็นตารางใน SQLite: ผลที่ worker อื่นเคยได้มาใช้ได้ทันที (1 query ตาม primary key)
+- หมดอายุตาม TTL (กำหนดต่อ entry ได้ เช่น cache ผลลบให้สั้นกว่า) และจำกัดจำนวน entry (ลบที่ใช้ล่าสุดนานสุดก่อน)
+หลาย cache ใช้ไฟล์เดียวกันได้ แยกกันด้วย namespace
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+
+class SharedCache:
+    """
+    Cache ของ namespace เดียว - path=None คือเก็บใน process อย่างเดียว (backend 'memory')
+    ค่า None ใช้แทน "ไม่มีใน cache" จึงเก็บ None ไม่ได้
+    """
+
+    def __init__(self, path: Optional[str], namespace: str, ttl_seconds: float,
+                 max_entries: int = 10000, local_entries: int = 1024):
+        """
+        Args:
+            path: ไฟล์ SQLite ที่ใช้ร่วมกันทุก worker (None = ใน process อย่างเดียว)
+            namespace: ชื่อกลุ่มของ key ในไฟล์
+            ttl_seconds: อายุ default ของ entry
+            max_entries: จำนวน entry สูงสุดใน SQLite ของ namespace นี้
+            local_entries: จำนวน entry สูงสุดใน LRU ของ process
+        """
+        self.path = path
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self.local_entries = max(1, local_entries if path else max_entries)
+        self._local_cache: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            conn = self._conn()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                );
+                CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache (namespace, last_used);
+            """)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connection ใช้ข้าม thread ไม่ได้ - เปิด 1 connection ต่อ thread
+        conn = getattr(self._thread, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._thread.conn = conn
+        return conn
+
+    def _remember(self, key: str, value: Any, expires_at: float):
+        with self._lock:
+            self._local_cache[key] = (value, expires_at)
+            self._local_cache.move_to_end(key)
+            while len(self._local_cache) > self.local_entries:
+                self._local_cache.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Any]:
+        """ค่าของ key หรือ None ถ้าไม่มี / หมดอายุ"""
+        now = time.time()
+        with self._lock:
+            entry = self._local_cache.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._local_cache.move_to_end(key)
+                    return entry[0]
+                del self._local_cache[key]
+        if not self.path:
+            return None
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        conn.execute(
+            "UPDATE cache SET last_used = ? WHERE namespace = ? AND key = ?", (now, self.namespace, key)
+        )
+        value = json.loads(row[0])
+        self._remember(key, value, row[1])
+        return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        """เก็บค่า (ต้อง serialize เป็น JSON ได้) อายุ ttl_seconds (default: ttl ของ cache)"""
+        now = time.time()
+        expires_at = now + (self.ttl_seconds if ttl_seconds is None else ttl_seconds)
+        self._remember(key, value, expires_at)
+        if not self.path:
+            return
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), expires_at, now)
+            )
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND expires_at <= ?", (self.namespace, now))
+            excess = conn.execute(
+                "SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key IN "
+                    "(SELECT key FROM cache WHERE namespace = ? ORDER BY last_used LIMIT ?)",
+                    (self.namespace, self.namespace, excess)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._local_cache.pop(key, None)
+        if self.path:
+            self._conn().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
@@ -6,6 +6,8 @@
 // ===== Global Variables =====
 let currentJobId = null;
 let statusCheckInterval = null;
+let statusEventSource = null;
+let liveJob = null;
 let promptCounter = 0;
 let promptCounterRef = 0;  // แยก counter สำหรับ Reference mode
 
@@ -35,6 +37,7 @@ const modeSelect = document.getElementById('modeSelect');
 const aspectRatioSelect = document.getElementById('aspectRatioSelect');
 const aspectRatioDropdownBtn = document.getElementById('aspectRatioDropdownBtn');
 const aspectRatioDropdownMenu = document.getElementById('aspectRatioDropdownMenu');
+const outputFormatSelect = document.getElementById('outputFormatSelect');
 const customAspectRatioInput = document.getElementById('customAspectRatioInput');
 const customAspectRatioWidth = document.getElementById('customAspectRatioWidth');
 const customAspectRatioHeight = document.getElementById('customAspectRatioHeight');
@@ -93,6 +96,7 @@ const historyList = document.getElementById('historyList');
 const historyEmpty = document.getElementById('historyEmpty');
 const historyToggleContainer = document.getElementById('historyToggleContainer');
 const historyToggleBtn = document.getElementById('historyToggleBtn');
+const historySearchInput = document.getElementById('historySearchInput');
 const refreshHistoryBtn = document.getElementById('refreshHistoryBtn');
 const deleteAllHistoryBtn = document.getElementById('deleteAllHistoryBtn');
 
@@ -128,6 +132,9 @@ const REFERENCE_TYPE_PRESETS = {
 
 // Store reference image data (base64 data URL)
 let referenceImageData = null;
+// อัปโหลด reference ครั้งเดียวผ่าน /api/references แล้วส่งแค่ reference_id (null = อัปโหลดไม่สำเร็จ ส่ง data URL แทน)
+let referenceFile = null;
+let referenceIdPromise = null;
 
 // Cleanup Section Elements
 const cleanupSection = document.getElementById('cleanupSection');
@@ -141,8 +148,12 @@ const cleanupNowBtn = document.getElementById('cleanupNowBtn');
 
 // History list state
 const MAX_HISTORY_ITEMS_COLLAPSED = 5;
+const HISTORY_PAGE_SIZE = 50;
 let historyJobsAll = [];
 let historyExpanded = false;
+// cursor ของหน้าถัดไป (null = โหลดครบแล้ว) และยอดรวมทั้ง history จาก server
+let historyNextCursor = null;
+let historyTotals = null;
 const historyDayCollapsed = {};
 
 // ===== API Key Functions =====
@@ -220,14 +231,53 @@ function handleReferenceFile(file) {
         showToast('Image too large (max 10MB)', 'warning');
         return;
     }
-    const reader = new FileReader();
-    reader.onload = (e) => {
-        referenceImageData = e.target.result;
-        if (referencePreviewImg) referencePreviewImg.src = referenceImageData;
-        if (referenceUploadPlaceholder) referenceUploadPlaceholder.style.display = 'none';
-        if (referencePreviewBlock) referencePreviewBlock.style.display = 'block';
-    };
-    reader.readAsDataURL(file);
+    clearReferenceImage();
+    referenceFile = file;
+    referenceImageData = URL.createObjectURL(file);
+    referenceIdPromise = uploadReference(file);
+    if (referencePreviewImg) referencePreviewImg.src = referenceImageData;
+    if (referenceUploadPlaceholder) referenceUploadPlaceholder.style.display = 'none';
+    if (referencePreviewBlock) referencePreviewBlock.style.display = 'block';
+}
+
+/**
+ * อัปโหลด reference image (multipart) - return reference_id หรือ null ถ้าไม่สำเร็จ
+ */
+async function uploadReference(file) {
+    const form = new FormData();
+    form.append('file', file);
+    try {
+        const response = await fetch('/api/references', { method: 'POST', body: form });
+        const result = await response.json();
+        return result.success ? result.reference_id : null;
+    } catch (error) {
+        return null;
+    }
+}
+
+function readFileAsDataURL(file) {
+    return new Promise((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onload = (e) => resolve(e.target.result);
+        reader.onerror = () => reject(reader.error);
+        reader.readAsDataURL(file);
+    });
+}
+
+/**
+ * field ของ reference ใน request: { reference_id } หรือ { reference_image: data URL } ถ้าอัปโหลดไม่สำเร็จ
+ */
+async function getReferencePayload() {
+    const referenceId = referenceIdPromise ? await referenceIdPromise : null;
+    if (referenceId) return { reference_id: referenceId };
+    return { reference_image: await readFileAsDataURL(referenceFile) };
+}
+
+function clearReferenceImage() {
+    if (referenceImageData) URL.revokeObjectURL(referenceImageData);
+    referenceImageData = null;
+    referenceFile = null;
+    referenceIdPromise = null;
 }
 
 // ===== Reference Type Preset =====
@@ -1098,11 +1148,12 @@ function createGalleryItem(result, index) {
     div.className = 'col-md-4 col-sm-6';
     
     const imageUrl = `/static/generated/${result.filename}`;
+    const thumbUrl = result.thumbnail_url || imageUrl;
     const promptHtml = escapeHtml(result.prompt);
     
     div.innerHTML = `
         <div class="card h-100 shadow-sm gallery-item-card">
-            <img src="${imageUrl}" alt="Generated Image" class="card-img-top gallery-item-img" loading="lazy" style="object-fit: cover; height: 250px; cursor: pointer;" title="Click to view full size">
+            <img src="${thumbUrl}" alt="Generated Image" class="card-img-top gallery-item-img" loading="lazy" style="object-fit: cover; height: 250px; cursor: pointer;" title="Click to view full size">
             <div class="card-body">
                 <div class="mb-2">
                     <div class="gallery-item-prompt small text-muted" style="line-height: 1.4;" title="${promptHtml}">
@@ -1261,11 +1312,15 @@ async function startGeneration() {
         master_prompts: masterPromptsInput.value.trim(),
         suffix: suffixInput.value.trim(),
         negative_prompts: negativePromptsInput.value.trim(),
-        character_consistency: charConsistency
+        character_consistency: charConsistency,
+        // ไม่ได้เลือก format = ไม่ส่ง (server ใช้ OUTPUT_FORMAT ของตัวเอง)
+        output_format: outputFormatSelect?.value || undefined,
+        // prompt ซ้ำจาก "images per prompt" ต้องได้รูปคนละแบบ (ไม่งั้น server รวม prompt ซ้ำเป็นรูปเดียว)
+        variations: variations > 1
     };
 
     if (isReferenceMode) {
-        data.reference_image = referenceImageData;
+        Object.assign(data, await getReferencePayload());
         data.reference_type = referenceTypeSelect?.value || '';
     }
 
@@ -1298,9 +1353,9 @@ async function startGeneration() {
                 promptList.appendChild(createPromptItem(prompt, index, 'pending'));
             });
             
-            // เริ่ม polling status
+            // เริ่มรับ progress (SSE, fallback เป็น polling)
             requestNotificationPermission();
-            startStatusPolling();
+            startStatusUpdates();
 
             // Disable generate button และแสดงปุ่มหยุด
             generateBtn.disabled = true;
@@ -1336,6 +1391,52 @@ function sendBatchNotification(completed, total) {
     });
 }
 
+/**
+ * เริ่มรับ progress ของ job ผ่าน Server-Sent Events (/api/events/<job_id>)
+ * ถ้า browser ไม่รองรับหรือเชื่อมต่อไม่ได้ ใช้ status polling แทน
+ */
+function startStatusUpdates() {
+    stopStatusPolling();
+    if (!window.EventSource || !currentJobId) {
+        startStatusPolling();
+        return;
+    }
+    
+    const jobId = currentJobId;
+    const source = new EventSource(`/api/events/${jobId}`);
+    statusEventSource = source;
+    liveJob = { results: [] };
+    
+    // ผลรูปใหม่ทีละรูป (id ของ event ใช้ resume อัตโนมัติเมื่อหลุด)
+    source.addEventListener('result', (event) => {
+        if (currentJobId !== jobId || !liveJob) return;
+        const { index, result } = JSON.parse(event.data);
+        liveJob.results[index] = result;
+        updateProgress(liveJob, index);
+    });
+    
+    source.addEventListener('status', (event) => {
+        if (currentJobId !== jobId || !liveJob) return;
+        const { results_since, ...summary } = JSON.parse(event.data);
+        Object.assign(liveJob, summary);
+        updateProgress(liveJob, liveJob.results.length);
+    });
+    
+    // job จบ - ดึง job เต็มครั้งเดียวเพื่อแสดงผลลัพธ์
+    source.addEventListener('done', () => {
+        stopStatusPolling();
+        finishJob(jobId);
+    });
+    
+    source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED && statusEventSource === source) {
+            console.warn('Progress stream unavailable, falling back to polling');
+            stopStatusPolling();
+            startStatusPolling();
+        }
+    };
+}
+
 /**
  * เริ่มต้น status polling
  */
@@ -1344,6 +1445,7 @@ function startStatusPolling() {
         clearInterval(statusCheckInterval);
     }
     
+    liveJob = { results: [], etag: null };
     statusCheckInterval = setInterval(checkStatus, 1000);
 }
 
@@ -1355,40 +1457,40 @@ function stopStatusPolling() {
         clearInterval(statusCheckInterval);
         statusCheckInterval = null;
     }
+    if (statusEventSource) {
+        statusEventSource.close();
+        statusEventSource = null;
+    }
+    liveJob = null;
 }
 
 /**
- * ตรวจสอบสถานะของ job
+ * ตรวจสอบสถานะของ job (polling)
+ * ขอเฉพาะผลที่ยังไม่เคยได้ (?since=n) และส่ง ETag เดิมไป - ถ้าไม่มีอะไรเปลี่ยน server ตอบ 304
  */
 async function checkStatus() {
-    if (!currentJobId) return;
+    if (!currentJobId || !liveJob) return;
+    const jobId = currentJobId;
+    const state = liveJob;
     
     try {
-        const response = await fetch(`/api/status/${currentJobId}`);
+        const headers = state.etag ? { 'If-None-Match': state.etag } : {};
+        const response = await fetch(`/api/status/${jobId}?since=${state.results.length}`, { headers });
+        if (response.status === 304 || liveJob !== state) return;
         const result = await response.json();
         
         if (result.success) {
-            updateProgress(result.job);
+            const { results, results_since, ...summary } = result.job;
+            if (results_since !== state.results.length) return; // คำตอบของ poll ที่ซ้อนกัน
+            state.etag = response.headers.get('ETag');
+            Object.assign(state, summary);
+            state.results.push(...results);
+            updateProgress(state, results_since);
             
             // ถ้าเสร็จ / ยกเลิก / error หยุด polling และแสดงผลลัพธ์ (รูปที่ได้แล้วยังแสดง)
-            if (result.job.status === 'completed' || result.job.status === 'error' || result.job.status === 'cancelled') {
+            if (state.status === 'completed' || state.status === 'error' || state.status === 'cancelled') {
                 stopStatusPolling();
-                displayResults(result.job);
-                generateBtn.disabled = false;
-                if (cancelJobBtn) {
-                    cancelJobBtn.style.display = 'none';
-                    cancelJobBtn.disabled = false;
-                    cancelJobBtn.innerHTML = '<i class="bi bi-stop-circle me-1"></i> Stop / Cancel';
-                }
-                
-                if (result.job.status === 'completed') {
-                    showToast('Image generation complete!', 'success');
-                    sendBatchNotification(result.job.completed - result.job.failed, result.job.total);
-                } else if (result.job.status === 'cancelled') {
-                    showToast('Cancelled. Showing completed images.', 'warning');
-                } else {
-                    showToast('Error generating images', 'error');
-                }
+                finishJob(jobId);
             }
         }
     } catch (error) {
@@ -1396,10 +1498,43 @@ async function checkStatus() {
     }
 }
 
+/**
+ * ดึง job เต็ม (รวม prompts / results ทั้งหมด) ครั้งเดียวหลัง job จบ แล้วแสดงผลลัพธ์
+ */
+async function finishJob(jobId) {
+    try {
+        const response = await fetch(`/api/status/${jobId}`);
+        const result = await response.json();
+        if (!result.success || currentJobId !== jobId) return;
+        const job = result.job;
+        
+        updateProgress(job);
+        displayResults(job);
+        generateBtn.disabled = false;
+        if (cancelJobBtn) {
+            cancelJobBtn.style.display = 'none';
+            cancelJobBtn.disabled = false;
+            cancelJobBtn.innerHTML = '<i class="bi bi-stop-circle me-1"></i> Stop / Cancel';
+        }
+        
+        if (job.status === 'completed') {
+            showToast('Image generation complete!', 'success');
+            sendBatchNotification(job.completed - job.failed, job.total);
+        } else if (job.status === 'cancelled') {
+            showToast('Cancelled. Showing completed images.', 'warning');
+        } else {
+            showToast('Error generating images', 'error');
+        }
+    } catch (error) {
+        console.error('Status check error:', error);
+    }
+}
+
 /**
  * อัพเดท progress UI
+ * fromIndex: อัพเดทเฉพาะ prompt item ตั้งแต่ index นี้ (SSE ส่งมาเฉพาะผลใหม่)
  */
-function updateProgress(job) {
+function updateProgress(job, fromIndex = 0) {
     const { total, completed, failed } = job;
     const pending = total - completed;
     const percentage = total > 0 ? Math.round((completed / total) * 100) : 0;
@@ -1407,7 +1542,7 @@ function updateProgress(job) {
     // Log detailed errors to console for debugging
     if (job.results && job.results.length > 0) {
         job.results.forEach((result, idx) => {
-            if (result.status === 'failed' && result.error) {
+            if (idx >= fromIndex && result && result.status === 'failed' && result.error) {
                 console.error(`❌ Image ${idx + 1} failed:`, result.error);
                 console.error(`   Prompt:`, result.prompt);
             }
@@ -1428,6 +1563,7 @@ function updateProgress(job) {
     // Update prompt items
     if (job.results && job.results.length > 0) {
         job.results.forEach((result, index) => {
+            if (index < fromIndex || !result) return;
             const promptItem = promptList.querySelector(`[data-index="${index}"]`);
             if (promptItem) {
                 const statusConfig = {
@@ -1588,7 +1724,7 @@ async function clearForm() {
     if (deletePresetBtn) deletePresetBtn.style.display = 'none';
 
     // Clear reference mode
-    referenceImageData = null;
+    clearReferenceImage();
     if (referencePreviewImg) referencePreviewImg.src = '';
     if (referenceUploadPlaceholder) referenceUploadPlaceholder.style.display = 'block';
     if (referencePreviewBlock) referencePreviewBlock.style.display = 'none';
@@ -1633,15 +1769,20 @@ async function cancelJob() {
 // ===== History Functions =====
 
 /**
- * Fetch job history from API
+ * Fetch the first page of job history (summary view) from API
  */
 async function fetchHistory() {
+    // มีคำค้นอยู่ -> โหลดผลค้นหาใหม่แทนหน้าแรก
+    const query = historySearchInput ? historySearchInput.value.trim() : '';
+    if (query) return searchHistory(query);
     try {
-        const response = await fetch('/api/history');
+        const response = await fetch(`/api/history?view=summary&limit=${HISTORY_PAGE_SIZE}`);
         const result = await response.json();
         
         if (result.success) {
             historyJobsAll = result.jobs || [];
+            historyNextCursor = result.next_cursor ?? null;
+            historyTotals = result.totals || null;
             // รีเซ็ตสถานะเป็นแบบย่อทุกครั้งที่โหลดใหม่
             historyExpanded = false;
             renderHistory();
@@ -1651,6 +1792,46 @@ async function fetchHistory() {
     }
 }
 
+/**
+ * Search history prompts (full-text, ranked by server)
+ */
+async function searchHistory(query) {
+    try {
+        const response = await fetch(`/api/history/search?q=${encodeURIComponent(query)}&limit=${HISTORY_PAGE_SIZE}`);
+        const result = await response.json();
+
+        if (result.success) {
+            historyJobsAll = result.jobs || [];
+            historyNextCursor = null;
+            historyTotals = null;
+            // แสดงผลค้นหาทั้งหมดทันที
+            historyExpanded = true;
+            renderHistory();
+        }
+    } catch (error) {
+        console.error('Failed to search history:', error);
+    }
+}
+
+/**
+ * Fetch the next page of job history and append it to the list
+ */
+async function loadMoreHistory() {
+    if (historyNextCursor === null) return;
+    try {
+        const response = await fetch(`/api/history?view=summary&limit=${HISTORY_PAGE_SIZE}&cursor=${historyNextCursor}`);
+        const result = await response.json();
+
+        if (result.success) {
+            historyJobsAll = historyJobsAll.concat(result.jobs || []);
+            historyNextCursor = result.next_cursor ?? null;
+            renderHistory();
+        }
+    } catch (error) {
+        console.error('Failed to load more history:', error);
+    }
+}
+
 /**
  * Render history list
  */
@@ -1680,7 +1861,7 @@ function renderHistory() {
     let totalImagesAll = 0;
     const groupsByDate = {};
     jobs.forEach(job => {
-        const promptsCount = job.total || (job.prompts ? job.prompts.length : 0);
+        const promptsCount = job.total || job.prompt_count || (job.prompts ? job.prompts.length : 0);
         const imagesCount = job.success_count ?? job.completed ?? 0;
 
         totalPromptsAll += promptsCount;
@@ -1714,8 +1895,9 @@ function renderHistory() {
     const totalPromptsEl = document.getElementById('historyTotalPrompts');
     const totalImagesEl = document.getElementById('historyTotalImages');
     if (summaryEl) summaryEl.style.display = 'block';
-    if (totalPromptsEl) totalPromptsEl.textContent = totalPromptsAll;
-    if (totalImagesEl) totalImagesEl.textContent = totalImagesAll;
+    // ยอดรวมจาก server ครอบคลุมหน้าที่ยังไม่ได้โหลดด้วย
+    if (totalPromptsEl) totalPromptsEl.textContent = historyTotals ? historyTotals.prompts : totalPromptsAll;
+    if (totalImagesEl) totalImagesEl.textContent = historyTotals ? historyTotals.images : totalImagesAll;
 
     // สรุปรวมแยกตามวัน (ใต้ summary)
     if (summaryEl) {
@@ -1732,9 +1914,11 @@ function renderHistory() {
             .join('<br>');
     }
 
+    const totalJobs = historyTotals ? Math.max(historyTotals.jobs, jobs.length) : jobs.length;
+
     // จัดการปุ่ม Show more / Show less ตามจำนวน jobs ทั้งหมด
     if (historyToggleContainer && historyToggleBtn) {
-        if (jobs.length > MAX_HISTORY_ITEMS_COLLAPSED) {
+        if (totalJobs > MAX_HISTORY_ITEMS_COLLAPSED) {
             historyToggleContainer.style.display = 'block';
         } else {
             historyToggleContainer.style.display = 'none';
@@ -1807,7 +1991,7 @@ function renderHistory() {
         
         const refBadge = job.has_reference ? '<span class="badge bg-info ms-1" title="Reference image">Ref</span>' : '';
         const ccBadge = job.character_consistency ? '<span class="badge bg-secondary ms-1" title="Character consistency">CC</span>' : '';
-        const totalPrompts = job.total || (job.prompts ? job.prompts.length : 0);
+        const totalPrompts = job.total || job.prompt_count || (job.prompts ? job.prompts.length : 0);
         const imagesCreated = job.success_count ?? job.completed ?? 0;
 
         item.innerHTML = `
@@ -1870,13 +2054,17 @@ function renderHistory() {
     historyList.appendChild(groupContainer);
     });
 
-    // อัปเดตข้อความปุ่ม Show all history ตามจำนวนที่ซ่อน
+    // อัปเดตข้อความปุ่ม Show all history ตามจำนวนที่ซ่อน (รวมหน้าที่ยังไม่ได้โหลด)
     if (historyToggleContainer && historyToggleBtn) {
-        if (jobs.length > MAX_HISTORY_ITEMS_COLLAPSED) {
-            const hiddenCount = Math.max(0, jobs.length - visibleJobsCount);
-            historyToggleBtn.textContent = historyExpanded
-                ? 'Show less history'
-                : `Show all history (${hiddenCount})`;
+        if (totalJobs > MAX_HISTORY_ITEMS_COLLAPSED) {
+            const hiddenCount = Math.max(0, totalJobs - visibleJobsCount);
+            if (!historyExpanded) {
+                historyToggleBtn.textContent = `Show all history (${hiddenCount})`;
+            } else if (historyNextCursor !== null) {
+                historyToggleBtn.textContent = `Load more history (${Math.max(0, totalJobs - jobs.length)})`;
+            } else {
+                historyToggleBtn.textContent = 'Show less history';
+            }
         } else {
             historyToggleContainer.style.display = 'none';
         }
@@ -1990,9 +2178,10 @@ async function showHistoryPreview(jobId) {
                 const col = document.createElement('div');
                 col.className = 'col-6 col-md-4 col-lg-3';
                 const url = `/static/generated/${r.filename}`;
+                const thumbUrl = r.thumbnail_url || url;
                 col.innerHTML = `
                     <div class="history-preview-thumb" title="${escapeHtml(r.prompt || '')}">
-                        <img src="${url}" alt="Image ${i + 1}" onerror="this.parentElement.innerHTML='<div class=\\'text-muted small p-2\\'>Image unavailable</div>'">
+                        <img src="${thumbUrl}" loading="lazy" alt="Image ${i + 1}" onerror="this.parentElement.innerHTML='<div class=\\'text-muted small p-2\\'>Image unavailable</div>'">
                     </div>
                 `;
                 const thumb = col.querySelector('.history-preview-thumb');
@@ -2060,9 +2249,9 @@ async function rerunJob(jobId, jobData) {
                 promptList.appendChild(createPromptItem(prompt, index, 'pending'));
             });
             
-            // เริ่ม polling status
+            // เริ่มรับ progress (SSE, fallback เป็น polling)
             requestNotificationPermission();
-            startStatusPolling();
+            startStatusUpdates();
 
             // Disable generate button
             generateBtn.disabled = true;
@@ -2331,7 +2520,7 @@ if (referenceFileInput) {
 if (referenceRemoveBtn) {
     referenceRemoveBtn.addEventListener('click', (e) => {
         e.stopPropagation();
-        referenceImageData = null;
+        clearReferenceImage();
         referencePreviewImg.src = '';
         referenceUploadPlaceholder.style.display = 'block';
         referencePreviewBlock.style.display = 'none';
@@ -2375,7 +2564,7 @@ if (analyzeRefTypeBtn) {
             const res = await fetch('/api/analyze-reference-type', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ api_key: apiKey, reference_image: referenceImageData })
+                body: JSON.stringify({ api_key: apiKey, ...(await getReferencePayload()) })
             });
             const result = await res.json();
             if (result.success && result.type) {
@@ -2530,8 +2719,20 @@ if (cancelJobBtn) cancelJobBtn.addEventListener('click', cancelJob);
 // History buttons
 if (refreshHistoryBtn) refreshHistoryBtn.addEventListener('click', fetchHistory);
 if (deleteAllHistoryBtn) deleteAllHistoryBtn.addEventListener('click', deleteAllHistory);
+if (historySearchInput) {
+    let historySearchTimer = null;
+    historySearchInput.addEventListener('input', () => {
+        clearTimeout(historySearchTimer);
+        historySearchTimer = setTimeout(fetchHistory, 300);
+    });
+}
 if (historyToggleBtn) {
     historyToggleBtn.addEventListener('click', () => {
+        // โหมดขยายและยังมีหน้าถัดไป -> โหลดเพิ่มแทนการย่อ
+        if (historyExpanded && historyNextCursor !== null) {
+            loadMoreHistory();
+            return;
+        }
         historyExpanded = !historyExpanded;
         renderHistory();
     });
@@ -0,0 +1,64 @@
+"""
+Zip Stream Module
+สร้าง ZIP แบบ stream ทีละ chunk (ไม่เขียนไฟล์ชั่วคราวลง disk)
+รูปเก็บแบบ ZIP_STORED - PNG / WebP / JPEG ถูกบีบอัดมาแล้ว deflate ซ้ำเปลือง CPU เปล่าๆ
+memory คงที่ไม่ว่า job จะมีกี่รูป (ถือแค่ chunk ล่าสุด)
+"""
+
+import io
+import zipfile
+from typing import Iterable, Iterator, Tuple
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ZipStreamBuffer(io.RawIOBase):
+    """File object แบบเขียนอย่างเดียว (ไม่ seek ได้) - ZipFile เขียนลงมา แล้ว generator ดึงออกไปส่งทีละก้อน"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(files: Iterable[Tuple[str, str]], extra: Iterable[Tuple[str, bytes]] = ()) -> Iterator[bytes]:
+    """
+    Yield bytes ของ ZIP ทีละ chunk
+
+    Args:
+        files: (ชื่อใน ZIP, path บน disk) - เก็บแบบ ZIP_STORED
+        extra: (ชื่อใน ZIP, ข้อมูล) เช่น manifest.json - บีบอัดแบบ ZIP_DEFLATED
+    """
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zipf:
+        for arcname, filepath in files:
+            info = zipfile.ZipInfo.from_file(filepath, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(filepath, "rb") as src, zipf.open(info, "w") as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+        for arcname, content in extra:
+            zipf.writestr(arcname, content, compress_type=zipfile.ZIP_DEFLATED)
+    data = buffer.drain()
+    if data:
+        yield data